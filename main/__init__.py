@@ -3,7 +3,6 @@ Init file for the application
 """
 # Import statements
 import os
-import logging
 from flask import Flask, render_template
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
@@ -12,13 +11,89 @@ from dotenv import load_dotenv
 
 # Configuration for the app
 app = Flask(__name__)
-app.logger.setLevel(logging.INFO)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///eCommerceWebsite.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///eCommerceWebsite.db')
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY")
+# Apply pending schema migrations when the app starts, turn off to run flask upgrade-db when deploying
+app.config['MIGRATE_ON_STARTUP'] = True
+# Catalogue pages are validated against this file and shared caches may store them for this many seconds
+app.config['CATALOGUE_VERSION_FILE'] = os.path.join(app.instance_path, 'catalogue.version')
+app.config['CATALOGUE_CACHE_MAX_AGE'] = 30
+# Catalogue pages showing stock levels are also validated against this file, which changes on every sale
+app.config['STOCK_VERSION_FILE'] = os.path.join(app.instance_path, 'stock.version')
+# Pages for a logged-in customer are also validated against the file named after their id in this directory, and
+# their cart count is read again when it changes, which happens whenever their cart changes
+app.config['CART_VERSION_DIR'] = os.path.join(app.instance_path, 'cart-versions')
+# The search index is rebuilt when this file changes, which happens when products are added, renamed or deleted
+app.config['PRODUCT_NAMES_VERSION_FILE'] = os.path.join(app.instance_path, 'product-names.version')
+# The fraction of a search's trigrams a product name must contain to match, lower allows more typing mistakes
+app.config['SEARCH_MIN_SCORE'] = 0.6
+# The most products each worker process keeps in memory, the least recently used are removed first
+app.config['PRODUCT_CACHE_SIZE'] = 10000
+# Compiled templates are cached in this directory, fill it with flask compile-templates when deploying, and changed
+# templates are only reloaded in debug mode while TEMPLATES_AUTO_RELOAD is None
+app.config['TEMPLATE_CACHE_DIR'] = os.getenv('TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'template-cache'))
+app.config['TEMPLATES_AUTO_RELOAD'] = None
+# Warm up each worker process as the app is imported, opening this many database connections
+app.config['WARM_UP_ON_STARTUP'] = os.getenv('WARM_UP_ON_STARTUP', '0') == '1'
+app.config['WARM_UP_CONNECTIONS'] = 5
+# Rows fetched per round trip and template events per chunk when streaming large admin pages
+app.config['STREAM_BATCH_SIZE'] = 500
+app.config['STREAM_BUFFER_SIZE'] = 64
+app.config['EXPORT_CHUNK_SIZE'] = 1000
+app.config['IMPORT_BATCH_SIZE'] = 500
+# How long stock is held for a cart, and how often and how many expired holds are released
+app.config['STOCK_HOLD_SECONDS'] = 15 * 60
+app.config['STOCK_HOLD_SWEEP_INTERVAL'] = 60
+app.config['STOCK_HOLD_REAP_BATCH_SIZE'] = 500
+# Background jobs are retried with a growing delay and dead-lettered after the last attempt
+app.config['JOB_MAX_ATTEMPTS'] = 5
+app.config['JOB_RETRY_DELAY'] = 30
+app.config['JOB_LEASE_SECONDS'] = 300
+app.config['JOB_POLL_INTERVAL'] = 1
+# The weak password audit's wordlist, processes checking passwords (defaults to one per CPU), accounts checked
+# between progress updates and the largest piece of the wordlist each process keeps in memory, a larger wordlist is
+# checked a piece at a time
+app.config['PASSWORD_AUDIT_WORDLIST'] = os.path.join(os.path.dirname(__file__), 'common_passwords.txt')
+app.config['PASSWORD_AUDIT_PROCESSES'] = None
+app.config['PASSWORD_AUDIT_BATCH_SIZE'] = 200
+app.config['PASSWORD_AUDIT_CACHE_BYTES'] = 1024 * 1024
+# New passwords are rejected if they are in this filter of breached passwords, built by flask build-breached-filter
+app.config['BREACHED_PASSWORDS_FILTER'] = os.path.join(app.instance_path, 'breached-passwords.bloom')
 db = SQLAlchemy(app)
 bcrypt = Bcrypt(app)
 # Load environment variables from the .env file
 load_dotenv()
+# Token bucket limits for the endpoints that hash passwords, as (scope, requests, seconds, methods) where the
+# scope is ip or account, set RATE_LIMIT_STORAGE to a SQLite file to share the limits between worker processes
+app.config['RATE_LIMIT_ENABLED'] = True
+app.config['RATE_LIMIT_STORAGE'] = os.getenv('RATE_LIMIT_STORAGE')
+app.config['RATE_LIMIT_MAX_KEYS'] = 100000
+# How often in seconds each worker removes the buckets that have refilled from the SQLite file
+app.config['RATE_LIMIT_PRUNE_INTERVAL'] = 60
+# The number of reverse proxies in front of the app, whose X-Forwarded-For headers give the client's address the
+# limits per IP address count against, leave at 0 when clients connect to the app directly as the headers could
+# be forged
+app.config['TRUSTED_PROXIES'] = int(os.getenv('TRUSTED_PROXIES', '0'))
+app.config['RATE_LIMITS'] = {
+    'login_page': [('ip', 20, 60, ('POST',)), ('account', 5, 60, ('POST',))],
+    'register_page': [('ip', 10, 60, ('POST',))],
+    'change_password_page': [('ip', 10, 60, ('POST',))],
+    'dictionary_attack': [('ip', 3, 60, ('GET', 'POST'))],
+    'api.create_token_endpoint': [('ip', 20, 60, ('POST',)), ('account', 5, 60, ('POST',))],
+}
+# JSON API tokens are valid for this many seconds, and lists are returned this many rows at a time by default
+app.config['API_TOKEN_MAX_AGE'] = 24 * 60 * 60
+app.config['API_PAGE_SIZE'] = 50
+app.config['API_MAX_PAGE_SIZE'] = 200
+# Log records are written as JSON lines by a background thread, to LOG_FILE or standard error, and dropped if
+# more than LOG_QUEUE_SIZE are waiting, a fraction of the records from each logger in LOG_SAMPLE_RATES is kept
+app.config['LOG_LEVEL'] = os.getenv('LOG_LEVEL', 'INFO')
+app.config['LOG_FILE'] = os.getenv('LOG_FILE')
+app.config['LOG_QUEUE_SIZE'] = 10000
+app.config['LOG_SLOW_REQUEST_MS'] = 500
+app.config['LOG_SAMPLE_RATES'] = {'main.access': 0.1}
+# The bcrypt cost of new password hashes, measure one for this hardware with flask calibrate-bcrypt
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.getenv('BCRYPT_LOG_ROUNDS', '12'))
 
 
 @app.errorhandler(404)
@@ -28,7 +103,7 @@ def page_not_found(error):
     :param error: The error code
     :return: 404 page
     """
-    print(error)
+    app.logger.info('Page not found: %s', error)
     # Displays the 404 error page to prevent information leakage
     return render_template('404.html')
 
@@ -37,5 +112,7 @@ def page_not_found(error):
 login_manager = LoginManager(app)
 login_manager.login_view = 'login_page'
 login_manager.login_message_category = 'info'
-# Import routes
-from main import routes
+# Import the logging first so every request has an id, then the rate limits so they are checked before anything
+# else runs, then the JSON encoder and the template cache, the routes, the JSON API and the commands, and warm up
+# the worker last once everything it uses is set up
+from main import logs, rate_limit, json_provider, templating, routes, api, commands, warmup
@@ -0,0 +1,426 @@
+"""
+Versioned JSON API for the catalogue, cart and orders, used by the mobile app and integrations
+
+Requests are authenticated with a signed bearer token from POST /api/v1/tokens. The token carries the customer's
+id and token generation, which is checked with one primary key lookup, so changing the password or deleting the
+account revokes every token issued before. Responses are built from the columns each endpoint
+selects rather than from loaded models, so no row triggers another query, and the rows are encoded as they are
+by the app's JSON provider.
+"""
+# Import statements
+import functools
+
+from flask import Blueprint, g, jsonify, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import select
+
+from main import app, db
+from main.checkout import checkout
+from main.models import Cart, Customer, Order, Product
+from main.money import cart_total
+from main.product_cache import product_cache
+from main.reservations import OutOfStockError, release, reserve
+from main.stock_shards import stock_on_hand
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# The product fields a client can ask for with the fields parameter
+PRODUCT_FIELDS = {
+    'id': Product.id,
+    'name': Product.name,
+    'price_pence': Product.price_pence,
+    'description': Product.description,
+    'quantity': stock_on_hand,
+    'image': Product.product_image,
+    'date_added': Product.date_added,
+}
+# The fields of each order in the order history
+ORDER_FIELDS = {
+    'id': Order.id,
+    'product_id': Order.product_id,
+    'product_name': Product.name,
+    'quantity': Order.quantity,
+    'price_pence': Order.price_pence,
+    'status': Order.status,
+}
+
+
+def error(message, status):
+    """
+    Function for building an error response
+    :param message: The description of the error
+    :param status: The HTTP status code
+    :return: The JSON response and status code
+    """
+    return jsonify({'error': message}), status
+
+
+def token_serializer():
+    """
+    Function for getting the serializer that signs and checks tokens with the app's secret key
+    :return: The serializer
+    """
+    return URLSafeTimedSerializer(app.secret_key, salt='api-token')
+
+
+def create_token(customer):
+    """
+    Function for creating a token for a customer
+    :param customer: The customer
+    :return: The signed token
+    """
+    return token_serializer().dumps({'id': customer.id, 'generation': customer.token_generation})
+
+
+def read_token(token):
+    """
+    Function for checking a token's signature, age and generation
+    :param token: The token
+    :return: The customer, or None if the token is invalid, has expired or has been revoked
+    """
+    try:
+        payload = token_serializer().loads(token, max_age=app.config['API_TOKEN_MAX_AGE'])
+        customer_id, generation = payload['id'], payload['generation']
+    except (BadSignature, KeyError, TypeError):
+        return None
+    # The row is always read so a changed generation is seen, and a deleted customer's tokens are rejected too
+    customer = db.session.get(Customer, customer_id, populate_existing=True)
+    return customer if customer is not None and customer.token_generation == generation else None
+
+
+def token_required(view):
+    """
+    Decorator for endpoints that need a bearer token, the customer's id is put in g.customer_id and the customer is
+    used as the current user
+    :param view: The endpoint
+    :return: The wrapped endpoint
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        customer = read_token(token) if scheme.lower() == 'bearer' else None
+        if customer is None:
+            response, status = error('A valid bearer token is required', 401)
+            response.headers['WWW-Authenticate'] = 'Bearer'
+            return response, status
+        g.customer_id = customer.id
+        # Flask-Login keeps the request's user in g, so current_user reuses the row the token was checked against
+        g._login_user = customer  # pylint: disable=protected-access
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def page_arguments():
+    """
+    Function for reading the pagination parameters, pages are read after an id so each page is an index lookup
+    :return: The id to read after and the number of rows to read
+    """
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', app.config['API_PAGE_SIZE'], type=int)
+    return after, min(max(limit, 1), app.config['API_MAX_PAGE_SIZE'])
+
+
+def page(rows, limit, key):
+    """
+    Function for building a page of results
+    :param rows: The rows read, one more than the page size if there is another page
+    :param limit: The page size
+    :param key: The name the results are listed under
+    :return: A dictionary of the results and the id to read the next page after, None on the last page
+    """
+    return {key: rows[:limit], 'next_after': rows[limit - 1].id if len(rows) > limit else None}
+
+
+@api.route('/tokens', methods=['POST'])
+def create_token_endpoint():
+    """
+    Create token Api
+
+    Description:
+        This exchanges an email and password for a bearer token used to call the other endpoints
+
+    Response:
+        If successful, returns 201 status code with the token and the number of seconds it is valid for
+
+        If the email or password is incorrect, returns 401 status code
+
+    Example request:
+        POST http://127.0.0.1:5000/api/v1/tokens
+
+    Request Body:
+        {"email": "admin@admin.com", "password": "123456"}
+    """
+    data = request.get_json(silent=True) or {}
+    customer = Customer.query.filter_by(email=data.get('email')).first()
+    if not customer or not isinstance(data.get('password'), str) or not customer.verify_password(data['password']):
+        return error('Incorrect email or password', 401)
+    # Save the password if it was hashed again with the current cost
+    db.session.commit()
+    return jsonify({'token': create_token(customer), 'expires_in': app.config['API_TOKEN_MAX_AGE']}), 201
+
+
+@api.route('/products')
+def list_products():
+    """
+    List products Api
+
+    Description:
+        This lists the products in id order a page at a time
+
+    Parameters:
+        after: The id of the last product on the previous page, defaults to 0
+
+        limit: The number of products on a page, defaults to API_PAGE_SIZE
+
+        fields: Comma separated fields to include, from id, name, price_pence, description, quantity, image and
+        date_added, defaults to all of them
+
+    Response:
+        If successful, returns 200 status code with the products and the after value of the next page
+
+    Example request:
+        GET http://127.0.0.1:5000/api/v1/products?limit=20&fields=id,name,price_pence
+    """
+    fields = request.args.get('fields')
+    names = [name.strip() for name in fields.split(',') if name.strip()] if fields else list(PRODUCT_FIELDS)
+    unknown = [name for name in names if name not in PRODUCT_FIELDS]
+    if unknown:
+        return error(f'Unknown fields: {", ".join(unknown)}', 400)
+    after, limit = page_arguments()
+    # The id is needed to find the next page, so it is read after the fields even if it wasn't asked for
+    columns = [PRODUCT_FIELDS[name].label(name) for name in names]
+    rows = db.session.execute(
+        select(*columns, Product.id).where(Product.id > after).order_by(Product.id).limit(limit + 1)
+    ).all()
+    return jsonify({
+        'products': [dict(zip(names, row)) for row in rows[:limit]],
+        'next_after': rows[limit - 1][-1] if len(rows) > limit else None,
+    })
+
+
+@api.route('/products/<int:product_id>')
+def get_product(product_id):
+    """
+    Get product Api
+
+    Description:
+        This returns a product
+
+    Response:
+        If successful, returns 200 status code
+
+        If the product doesn't exist, returns 404 status code
+
+    Example request:
+        GET http://127.0.0.1:5000/api/v1/products/1
+    """
+    row = db.session.execute(
+        select(*(column.label(name) for name, column in PRODUCT_FIELDS.items())).where(Product.id == product_id)
+    ).first()
+    if row is None:
+        return error('Product not found', 404)
+    return jsonify(row)
+
+
+def cart_contents(customer_id):
+    """
+    Function for reading a customer's cart with the name and price of each product in one query
+    :param customer_id: The id of the customer
+    :return: A dictionary of the items in the cart and the total in pence
+    """
+    rows = db.session.execute(
+        select(Cart.product_id, Product.name, Product.price_pence, Cart.quantity)
+        .join(Product, Product.id == Cart.product_id)
+        .where(Cart.customer_id == customer_id)
+        .order_by(Cart.id)
+    ).all()
+    return {
+        'items': rows,
+        'total_pence': sum(row.price_pence * row.quantity for row in rows),
+    }
+
+
+@api.route('/cart')
+@token_required
+def get_cart():
+    """
+    Get cart Api
+
+    Description:
+        This returns the items in the cart and the total
+
+    Response:
+        If successful, returns 200 status code
+
+    Example request:
+        GET http://127.0.0.1:5000/api/v1/cart
+    """
+    return jsonify(cart_contents(g.customer_id))
+
+
+@api.route('/cart/<int:product_id>', methods=['PUT'])
+@token_required
+def set_cart_quantity(product_id):
+    """
+    Set cart quantity Api
+
+    Description:
+        This sets the quantity of a product in the cart, adding it if it isn't already there
+
+    Response:
+        If successful, returns 200 status code with the cart
+
+        If there isn't enough stock, returns 409 status code
+
+    Example request:
+        PUT http://127.0.0.1:5000/api/v1/cart/1
+
+    Request Body:
+        {"quantity": 2}
+
+    How it works:
+        The extra items are held for the customer, and items taken out of the cart are released,
+        so a quantity of 0 removes the product from the cart
+    """
+    quantity = (request.get_json(silent=True) or {}).get('quantity')
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 0:
+        return error('quantity must be a whole number of 0 or more', 400)
+    if product_cache.get(product_id) is None:
+        return error('Product not found', 404)
+    cart_item = Cart.query.filter_by(customer_id=g.customer_id, product_id=product_id).first()
+    change = quantity - (cart_item.quantity if cart_item else 0)
+    try:
+        if change > 0:
+            # Hold the extra items for the customer
+            reserve(g.customer_id, product_id, change)
+        elif change < 0:
+            release(g.customer_id, product_id, -change)
+    except OutOfStockError:
+        db.session.rollback()
+        return error('Not enough stock', 409)
+    if quantity == 0 and cart_item:
+        db.session.delete(cart_item)
+    elif cart_item:
+        cart_item.quantity = quantity
+    elif quantity:
+        db.session.add(Cart(customer_id=g.customer_id, product_id=product_id, quantity=quantity))
+    db.session.commit()
+    return jsonify(cart_contents(g.customer_id))
+
+
+@api.route('/cart/<int:product_id>', methods=['DELETE'])
+@token_required
+def remove_cart_item(product_id):
+    """
+    Remove cart item Api
+
+    Description:
+        This removes a product from the cart and releases the items held for it
+
+    Response:
+        If successful, returns 200 status code with the cart
+
+    Example request:
+        DELETE http://127.0.0.1:5000/api/v1/cart/1
+    """
+    release(g.customer_id, product_id)
+    Cart.query.filter_by(customer_id=g.customer_id, product_id=product_id).delete()
+    db.session.commit()
+    return jsonify(cart_contents(g.customer_id))
+
+
+@api.route('/orders', methods=['POST'])
+@token_required
+def create_order():
+    """
+    Checkout Api
+
+    Description:
+        This places an order for everything in the cart
+
+    Response:
+        If successful, returns 201 status code with the new orders and the total
+
+        If the cart is empty, returns 400 status code
+
+        If there isn't enough stock, returns 409 status code
+
+    Example request:
+        POST http://127.0.0.1:5000/api/v1/orders
+    """
+    # The total is read before the cart is turned into orders
+    total = cart_total(g.customer_id)
+    try:
+        new_orders = checkout(g.customer_id)
+    except OutOfStockError:
+        db.session.rollback()
+        return error('Not enough stock', 409)
+    if not new_orders:
+        return error('Your cart is empty', 400)
+    # The orders are read before the commit expires them, so they aren't loaded again one at a time
+    orders = [{'id': order.id, 'product_id': order.product_id, 'quantity': order.quantity,
+               'price_pence': order.price_pence, 'status': order.status} for order in new_orders]
+    # Place the whole order in one transaction
+    db.session.commit()
+    return jsonify({'orders': orders, 'total_pence': total}), 201
+
+
+@api.route('/orders')
+@token_required
+def list_orders():
+    """
+    Order history Api
+
+    Description:
+        This lists the customer's orders in id order a page at a time
+
+    Parameters:
+        after: The id of the last order on the previous page, defaults to 0
+
+        limit: The number of orders on a page, defaults to API_PAGE_SIZE
+
+    Response:
+        If successful, returns 200 status code with the orders and the after value of the next page
+
+    Example request:
+        GET http://127.0.0.1:5000/api/v1/orders?limit=20
+    """
+    after, limit = page_arguments()
+    rows = db.session.execute(
+        select(*(column.label(name) for name, column in ORDER_FIELDS.items()))
+        .join(Product, Product.id == Order.product_id)
+        .where(Order.customer_id == g.customer_id, Order.id > after)
+        .order_by(Order.id)
+        .limit(limit + 1)
+    ).all()
+    return jsonify(page(rows, limit, 'orders'))
+
+
+@api.route('/orders/<int:order_id>')
+@token_required
+def get_order(order_id):
+    """
+    Get order Api
+
+    Description:
+        This returns one of the customer's orders
+
+    Response:
+        If successful, returns 200 status code
+
+        If the order doesn't exist or belongs to another customer, returns 404 status code
+
+    Example request:
+        GET http://127.0.0.1:5000/api/v1/orders/1
+    """
+    row = db.session.execute(
+        select(*(column.label(name) for name, column in ORDER_FIELDS.items()))
+        .join(Product, Product.id == Order.product_id)
+        .where(Order.id == order_id, Order.customer_id == g.customer_id)
+    ).first()
+    if row is None:
+        return error('Order not found', 404)
+    return jsonify(row)
+
+
+app.register_blueprint(api)
@@ -0,0 +1,175 @@
+"""
+Breached password screening with a Bloom filter built from a list of passwords leaked in data breaches
+
+The filter is built offline by flask build-breached-filter and is only read by the website. It is memory-mapped
+read-only, so every worker process on the host shares the same pages of the file instead of loading a copy, and a
+check reads one bit per hash function. A password in the list is always found, and a password that isn't is wrongly
+reported as breached at the false positive rate the filter was built for.
+
+Passwords are keyed by their SHA-1 hash, so a plain text list and a list of SHA-1 hashes, such as the Pwned
+Passwords download, give the same filter.
+"""
+# Import statements
+import hashlib
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+
+from main import app
+
+# The file starts with a magic number, then the number of bits and hash functions
+MAGIC = b'BLOOMv1\0'
+HEADER = struct.Struct('<8sQQ')
+# A line of a hashed list, the SHA-1 hash in hex optionally followed by the number of times it was seen
+SHA1_LINE = re.compile(r'([0-9A-Fa-f]{40})(?::\d+)?')
+
+
+class BloomFilter:
+    """Class for checking passwords against a memory-mapped Bloom filter file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.bits, self.hashes = HEADER.unpack_from(self.map)
+        if magic != MAGIC or len(self.map) < HEADER.size + math.ceil(self.bits / 8):
+            self.map.close()
+            raise ValueError(f'{path} is not a breached password filter')
+        self.path = path
+        self.modified = os.stat(path).st_mtime_ns
+
+    def __contains__(self, password):
+        """
+        Function for checking if a password may be in the filter
+        :param password: The plain text password
+        :return: Boolean indicating if the password may be breached, False means it definitely isn't
+        """
+        return all(self.map[HEADER.size + bit // 8] >> (bit % 8) & 1
+                   for bit in bit_positions(sha1(password), self.bits, self.hashes))
+
+    def close(self):
+        """
+        Function for unmapping the file
+        :return:
+        """
+        self.map.close()
+
+
+def sha1(password):
+    """
+    Function for getting the key a password is stored under in the filter
+    :param password: The plain text password
+    :return: The SHA-1 digest of the password
+    """
+    return hashlib.sha1(password.encode('utf-8')).digest()
+
+
+def bit_positions(digest, bits, hashes):
+    """
+    Function for finding the bits a password sets, using two halves of its digest to make each hash function
+    :param digest: The SHA-1 digest of the password
+    :param bits: The number of bits in the filter
+    :param hashes: The number of hash functions
+    :return: A generator of the bit positions
+    """
+    first, second = struct.unpack_from('<QQ', digest)
+    # An odd step never repeats a position before every bit has been visited
+    second |= 1
+    return ((first + i * second) % bits for i in range(hashes))
+
+
+def filter_size(items, false_positive_rate):
+    """
+    Function for working out the bits and hash functions a filter needs
+    :param items: The number of passwords in the filter
+    :param false_positive_rate: The chance a password that isn't in the filter is reported as breached
+    :return: The number of bits and the number of hash functions
+    """
+    items = max(items, 1)
+    bits = max(math.ceil(-items * math.log(false_positive_rate) / math.log(2) ** 2), 64)
+    hashes = max(round(bits / items * math.log(2)), 1)
+    return bits, hashes
+
+
+def line_digest(line, hashed):
+    """
+    Function for reading the digest of a password from a line of a list
+    :param line: The line, without the line ending
+    :param hashed: Boolean indicating if the list holds SHA-1 hashes instead of plain text passwords
+    :return: The SHA-1 digest, or None if the line is empty or not a hash
+    """
+    if not hashed:
+        return sha1(line) if line else None
+    match = SHA1_LINE.fullmatch(line.strip())
+    return bytes.fromhex(match.group(1)) if match else None
+
+
+def build_filter(path, lines, items, false_positive_rate, hashed=False):
+    """
+    Function for writing a filter, building it in a new file that replaces the old one when it is complete
+    Workers using the old filter keep reading it until they notice it has been replaced
+    :param path: The path of the filter file
+    :param lines: An iterable of the lines of the list, without line endings
+    :param items: The number of passwords in the list
+    :param false_positive_rate: The chance a password that isn't in the filter is reported as breached
+    :param hashed: Boolean indicating if the list holds SHA-1 hashes instead of plain text passwords
+    :return: The number of passwords added
+    """
+    bits, hashes = filter_size(items, false_positive_rate)
+    size = HEADER.size + math.ceil(bits / 8)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary_path = f'{path}.tmp'
+    added = 0
+    try:
+        with open(temporary_path, 'w+b') as f:
+            f.truncate(size)
+            # The bits are set in the mapped file, so a filter larger than memory can still be built
+            with mmap.mmap(f.fileno(), size) as bit_map:
+                HEADER.pack_into(bit_map, 0, MAGIC, bits, hashes)
+                for line in lines:
+                    digest = line_digest(line, hashed)
+                    if digest is None:
+                        continue
+                    for bit in bit_positions(digest, bits, hashes):
+                        bit_map[HEADER.size + bit // 8] |= 1 << (bit % 8)
+                    added += 1
+                bit_map.flush()
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return added
+
+
+filter_lock = threading.Lock()
+filters = {}
+
+
+def get_filter():
+    """
+    Function for getting the filter configured by BREACHED_PASSWORDS_FILTER, reopening it if it has been rebuilt
+    :return: The filter, or None if it hasn't been built
+    """
+    path = app.config['BREACHED_PASSWORDS_FILTER']
+    try:
+        modified = os.stat(path).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+    with filter_lock:
+        bloom_filter = filters.get(path)
+        if bloom_filter is None or bloom_filter.modified != modified:
+            # The old map is left for the garbage collector in case another thread is still reading it
+            bloom_filter = filters[path] = BloomFilter(path)
+        return bloom_filter
+
+
+def is_breached(password):
+    """
+    Function for checking if a password has appeared in a data breach
+    :param password: The plain text password
+    :return: Boolean indicating if the password is in the breached password filter, False if there is no filter
+    """
+    bloom_filter = get_filter()
+    return bloom_filter is not None and password in bloom_filter
@@ -0,0 +1,70 @@
+"""
+Set based bulk updates of products and orders
+"""
+# Import statements
+from sqlalchemy import Integer, cast, func
+
+from main import db
+from main.models import Order, Product
+from main.money import to_pence
+from main.sales import record_bulk_status_change
+from main.stock_shards import respread_changed_shards, sync_sharded_totals
+
+
+def bulk_update_products(product_ids=None, name_contains=None, price_change='none', price_value=None,
+                         quantity_change='none', quantity_value=None):
+    """
+    Function for changing the price and stock of the matching products in a single update
+    :param product_ids: Only update the products with these ids
+    :param name_contains: Only update the products with names containing this text
+    :param price_change: none, set to set the price or percent to change it by a percentage
+    :param price_value: The new price or the percentage, a reduced price is never less than 1 pence
+    :param quantity_change: none, set to set the stock or adjust to add to it
+    :param quantity_value: The new stock or the amount to add, stock is never reduced below 0
+    :return: The number of products updated
+    """
+    values = {}
+    if price_change == 'set':
+        values[Product.price_pence] = to_pence(price_value)
+    elif price_change == 'percent':
+        # Round to the nearest penny so prices stay whole pence, and never reduce a price below a penny
+        new_price = cast(func.round(Product.price_pence * (100 + float(price_value)) / 100), Integer)
+        values[Product.price_pence] = func.max(new_price, 1)
+    if quantity_change == 'set':
+        values[Product.quantity] = max(quantity_value, 0)
+    elif quantity_change == 'adjust':
+        values[Product.quantity] = func.max(Product.quantity + quantity_value, 0)
+    query = Product.query
+    if product_ids:
+        query = query.filter(Product.id.in_(product_ids))
+    if name_contains:
+        query = query.filter(Product.name.ilike(f'%{name_contains}%'))
+    if quantity_change != 'none':
+        # Adjust sharded products from their current total
+        sync_sharded_totals()
+    # One statement in one transaction no matter how many products match
+    updated = query.update(values, synchronize_session=False)
+    if quantity_change != 'none':
+        respread_changed_shards()
+    db.session.commit()
+    return updated
+
+
+def bulk_update_order_status(new_status, current_status=None, order_ids=None):
+    """
+    Function for changing the status of the matching orders in a single update
+    :param new_status: The status to change the orders to
+    :param current_status: Only update the orders with this status
+    :param order_ids: Only update the orders with these ids
+    :return: The number of orders updated
+    """
+    query = Order.query.filter(Order.status != new_status)
+    if current_status:
+        query = query.filter(Order.status == current_status)
+    if order_ids:
+        query = query.filter(Order.id.in_(order_ids))
+    # Move the matching orders to their new status on the dashboard
+    record_bulk_status_change(query, new_status)
+    updated = query.update({Order.status: new_status}, synchronize_session=False)
+    db.session.commit()
+    return updated
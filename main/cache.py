@@ -0,0 +1,334 @@
+"""
+HTTP caching helpers for the catalogue pages
+"""
+# Import statements
+import functools
+import os
+import secrets
+import tempfile
+from itertools import chain
+
+from flask import make_response, request, session
+from flask_login import current_user
+from sqlalchemy import event, func, inspect, select
+
+from main import app, db
+from main.models import Cart, Product
+
+
+def catalogue_version_file():
+    """
+    Function for getting the path of the file used to track the catalogue version
+    :return: The path of the catalogue version file
+    """
+    return app.config['CATALOGUE_VERSION_FILE']
+
+
+def file_version(path):
+    """
+    Function for reading the version tracked by a file without querying the database
+    :param path: The path of the version file
+    :return: The version as a hex string
+    """
+    # The version file is shared by every worker process, a file from before versions were written is empty
+    try:
+        with open(path, encoding='utf-8') as version_file:
+            version = version_file.read().strip()
+    except FileNotFoundError:
+        version = None
+    return version or bump_file_version(path)
+
+
+def bump_file_version(path):
+    """
+    Function for changing the version tracked by a file
+    :param path: The path of the version file
+    :return: The new version as a hex string
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # A random version can't repeat like a modification time within the file system's granularity, and replacing
+    # the file means readers see the old version or the new one, never a partly written one
+    version = secrets.token_hex(8)
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix='.version-')
+    try:
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as version_file:
+            version_file.write(version)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+    return version
+
+
+def catalogue_version():
+    """
+    Function for reading the current catalogue version without querying the database
+    :return: The catalogue version as a hex string
+    """
+    return file_version(catalogue_version_file())
+
+
+def bump_catalogue_version():
+    """
+    Function for marking the catalogue as changed so cached pages are revalidated
+    :return: The new catalogue version as a hex string
+    """
+    return bump_file_version(catalogue_version_file())
+
+
+def product_names_version():
+    """
+    Function for reading the version of the product names, which only changes when products are added, renamed or
+    deleted, not when their stock or price changes
+    :return: The product names version as a hex string
+    """
+    return file_version(app.config['PRODUCT_NAMES_VERSION_FILE'])
+
+
+def stock_version():
+    """
+    Function for reading the version of the stock levels, which changes when only the stock of products changes
+    :return: The stock version as a hex string
+    """
+    return file_version(app.config['STOCK_VERSION_FILE'])
+
+
+def cart_version_file(customer_id):
+    """
+    Function for getting the path of the file used to track the version of a customer's cart
+    :param customer_id: The id of the customer
+    :return: The path of the cart version file
+    """
+    return os.path.join(app.config['CART_VERSION_DIR'], str(int(customer_id)))
+
+
+def cart_version(customer_id):
+    """
+    Function for reading the version of a customer's cart without querying the database
+    It changes whenever the customer's cart rows are committed, from the pages or the JSON API
+    :param customer_id: The id of the customer
+    :return: The cart version as a hex string
+    """
+    return file_version(cart_version_file(customer_id))
+
+
+def cart_count():
+    """
+    Function for getting the number of lines in the current user's cart without loading the cart
+    :return: The number of lines in the cart
+    """
+    if not current_user.is_authenticated:
+        return 0
+    cached = session.get('cart_count')
+    versions = [catalogue_version(), cart_version(current_user.id)]
+    # Count again for a different user, when their cart has changed, or when products have changed as deleting one
+    # removes it from carts
+    if not cached or cached[0] != current_user.id or cached[1] != versions:
+        count = db.session.scalar(select(func.count()).select_from(Cart).where(Cart.customer_id == current_user.id))
+        cached = session['cart_count'] = [current_user.id, versions, count]
+    return cached[2]
+
+
+@app.context_processor
+def inject_cart_count():
+    """
+    Function for making the cart count available to every template for the navigation bar
+    :return: A dictionary of the template variables
+    """
+    return {'cart_count': cart_count()}
+
+
+def catalogue_etag():
+    """
+    Function for building the weak ETag of a catalogue page for the current user
+    :return: The ETag value, or None if the page can't be validated without loading the user
+    """
+    user_id = session.get('_user_id')
+    # A remembered user without a session is only known after querying the database
+    if user_id is None and request.cookies.get(app.config.get('REMEMBER_COOKIE_NAME', 'remember_token')):
+        return None
+    # The pages show how many of each product are left, so a sale changes them without changing the catalogue
+    cart = cart_version(user_id) if user_id else 0
+    return f'{catalogue_version()}-{stock_version()}-{user_id or "anonymous"}-{cart}'
+
+
+def set_catalogue_cache_headers(response, etag):
+    """
+    Function for adding the validator and cache headers to a catalogue page response
+    :param response: The response being sent
+    :param etag: The ETag of the page
+    :return: The response
+    """
+    response.set_etag(etag, weak=True)
+    response.vary.add('Cookie')
+    if session.get('_user_id') is None:
+        # Anonymous pages can be stored by a shared cache such as a reverse proxy
+        response.cache_control.public = True
+        response.cache_control.max_age = 0
+        response.cache_control.s_maxage = app.config['CATALOGUE_CACHE_MAX_AGE']
+    else:
+        # Pages for a logged-in user must always be revalidated by their own browser
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+def cached_catalogue_page(view):
+    """
+    Decorator for answering conditional requests to catalogue pages before the view runs
+    :param view: The view function
+    :return: The wrapped view function
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # Only safe requests without pending flash messages can be served from a cache
+        if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+            return view(*args, **kwargs)
+        etag = catalogue_etag()
+        if etag is None:
+            return view(*args, **kwargs)
+        if request.if_none_match.contains_weak(etag):
+            # Nothing has changed so no query or render is needed
+            return set_catalogue_cache_headers(app.response_class(status=304), etag)
+        return set_catalogue_cache_headers(make_response(view(*args, **kwargs)), etag)
+    return wrapper
+
+
+@event.listens_for(db.session, 'after_flush')
+def track_product_changes(session_, flush_context):
+    """
+    Function for recording that a flush has changed a product
+    :param session_: The database session
+    :param flush_context: The flush context
+    :return:
+    """
+    if any(isinstance(obj, Product) for obj in chain(session_.new, session_.deleted)):
+        session_.info['catalogue_changed'] = True
+    for obj in session_.dirty:
+        if isinstance(obj, Product):
+            changed = {attr.key for attr in inspect(obj).attrs if attr.history.has_changes()}
+            # The stock is never cached, so changing only the stock leaves the cached products as they were
+            if changed == {'quantity'}:
+                session_.info['stock_changed'] = True
+            elif changed:
+                session_.info['catalogue_changed'] = True
+    if (any(isinstance(obj, Product) for obj in chain(session_.new, session_.deleted))
+            or any(isinstance(obj, Product) and inspect(obj).attrs.name.history.has_changes()
+                   for obj in session_.dirty)):
+        session_.info['product_names_changed'] = True
+
+
+def updated_columns(statement):
+    """
+    Function for getting the names of the columns a bulk update statement sets
+    :param statement: The update statement
+    :return: The set of column names, or None if the columns are only known from the parameters
+    """
+    values = statement._values or dict(statement._ordered_values or ())
+    # Values passed with the parameters instead of the statement could set any column
+    if not values:
+        return None
+    return {getattr(column, 'key', column) for column in values}
+
+
+def updates_name(statement):
+    """
+    Function for checking if a bulk update statement may change product names
+    :param statement: The update statement
+    :return: Boolean indicating if the name is one of the columns set
+    """
+    columns = updated_columns(statement)
+    return columns is None or 'name' in columns
+
+
+def updates_only_stock(statement):
+    """
+    Function for checking if a bulk update statement only changes the stock of products, such as a sale
+    :param statement: The update statement
+    :return: Boolean indicating if the quantity is the only column set
+    """
+    columns = updated_columns(statement)
+    return columns is not None and columns <= {'quantity'}
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def track_bulk_product_changes(orm_execute_state):
+    """
+    Function for recording that a bulk insert, update or delete has changed products
+    :param orm_execute_state: The state of the statement being executed
+    :return:
+    """
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        if any(mapper.class_ is Product for mapper in orm_execute_state.all_mappers):
+            # Sales only change the stock, which is read from the database every time and never cached
+            if orm_execute_state.is_update and updates_only_stock(orm_execute_state.statement):
+                orm_execute_state.session.info['stock_changed'] = True
+                return
+            orm_execute_state.session.info['catalogue_changed'] = True
+            # Stock and price updates leave the names, and so the search index, as they were
+            if not orm_execute_state.is_update or updates_name(orm_execute_state.statement):
+                orm_execute_state.session.info['product_names_changed'] = True
+
+
+@event.listens_for(db.session, 'after_flush')
+def track_cart_changes(session_, flush_context):
+    """
+    Function for recording the customers whose carts a flush has changed
+    :param session_: The database session
+    :param flush_context: The flush context
+    :return:
+    """
+    customer_ids = {obj.customer_id for obj in chain(session_.new, session_.dirty, session_.deleted)
+                    if isinstance(obj, Cart)}
+    if customer_ids:
+        session_.info.setdefault('carts_changed', set()).update(customer_ids)
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def track_bulk_cart_changes(orm_execute_state):
+    """
+    Function for recording the customers whose carts a bulk update or delete is about to change
+    :param orm_execute_state: The state of the statement being executed
+    :return:
+    """
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        if any(mapper.class_ is Cart for mapper in orm_execute_state.all_mappers):
+            # The statement's conditions find the rows it changes before it runs
+            query = select(Cart.customer_id).distinct()
+            if orm_execute_state.statement.whereclause is not None:
+                query = query.where(orm_execute_state.statement.whereclause)
+            customer_ids = orm_execute_state.session.scalars(query).all()
+            orm_execute_state.session.info.setdefault('carts_changed', set()).update(customer_ids)
+
+
+@event.listens_for(db.session, 'after_commit')
+def publish_product_changes(session_):
+    """
+    Function for bumping the catalogue version once product changes are committed
+    :param session_: The database session
+    :return:
+    """
+    if session_.info.pop('catalogue_changed', False):
+        bump_catalogue_version()
+    if session_.info.pop('stock_changed', False):
+        bump_file_version(app.config['STOCK_VERSION_FILE'])
+    if session_.info.pop('product_names_changed', False):
+        bump_file_version(app.config['PRODUCT_NAMES_VERSION_FILE'])
+    # Cart rows left without a customer when an account is deleted have no version to change
+    for customer_id in session_.info.pop('carts_changed', set()) - {None}:
+        bump_file_version(cart_version_file(customer_id))
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_product_changes(session_, previous_transaction):
+    """
+    Function for forgetting product changes that were rolled back
+    :param session_: The database session
+    :param previous_transaction: The transaction that was rolled back
+    :return:
+    """
+    session_.info.pop('catalogue_changed', None)
+    session_.info.pop('stock_changed', None)
+    session_.info.pop('product_names_changed', None)
+    session_.info.pop('carts_changed', None)
@@ -0,0 +1,60 @@
+"""
+Checkout, turning a customer's cart into orders
+"""
+# Import statements
+import datetime
+
+from main import db
+from main.jobs import enqueue
+from main.models import Cart, Order
+from main.money import lines_total
+from main.payments import PAYMENT_PENDING
+from main.product_cache import product_cache
+from main.reservations import sell
+from main.sales import record_order
+
+
+def checkout(customer_id):
+    """
+    Function for placing an order for everything in a customer's cart, the caller commits the change
+    The stock is sold, the payment is queued and the sale is recorded in the same transaction as the orders
+    :param customer_id: The id of the customer
+    :raises: OutOfStockError: if there isn't enough stock of an item
+    :return: The new orders, one per item in the cart, or an empty list if the cart is empty
+    """
+    customer_cart = Cart.query.filter_by(customer_id=customer_id).all()
+    if not customer_cart:
+        return []
+    # The prices come from the product cache, the stock is checked in the database when it is sold
+    products = product_cache.get_many(item.product_id for item in customer_cart)
+    # Calculate the total
+    total = lines_total(customer_cart, products)
+    lines = [(item.product_id, item.quantity, products[item.product_id].price_pence * item.quantity)
+             for item in customer_cart]
+    placed_at = datetime.datetime.now(datetime.UTC)
+    new_orders = []
+    for item in customer_cart:
+        # Create order
+        new_order = Order()
+        new_order.quantity = item.quantity
+        new_order.price_pence = products[item.product_id].price_pence
+        new_order.status = 'Pending'
+        # The payment id is recorded once the payment has been taken
+        new_order.payment_id = PAYMENT_PENDING
+        new_order.product_id = item.product_id
+        new_order.customer_id = customer_id
+        new_order.placed_at = placed_at
+        # Update database
+        db.session.add(new_order)
+        new_orders.append(new_order)
+        # Update stock, turning the items held for the customer into a sale
+        sell(customer_id, item.product_id, item.quantity)
+        db.session.delete(item)
+    db.session.flush()
+    # Take the payment in the background, queued in the same transaction as the order
+    order_ids = [order.id for order in new_orders]
+    enqueue('take_payment', {'order_ids': order_ids, 'customer_id': customer_id, 'amount_pence': total},
+            idempotency_key=f'take-payment-{min(order_ids)}')
+    # Add the order to the sales dashboard
+    record_order(lines, 'Pending', day=placed_at.date())
+    return new_orders
@@ -0,0 +1,214 @@
+"""
+Command line commands for the application
+"""
+# Import statements
+import click
+
+from main import app, db
+from main.breached_passwords import build_filter
+from main.imports import ImageSource, import_products, iter_rows
+from main.jobs import requeue_dead_jobs, run_pending_jobs, start_workers
+from main.migrations import status, upgrade
+from main.password_audit import audit_passwords, start_audit
+from main.passwords import calibrate, target_rounds
+from main.reservations import sweep_expired_holds
+from main.sales import rebuild_aggregates
+from main.stock_shards import shard_stock
+from main.templating import compile_templates
+from main.warmup import warm_up
+
+
+@app.cli.command('import-products')
+@click.argument('products_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--images', type=click.Path(exists=True),
+              help='Directory or ZIP archive containing the product images')
+@click.option('--batch-size', type=int, default=None, help='Number of products saved per transaction')
+def import_products_command(products_file, images, batch_size):
+    """
+    Imports products from a CSV or JSON file, updating products that already exist by name
+    \f
+    :param products_file: The path of the CSV or JSON file
+    :param images: The directory or ZIP archive containing the product images
+    :param batch_size: The number of products saved per transaction
+    :return:
+    """
+    image_source = ImageSource(images)
+    try:
+        with open(products_file, 'r', encoding='utf-8', newline='') as stream:
+            report = import_products(iter_rows(stream, products_file), image_source, batch_size)
+    finally:
+        image_source.close()
+    for error in report.errors:
+        click.echo(str(error), err=True)
+    click.echo(str(report))
+
+
+@app.cli.command('reap-holds')
+def reap_holds_command():
+    """
+    Releases the stock held by every expired cart hold
+    \f
+    :return:
+    """
+    click.echo(f'{sweep_expired_holds()} expired holds released')
+
+
+@app.cli.command('shard-stock')
+@click.argument('product_id', type=int)
+@click.option('--shards', type=int, default=8, help='Number of shards, 1 or fewer merges the stock back')
+def shard_stock_command(product_id, shards):
+    """
+    Splits the stock of a hot product across shards so its checkouts don't all update one row
+    \f
+    :param product_id: The id of the product
+    :param shards: The number of shards
+    :return:
+    """
+    shard_stock(product_id, shards)
+    click.echo(f'Product {product_id} stock split across {max(shards, 1)} shards')
+
+
+@app.cli.command('run-workers')
+@click.option('--processes', type=int, default=1, help='Number of worker processes')
+@click.option('--once', is_flag=True, help='Run the jobs that are due and exit')
+def run_workers_command(processes, once):
+    """
+    Runs the background jobs, such as taking payments for orders
+    \f
+    :param processes: The number of worker processes
+    :param once: Whether to exit once no jobs are due
+    :return:
+    """
+    if once:
+        click.echo(f'{run_pending_jobs()} jobs run')
+        return
+    start_workers(processes)
+
+
+@app.cli.command('requeue-dead-jobs')
+def requeue_dead_jobs_command():
+    """
+    Puts the jobs that failed on every attempt back on the queue
+    \f
+    :return:
+    """
+    click.echo(f'{requeue_dead_jobs()} jobs requeued')
+
+
+@app.cli.command('rebuild-sales-aggregates')
+def rebuild_sales_aggregates_command():
+    """
+    Recalculates the sales dashboard figures from the orders and customers
+    \f
+    :return:
+    """
+    orders, customers = rebuild_aggregates()
+    click.echo(f'Sales figures rebuilt from {orders} orders and {customers} customers')
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """
+    Applies the pending schema migrations to the database
+    \f
+    :return:
+    """
+    applied = upgrade()
+    click.echo(f'Applied {", ".join(applied)}' if applied else 'The database is up to date')
+
+
+@app.cli.command('migration-status')
+def migration_status_command():
+    """
+    Lists the schema migrations and whether they have been applied
+    \f
+    :return:
+    """
+    for name, applied in status():
+        click.echo(f'[{"x" if applied else " "}] {name}')
+
+
+@app.cli.command('calibrate-bcrypt')
+@click.option('--target-ms', type=float, default=250, help='The most milliseconds a password hash should take')
+@click.option('--samples', type=int, default=3, help='Number of hashes timed at each cost')
+def calibrate_bcrypt_command(target_ms, samples):
+    """
+    Measures the bcrypt cost that fits the target time per hash on this machine
+    \f
+    :param target_ms: The most milliseconds a password hash should take
+    :param samples: The number of hashes timed at each cost
+    :return:
+    """
+    chosen, measurements = calibrate(target_ms, samples)
+    for rounds, elapsed in measurements:
+        click.echo(f'Cost {rounds}: {elapsed:.1f} ms')
+    click.echo(f'The current cost is {target_rounds()}, add this to .env to use the measured cost:')
+    click.echo(f'BCRYPT_LOG_ROUNDS={chosen}')
+
+
+@app.cli.command('audit-passwords')
+@click.option('--wordlist', type=click.Path(exists=True, dir_okay=False), help='The passwords to try, one per line')
+@click.option('--processes', type=int, help='Number of processes checking passwords')
+def audit_passwords_command(wordlist, processes):
+    """
+    Checks every account's password against a list of common passwords
+    \f
+    :param wordlist: The path of the wordlist, defaults to the common passwords file
+    :param processes: The number of processes checking passwords, defaults to one per CPU
+    :return:
+    """
+    audit = start_audit(wordlist)
+    db.session.commit()
+    weak = audit_passwords(audit.id, processes)
+    click.echo(f'{audit.accounts_checked} accounts checked, {weak} have a common password')
+
+
+@app.cli.command('build-breached-filter')
+@click.argument('wordlist', type=click.Path(exists=True, dir_okay=False))
+@click.option('--hashed', is_flag=True, help='The list holds SHA-1 hashes, such as the Pwned Passwords download')
+@click.option('--false-positive-rate', type=click.FloatRange(0, 1, min_open=True, max_open=True), default=0.001,
+              help='The chance a password that was never breached is rejected')
+def build_breached_filter_command(wordlist, hashed, false_positive_rate):
+    """
+    Builds the filter of breached passwords that new passwords are checked against
+    \f
+    :param wordlist: The path of the list of breached passwords, one per line
+    :param hashed: Whether the list holds SHA-1 hashes instead of plain text passwords
+    :param false_positive_rate: The chance a password that was never breached is rejected
+    :return:
+    """
+    def lines():
+        with open(wordlist, 'r', encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                yield line.rstrip('\r\n')
+
+    # Count the passwords first to size the filter, then read the list again to fill it
+    items = sum(1 for line in lines() if line)
+    path = app.config['BREACHED_PASSWORDS_FILTER']
+    added = build_filter(path, lines(), items, false_positive_rate, hashed)
+    click.echo(f'{added} breached passwords written to {path}')
+
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    """
+    Compiles every template into the template cache so new worker processes don't compile them
+    \f
+    :return:
+    """
+    directory = app.config['TEMPLATE_CACHE_DIR']
+    if not directory:
+        raise click.ClickException('TEMPLATE_CACHE_DIR is not set')
+    names = compile_templates()
+    click.echo(f'{len(names)} templates compiled into {directory}')
+
+
+@app.cli.command('warm-up')
+def warm_up_command():
+    """
+    Runs the steps that warm up a worker process and shows how long each took
+    \f
+    :return:
+    """
+    for name, seconds in warm_up():
+        click.echo(f'{name}: {seconds * 1000:.1f} ms')
@@ -0,0 +1,151 @@
+"""
+Streaming CSV and NDJSON exports of the shop's tables
+"""
+# Import statements
+import csv
+import datetime
+import io
+import json
+
+from sqlalchemy import select
+
+from main import app, db
+from main.models import Customer, Order, Product
+
+# Columns included in each export, the password hash is never exported
+EXPORTS = {
+    'customers': (Customer, (Customer.id, Customer.username, Customer.email, Customer.date_joined)),
+    'products': (Product, (Product.id, Product.name, Product.price_pence, Product.description,
+                           Product.quantity, Product.product_image, Product.date_added)),
+    'orders': (Order, (Order.id, Order.quantity, Order.price_pence, Order.status, Order.payment_id,
+                       Order.customer_id, Order.product_id, Order.placed_at)),
+}
+# Column used by the date range filter of each export
+DATE_COLUMNS = {
+    'customers': Customer.date_joined,
+    'products': Product.date_added,
+    'orders': Order.placed_at,
+}
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+
+class ExportError(ValueError):
+    """Class for invalid export requests"""
+
+
+def parse_date(value, name):
+    """
+    Function for reading a date filter from the query string
+    :param value: The date in YYYY-MM-DD format, or None
+    :param name: The name of the filter
+    :raises: ExportError: if the date is not valid
+    :return: The date as a datetime, or None
+    """
+    if not value:
+        return None
+    try:
+        return datetime.datetime.combine(datetime.date.fromisoformat(value), datetime.time())
+    except ValueError as error:
+        raise ExportError(f'{name} must be a date in the format YYYY-MM-DD') from error
+
+
+def build_export_query(table, start=None, end=None, status=None):
+    """
+    Function for building the filtered query for an export
+    :param table: The name of the export
+    :param start: Only include rows on or after this date
+    :param end: Only include rows before the day after this date
+    :param status: Only include orders with this status
+    :raises: ExportError: if a filter isn't supported by the export
+    :return: The select statement without the keyset condition
+    """
+    _, columns = EXPORTS[table]
+    query = select(*columns)
+    if start or end:
+        if table not in DATE_COLUMNS:
+            raise ExportError(f'The {table} export does not support a date range')
+        if start:
+            query = query.where(DATE_COLUMNS[table] >= start)
+        if end:
+            query = query.where(DATE_COLUMNS[table] < end + datetime.timedelta(days=1))
+    if status:
+        if table != 'orders':
+            raise ExportError(f'The {table} export does not support a status filter')
+        query = query.where(Order.status == status)
+    return query
+
+
+def export_chunks(table, query, after=0):
+    """
+    Generator for reading the rows of an export in chunks ordered by id
+    :param table: The name of the export
+    :param query: The filtered select statement
+    :param after: Only include rows with an id greater than this, used to resume an export
+    :return: Each chunk as a list of rows
+    """
+    model, _ = EXPORTS[table]
+    chunk_size = app.config['EXPORT_CHUNK_SIZE']
+    while True:
+        chunk = db.session.execute(
+            query.where(model.id > after).order_by(model.id).limit(chunk_size)
+        ).all()
+        # End the read transaction between chunks so writers are never held up by the export
+        db.session.rollback()
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        after = chunk[-1][0]
+
+
+def csv_lines(header, chunks):
+    """
+    Generator for converting chunks of rows to CSV
+    :param header: The column names
+    :param chunks: The chunks of rows to convert
+    :return: The CSV text for the header and then for each chunk
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield buffer.getvalue()
+    for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+
+
+def ndjson_lines(header, chunks):
+    """
+    Generator for converting chunks of rows to newline delimited JSON
+    :param header: The column names
+    :param chunks: The chunks of rows to convert
+    :return: The NDJSON text for each chunk
+    """
+    for chunk in chunks:
+        yield ''.join(json.dumps(dict(zip(header, row)), default=str) + '\n' for row in chunk)
+
+
+def export_lines(table, export_format, start=None, end=None, status=None, after=0):
+    """
+    Function for streaming an export in the requested format
+    :param table: The name of the export
+    :param export_format: Either csv or ndjson
+    :param start: Only include rows on or after this date
+    :param end: Only include rows on or before this date
+    :param status: Only include orders with this status
+    :param after: Only include rows with an id greater than this
+    :raises: ExportError: if the export or its filters are not valid
+    :return: A generator of text
+    """
+    if table not in EXPORTS:
+        raise ExportError(f'There is no {table} export')
+    if export_format not in EXPORT_FORMATS:
+        raise ExportError(f'Format must be one of {", ".join(EXPORT_FORMATS)}')
+    query = build_export_query(table, start, end, status)
+    header = [column.key for column in EXPORTS[table][1]]
+    chunks = export_chunks(table, query, after)
+    if export_format == 'csv':
+        return csv_lines(header, chunks)
+    return ndjson_lines(header, chunks)
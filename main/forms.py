@@ -2,21 +2,61 @@
 File containing forms used in the application
 """
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileField, FileRequired
+from sqlalchemy import or_, select
+from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms import (StringField,
                      IntegerField,
-                     FloatField,
+                     DecimalField,
                      PasswordField,
                      EmailField,
-                     SubmitField)
+                     SubmitField,
+                     BooleanField)
 from wtforms.fields.choices import SelectField
 from wtforms.validators import (Length,
                                 EqualTo,
                                 Email,
                                 DataRequired,
+                                Optional,
                                 ValidationError)
 
+from main import db
+from main.breached_passwords import is_breached
 from main.models import Customer
+from main.money import to_pence
+
+# Possible order statuses
+ORDER_STATUSES = [
+    ('Pending', 'Pending'),
+    ('Accepted', 'Accepted'),
+    ('Out for delivery', 'Out for delivery'),
+    ('Delivered', 'Delivered'),
+    ('Cancelled', 'Cancelled')
+]
+
+
+def parse_ids(field):
+    """
+    Function for reading a comma separated list of ids from a field
+    :param field: The field containing the ids
+    :raises: ValidationError: if an id is not a whole number
+    :return: A list of ids
+    """
+    try:
+        return [int(value) for value in (field.data or '').split(',') if value.strip()]
+    except ValueError as error:
+        raise ValidationError('IDs must be whole numbers separated by commas') from error
+
+
+def check_not_breached(form, field):
+    """
+    Validator to check a new password hasn't appeared in a data breach
+    :param form: The form being validated
+    :param field: The password field
+    :raises: ValidationError: if the password is in the breached password filter
+    :return:
+    """
+    if field.data and is_breached(field.data):
+        raise ValidationError('This password has appeared in a data breach, please choose a different password')
 
 
 class RegisterForm(FlaskForm):
@@ -24,37 +64,36 @@ class RegisterForm(FlaskForm):
     Form used to sign up new users
     """
 
-    def validate_username(self, username_to_check):
+    def check_available(self, error=None):
         """
-        Function to check if the username is available
-        :param username_to_check: The user's username
-        :return:
+        Function to check the username and email aren't already in use, with one query for both
+        The account is inserted without checking first, so this is only needed when the insert fails
+        :param error: The IntegrityError raised when inserting the account
+        :return: Boolean indicating if the username and email are available
         """
-        # Check the username doesn't already exist
-        user = Customer.query.filter_by(username=username_to_check.data).first()
-        if user:
-            raise ValidationError(
-                f"Username '{self.username}' already exists! Please try a different username"
+        taken = db.session.execute(
+            select(Customer.username, Customer.email)
+            .where(or_(Customer.username == self.username.data, Customer.email == self.email.data))
+        ).all()
+        username_taken = any(username == self.username.data for username, _ in taken)
+        email_taken = any(email == self.email.data for _, email in taken)
+        # Fall back to the constraint named in the error if the other account has since been deleted
+        message = str(getattr(error, 'orig', error or ''))
+        username_taken = username_taken or 'customer.username' in message
+        email_taken = email_taken or 'customer.email' in message
+        if username_taken:
+            self.username.errors.append(
+                f"Username '{self.username.data}' already exists! Please try a different username"
             )
-
-    def validate_email(self, email_to_check):
-        """
-        Function to check if the email is available
-        :param email_to_check: The users email address
-        :return:
-        """
-        # Check if the email isn't already associated with another account
-        email = (Customer.
-                 query.
-                 filter_by(email=email_to_check.data).first())
-        if email:
-            raise ValidationError(
-                f"Email '{self.email}' already exists! Please try a different email"
+        if email_taken:
+            self.email.errors.append(
+                f"Email '{self.email.data}' already exists! Please try a different email"
             )
+        return not (username_taken or email_taken)
 
     username = StringField(label='User Name:', validators=[Length(min=2, max=30), DataRequired()])
     email = EmailField(label='Email Address:', validators=[Email(), DataRequired()])
-    password = PasswordField(label='Password', validators=[Length(min=6), DataRequired()])
+    password = PasswordField(label='Password', validators=[Length(min=6), DataRequired(), check_not_breached])
     confirm_password = PasswordField(
         label='Confirm Password:',
         validators=[EqualTo('password'), DataRequired()])
@@ -79,7 +118,7 @@ class ChangePasswordForm(FlaskForm):
         validators=[Length(min=6), DataRequired()])
     new_password = PasswordField(
         label='New Password',
-        validators=[Length(min=6), DataRequired()])
+        validators=[Length(min=6), DataRequired(), check_not_breached])
     confirm_password = PasswordField(
         label='Confirm Password',
         validators=[Length(min=6), DataRequired()])
@@ -92,23 +131,134 @@ class ShopItemsForm(FlaskForm):
     """
     product_name = StringField('Product Name', validators=[DataRequired()])
     quantity = IntegerField('Quantity', validators=[DataRequired()])
-    price = FloatField('Price', validators=[DataRequired()])
+    price = DecimalField('Price', places=2, validators=[DataRequired()])
     description = StringField('Description', validators=[DataRequired()])
     product_image = FileField('Product Image', validators=[FileRequired()])
     add_product = SubmitField(label='Add Product')
     update_product = SubmitField(label='Update Product')
 
 
+class ProductImportForm(ShopItemsForm):
+    """
+    Form used to validate each row of a bulk product import
+    """
+    # The image is a file name in the import's image directory or archive instead of an upload
+    product_image = StringField('Product Image', validators=[DataRequired()])
+
+
+class ImportProductsForm(FlaskForm):
+    """
+    Form used to upload a file of products to import
+    """
+    products_file = FileField('Products File (CSV or JSON)', validators=[
+        FileRequired(), FileAllowed(['csv', 'json', 'ndjson'], 'Products must be a CSV or JSON file')])
+    images_archive = FileField('Images Archive (ZIP)', validators=[
+        FileAllowed(['zip'], 'Images must be a ZIP archive')])
+    import_products = SubmitField(label='Import Products')
+
+
 class OrderForm(FlaskForm):
     """
     Form used to place an order
     """
-    # Possible order statuses
-    order_status = SelectField('Order Status', choices=[
-        ('Pending', 'Pending'),
-        ('Accepted', 'Accepted'),
-        ('Out for delivery', 'Out for delivery'),
-        ('Delivered', 'Delivered'),
-        ('Cancelled', 'Cancelled')
-    ])
+    order_status = SelectField('Order Status', choices=ORDER_STATUSES)
     update = SubmitField(label='Update Status')
+
+
+class BulkProductUpdateForm(FlaskForm):
+    """
+    Form used to change the price and stock of many products at once
+    """
+
+    def validate_product_ids(self, product_ids):
+        """
+        Function to check the product ids are valid
+        :param product_ids: The comma separated product ids
+        :return:
+        """
+        parse_ids(product_ids)
+
+    def validate(self, extra_validators=None):
+        """
+        Function to check the products to update and the changes to make have been chosen
+        :param extra_validators: Any extra validators for the fields
+        :return: Boolean indicating if the form is valid
+        """
+        if not super().validate(extra_validators):
+            return False
+        if not (self.all_products.data or self.product_ids.data or self.name_contains.data):
+            self.product_ids.errors.append('Choose the products to update')
+            return False
+        if self.price_change.data == 'none' and self.quantity_change.data == 'none':
+            self.price_change.errors.append('Choose a change to make')
+            return False
+        if self.price_change.data != 'none' and self.price_value.data is None:
+            self.price_value.errors.append('Enter a price or percentage')
+            return False
+        # Prices are stored in whole pence, so a price that rounds to 0 pence is free
+        if self.price_change.data == 'set' and to_pence(self.price_value.data) < 1:
+            self.price_value.errors.append('The price must be at least 1 pence')
+            return False
+        if self.price_change.data == 'percent' and self.price_value.data <= -100:
+            self.price_value.errors.append('The price can not be reduced by 100% or more')
+            return False
+        if self.quantity_change.data != 'none' and self.quantity_value.data is None:
+            self.quantity_value.errors.append('Enter a quantity')
+            return False
+        return True
+
+    product_ids = StringField('Product IDs (comma separated)', validators=[Optional()])
+    name_contains = StringField('Name Contains', validators=[Optional()])
+    all_products = BooleanField('All Products')
+    price_change = SelectField('Price Change', choices=[
+        ('none', 'No change'),
+        ('set', 'Set price to'),
+        ('percent', 'Change price by %')
+    ])
+    price_value = DecimalField('Price or Percentage', validators=[Optional()])
+    quantity_change = SelectField('Stock Change', choices=[
+        ('none', 'No change'),
+        ('set', 'Set stock to'),
+        ('adjust', 'Adjust stock by')
+    ])
+    quantity_value = IntegerField('Quantity', validators=[Optional()])
+    update_products = SubmitField(label='Update Products')
+
+
+class BulkOrderStatusForm(FlaskForm):
+    """
+    Form used to change the status of many orders at once
+    """
+
+    def validate_order_ids(self, order_ids):
+        """
+        Function to check the order ids are valid
+        :param order_ids: The comma separated order ids
+        :return:
+        """
+        parse_ids(order_ids)
+
+    def validate(self, extra_validators=None):
+        """
+        Function to check the orders to update have been chosen
+        :param extra_validators: Any extra validators for the fields
+        :return: Boolean indicating if the form is valid
+        """
+        if not super().validate(extra_validators):
+            return False
+        if not (self.current_status.data or self.order_ids.data):
+            self.current_status.errors.append('Choose the orders to update')
+            return False
+        return True
+
+    current_status = SelectField('Current Status', choices=[('', 'Any status')] + ORDER_STATUSES)
+    order_ids = StringField('Order IDs (comma separated)', validators=[Optional()])
+    new_status = SelectField('New Status', choices=ORDER_STATUSES)
+    update_orders = SubmitField(label='Update Orders')
+
+
+class PasswordAuditForm(FlaskForm):
+    """
+    Form used to start a weak password audit
+    """
+    start_audit = SubmitField(label='Start Audit')
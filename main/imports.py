@@ -0,0 +1,283 @@
+"""
+Bulk import of products from CSV or JSON files
+"""
+# Import statements
+import csv
+import json
+import os
+import shutil
+import zipfile
+
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.datastructures import MultiDict
+from werkzeug.utils import secure_filename
+
+from main import app, db
+from main.forms import ProductImportForm
+from main.models import Product
+from main.money import to_pence
+from main.stock_shards import respread_changed_shards, sync_sharded_totals
+
+# Columns accepted in an import file mapped to the fields of the product import form
+COLUMN_ALIASES = {
+    'name': 'product_name',
+    'image': 'product_image',
+}
+MEDIA_DIRECTORY = './media'
+
+
+class RowError:
+    """Class for an error in a single row of an import"""
+
+    def __init__(self, row_number, message):
+        self.row_number = row_number
+        self.message = message
+
+    def __str__(self):
+        """
+        Returns the row number and the error message
+        :return: The error as a string
+        """
+        return f'Row {self.row_number}: {self.message}'
+
+
+class ImportReport:
+    """Class for the outcome of a bulk import"""
+
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.errors = []
+
+    def __str__(self):
+        """
+        Returns a summary of the import
+        :return: The summary as a string
+        """
+        return f'{self.created} products created, {self.updated} updated, {len(self.errors)} rows failed'
+
+
+class ImageSource:
+    """Class for finding product images in a directory or a ZIP archive"""
+
+    def __init__(self, path=None):
+        """
+        Opens the image directory or archive
+        :param path: The path of a directory, or the path or file object of a ZIP archive
+        :raises: ValueError: if the path is not a directory or a ZIP archive
+        """
+        self.directory = None
+        self.archive = None
+        if path is None:
+            return
+        if isinstance(path, (str, os.PathLike)) and os.path.isdir(path):
+            self.directory = path
+        elif zipfile.is_zipfile(path):
+            self.archive = zipfile.ZipFile(path)
+            # Match archive members by file name wherever they are in the archive
+            self.members = {os.path.basename(name): name for name in self.archive.namelist()
+                            if not name.endswith('/')}
+        else:
+            raise ValueError('Images must be a directory or a ZIP archive')
+
+    def close(self):
+        """
+        Function for closing the archive if one is open
+        :return:
+        """
+        if self.archive:
+            self.archive.close()
+
+    def attach(self, image_name):
+        """
+        Function for copying an image to the media directory
+        :param image_name: The file name given for the product's image
+        :raises: ValueError: if the image can't be found
+        :return: The path of the image stored for the product
+        """
+        file_name = secure_filename(os.path.basename(image_name))
+        if not file_name:
+            raise ValueError(f"'{image_name}' is not a valid image file name")
+        destination = f'{MEDIA_DIRECTORY}/{file_name}'
+        if self.archive:
+            if file_name not in self.members:
+                raise ValueError(f"Image '{image_name}' is not in the archive")
+            with self.archive.open(self.members[file_name]) as source, open(destination, 'wb') as target:
+                shutil.copyfileobj(source, target)
+        elif self.directory:
+            source = os.path.join(self.directory, file_name)
+            if not os.path.isfile(source):
+                raise ValueError(f"Image '{image_name}' is not in the image directory")
+            shutil.copyfile(source, destination)
+        elif not os.path.isfile(destination):
+            # Without an image source the image must already have been uploaded
+            raise ValueError(f"Image '{image_name}' has not been uploaded")
+        return destination
+
+
+def iter_csv_rows(stream):
+    """
+    Generator for reading the rows of a CSV file one at a time
+    :param stream: The text stream of the file
+    :return: Each row number and row as a dictionary
+    """
+    # Row 1 is the header
+    yield from enumerate(csv.DictReader(stream), start=2)
+
+
+def iter_json_rows(stream, read_size=65536):
+    """
+    Generator for reading the objects of a JSON array or JSON lines file one at a time
+    :param stream: The text stream of the file
+    :param read_size: The number of characters read at a time
+    :raises: ValueError: if the file isn't valid JSON
+    :return: Each row number and row as a dictionary
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    row_number = 0
+    finished = False
+    while True:
+        # Skip the array brackets, separators and whitespace between objects
+        while position < len(buffer) and buffer[position] in '[,] \t\r\n':
+            position += 1
+        if position == len(buffer):
+            if finished:
+                return
+            buffer, position = stream.read(read_size), 0
+            finished = not buffer
+            continue
+        try:
+            row, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if finished:
+                raise
+            # The object is split across reads so read some more of the file
+            more = stream.read(read_size)
+            finished = not more
+            buffer, position = buffer[position:] + more, 0
+            continue
+        row_number += 1
+        position = end
+        yield row_number, row
+
+
+def iter_rows(stream, file_name):
+    """
+    Function for choosing the parser for an import file
+    :param stream: The text stream of the file
+    :param file_name: The name of the file
+    :return: A generator of row numbers and rows
+    """
+    if file_name.lower().endswith('.csv'):
+        return iter_csv_rows(stream)
+    return iter_json_rows(stream)
+
+
+def validate_row(row):
+    """
+    Function for validating a row with the same rules as the shop items form
+    :param row: The row as a dictionary
+    :raises: ValueError: if the row is not valid
+    :return: The validated form
+    """
+    if not isinstance(row, dict):
+        raise ValueError('Each product must be an object')
+    data = MultiDict()
+    for key, value in row.items():
+        if value is not None:
+            data[COLUMN_ALIASES.get(key, key)] = str(value)
+    form = ProductImportForm(formdata=data, meta={'csrf': False})
+    if not form.validate():
+        raise ValueError('; '.join(f'{field}: {", ".join(errors)}' for field, errors in form.errors.items()))
+    return form
+
+
+def upsert_batch(batch, report):
+    """
+    Function for inserting or updating a batch of products by name in one transaction
+    :param batch: A dictionary of product values keyed by product name
+    :param report: The import report
+    :return:
+    """
+    names = list(batch)
+    existing = db.session.scalars(db.select(Product.name).where(Product.name.in_(names))).all()
+    statement = insert(Product)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Product.name],
+        set_={column: statement.excluded[column]
+              for column in ('price_pence', 'quantity', 'description', 'product_image')}
+    )
+    sync_sharded_totals()
+    db.session.execute(statement, list(batch.values()))
+    # Spread the imported stock of sharded products across their shards
+    respread_changed_shards()
+    db.session.commit()
+    report.updated += len(existing)
+    report.created += len(names) - len(existing)
+
+
+def flush_batch(batch, row_numbers, report):
+    """
+    Function for saving a batch, retrying each row on its own if the batch fails
+    :param batch: A dictionary of product values keyed by product name
+    :param row_numbers: The row numbers of the products in the batch keyed by product name
+    :param report: The import report
+    :return:
+    """
+    try:
+        upsert_batch(batch, report)
+    except SQLAlchemyError:
+        db.session.rollback()
+        for name, values in batch.items():
+            try:
+                upsert_batch({name: values}, report)
+            except SQLAlchemyError as error:
+                db.session.rollback()
+                report.errors.append(RowError(row_numbers[name], str(getattr(error, 'orig', None) or error)))
+
+
+def import_products(rows, image_source=None, batch_size=None):
+    """
+    Function for importing products, creating new ones and updating existing ones by name
+    :param rows: The row numbers and rows to import
+    :param image_source: Where to find the images named in the rows
+    :param batch_size: The number of products saved per transaction
+    :return: The import report
+    """
+    batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+    image_source = image_source or ImageSource()
+    report = ImportReport()
+    batch = {}
+    row_numbers = {}
+    last_row_number = 0
+    try:
+        for row_number, row in rows:
+            last_row_number = row_number
+            try:
+                form = validate_row(row)
+                product_image = image_source.attach(form.product_image.data)
+            except ValueError as error:
+                # Report the row and carry on with the rest of the import
+                report.errors.append(RowError(row_number, str(error)))
+                continue
+            # A later row with the same name replaces the earlier one
+            batch[form.product_name.data] = {
+                'name': form.product_name.data,
+                'price_pence': to_pence(form.price.data),
+                'quantity': form.quantity.data,
+                'description': form.description.data,
+                'product_image': product_image,
+            }
+            row_numbers[form.product_name.data] = row_number
+            if len(batch) >= batch_size:
+                flush_batch(batch, row_numbers, report)
+                batch, row_numbers = {}, {}
+    except (ValueError, csv.Error) as error:
+        # The rest of the file couldn't be read, the rows already read are still imported
+        report.errors.append(RowError(last_row_number + 1, f'The file could not be read: {error}'))
+    if batch:
+        flush_batch(batch, row_numbers, report)
+    return report
@@ -0,0 +1,256 @@
+"""
+Durable job queue stored in the database and run by worker processes
+"""
+# Import statements
+import contextvars
+import datetime
+import json
+import multiprocessing
+import time
+import uuid
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from main import app, db
+from main.models import Job
+
+# Job statuses
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+DEAD = 'dead'
+# Functions that run each kind of job
+JOB_HANDLERS = {}
+# The id and claim token of the job being run, so long running handlers can extend their lease
+current_job = contextvars.ContextVar('current_job', default=None)
+
+
+class LeaseLost(Exception):
+    """Exception raised when a job's lease ran out and the job was claimed by another worker"""
+
+
+def utc_now():
+    """
+    Function for getting the current time
+    :return: The current time in UTC
+    """
+    return datetime.datetime.now(datetime.UTC)
+
+
+def job_handler(kind):
+    """
+    Decorator for registering the function that runs a kind of job
+    :param kind: The kind of job
+    :return: The decorator
+    """
+    def register(function):
+        JOB_HANDLERS[kind] = function
+        return function
+    return register
+
+
+def enqueue(kind, payload, idempotency_key=None, delay=0):
+    """
+    Function for adding a job to the queue, the caller commits it with the rest of its changes
+    :param kind: The kind of job
+    :param payload: The data passed to the job's handler, which must be JSON serialisable
+    :param idempotency_key: A key identifying the job, a job with the same key is only queued once
+    :param delay: The number of seconds to wait before running the job
+    :return:
+    """
+    db.session.execute(insert(Job).values(
+        kind=kind,
+        payload=json.dumps(payload),
+        idempotency_key=idempotency_key,
+        status=QUEUED,
+        attempts=0,
+        max_attempts=app.config['JOB_MAX_ATTEMPTS'],
+        run_at=utc_now() + datetime.timedelta(seconds=delay)
+    ).on_conflict_do_nothing(index_elements=[Job.idempotency_key]))
+
+
+def dead_letter_abandoned_jobs(now):
+    """
+    Function for dead-lettering jobs whose worker stopped before finishing their last attempt
+    A job that kills its worker never records its outcome, so without this it would be claimed again forever
+    :param now: The current time
+    :return: The number of jobs dead-lettered
+    """
+    result = db.session.execute(
+        update(Job.__table__)
+        .where(Job.status == RUNNING, Job.locked_until <= now, Job.attempts >= Job.max_attempts)
+        .values(status=DEAD, locked_until=None, last_error='The worker stopped before the job finished')
+    )
+    return result.rowcount
+
+
+def claim_job():
+    """
+    Function for taking the next job that is due, including jobs whose worker stopped before finishing
+    :return: The id, kind, payload, attempts, most attempts and claim token of the job, or None if no job is due
+    """
+    now = utc_now()
+    dead_letter_abandoned_jobs(now)
+    due = (select(Job.id)
+           .where(or_(Job.status == QUEUED, Job.status == RUNNING), Job.run_at <= now)
+           .where(or_(Job.locked_until.is_(None), Job.locked_until <= now))
+           .where(Job.attempts < Job.max_attempts)
+           .order_by(Job.run_at)
+           .limit(1)
+           .scalar_subquery())
+    # Claiming is a single statement so two workers can never take the same job
+    claimed = db.session.execute(
+        update(Job.__table__)
+        .where(Job.id == due)
+        .values(status=RUNNING, attempts=Job.attempts + 1, claim_token=uuid.uuid4().hex,
+                locked_until=now + datetime.timedelta(seconds=app.config['JOB_LEASE_SECONDS']))
+        .returning(Job.id, Job.kind, Job.payload, Job.attempts, Job.max_attempts, Job.claim_token)
+    ).first()
+    db.session.commit()
+    return claimed
+
+
+def finish_job(job_id, claim_token, error=None, attempts=0, max_attempts=0):
+    """
+    Function for recording the outcome of a job, retrying it later or dead-lettering it if it failed
+    The outcome is dropped if the job has been claimed by another worker since
+    :param job_id: The id of the job
+    :param claim_token: The token returned when the job was claimed
+    :param error: The error raised by the job, or None if it succeeded
+    :param attempts: The number of times the job has been run
+    :param max_attempts: The most times the job can be run
+    :return: Boolean indicating if the outcome was recorded
+    """
+    if error is None:
+        values = {'status': DONE, 'locked_until': None, 'last_error': None}
+    elif attempts >= max_attempts:
+        # Keep the job so it can be inspected and requeued
+        values = {'status': DEAD, 'locked_until': None, 'last_error': repr(error)}
+    else:
+        # Wait longer after each failed attempt
+        delay = app.config['JOB_RETRY_DELAY'] * 2 ** (attempts - 1)
+        values = {'status': QUEUED, 'locked_until': None, 'last_error': repr(error),
+                  'run_at': utc_now() + datetime.timedelta(seconds=delay)}
+    result = db.session.execute(
+        update(Job.__table__)
+        .where(Job.id == job_id, Job.claim_token == claim_token, Job.status == RUNNING)
+        .values(**values)
+    )
+    db.session.commit()
+    if result.rowcount != 1:
+        app.logger.warning('Job %s was claimed by another worker, its outcome is dropped', job_id)
+        return False
+    return True
+
+
+def run_next_job():
+    """
+    Function for running the next job that is due
+    :return: Boolean indicating if a job was run
+    """
+    claimed = claim_job()
+    if claimed is None:
+        return False
+    job_id, kind, payload, attempts, max_attempts, claim_token = claimed
+    token = current_job.set((job_id, claim_token))
+    try:
+        handler = JOB_HANDLERS[kind]
+        handler(**json.loads(payload))
+        db.session.commit()
+    except LeaseLost:
+        # The worker that claimed the job since is running it, so this attempt leaves it alone
+        db.session.rollback()
+        app.logger.warning('Job %s (%s) lost its lease on attempt %s', job_id, kind, attempts)
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        db.session.rollback()
+        app.logger.warning('Job %s (%s) failed on attempt %s: %r', job_id, kind, attempts, error)
+        finish_job(job_id, claim_token, error, attempts, max_attempts)
+    else:
+        finish_job(job_id, claim_token)
+    finally:
+        current_job.reset(token)
+    return True
+
+
+def heartbeat():
+    """
+    Function for extending the lease of the job being run so no other worker takes it while it is still running
+    :raises: LeaseLost: if the lease already ran out and another worker has claimed the job
+    :return:
+    """
+    job = current_job.get()
+    if job is None:
+        return
+    job_id, claim_token = job
+    result = db.session.execute(
+        update(Job.__table__)
+        .where(Job.id == job_id, Job.claim_token == claim_token, Job.status == RUNNING)
+        .values(locked_until=utc_now() + datetime.timedelta(seconds=app.config['JOB_LEASE_SECONDS']))
+    )
+    db.session.commit()
+    if result.rowcount != 1:
+        raise LeaseLost(f'Job {job_id} was claimed by another worker')
+
+
+def run_pending_jobs():
+    """
+    Function for running jobs until none are due
+    :return: The number of jobs run
+    """
+    count = 0
+    while run_next_job():
+        count += 1
+    return count
+
+
+def work(poll_interval=None):
+    """
+    Function for running jobs as they become due until the process is stopped
+    :param poll_interval: The number of seconds to wait when no jobs are due
+    :return:
+    """
+    poll_interval = poll_interval or app.config['JOB_POLL_INTERVAL']
+    with app.app_context():
+        while True:
+            if not run_next_job():
+                time.sleep(poll_interval)
+
+
+def run_worker():
+    """
+    Function for running jobs in a forked worker process
+    :return:
+    """
+    with app.app_context():
+        # The database connections copied from the parent are left for it, and the worker opens its own
+        db.engine.dispose(close=False)
+    work()
+
+
+def start_workers(processes):
+    """
+    Function for starting worker processes and waiting for them to finish
+    :param processes: The number of worker processes
+    :return:
+    """
+    workers = [multiprocessing.Process(target=run_worker, name=f'job-worker-{number}')
+               for number in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def requeue_dead_jobs():
+    """
+    Function for putting dead-lettered jobs back on the queue
+    :return: The number of jobs requeued
+    """
+    result = db.session.execute(
+        update(Job.__table__)
+        .where(Job.status == DEAD)
+        .values(status=QUEUED, attempts=0, run_at=utc_now())
+    )
+    db.session.commit()
+    return result.rowcount
@@ -0,0 +1,95 @@
+"""
+Fast JSON for responses, used by jsonify and every JSON response
+
+Rows selected from the database can be returned directly, each is written as an object keyed by column name
+without building a model for it. When orjson is installed (pip install orjson) it encodes the responses, which is
+several times faster than the standard library and makes the bytes in one step without an intermediate string.
+Otherwise the standard library is used with the same output.
+"""
+# Import statements
+import dataclasses
+import datetime
+import decimal
+import uuid
+
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy.engine import Row
+
+from main import app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(value):
+    """
+    Function for converting the values the JSON encoder doesn't support itself
+    :param value: The value
+    :raises: TypeError: if the value can't be converted
+    :return: A value the encoder supports
+    """
+    if isinstance(value, Row):
+        return value._asdict()
+    if isinstance(value, (datetime.date, datetime.time)):
+        # The same ISO 8601 format orjson writes
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Class for encoding JSON with orjson when it is installed and the standard library otherwise"""
+
+    default = staticmethod(default)
+    # Objects keep the order their keys were added in, so rows keep the order their columns were selected in
+    sort_keys = False
+    ensure_ascii = False
+
+    def dumps(self, obj, **kwargs):
+        """
+        Function for encoding a value as a JSON string
+        :param obj: The value
+        :param kwargs: Options for the standard library encoder, which is used if any are given
+        :return: The JSON
+        """
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        """
+        Function for decoding JSON
+        :param s: The JSON as a string or bytes
+        :param kwargs: Options for the standard library decoder, which is used if any are given
+        :return: The value
+        """
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """
+        Function for building a JSON response, encoded straight to bytes
+        Responses are indented in debug mode, like the default provider
+        :param args: A single value, or several which are returned as a list
+        :param kwargs: Keys and values which are returned as an object
+        :return: The response
+        """
+        obj = self._prepare_response_obj(args, kwargs)
+        if orjson is None or (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(obj)
+        return self._app.response_class(
+            orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE),
+            mimetype=self.mimetype
+        )
+
+
+app.json_provider_class = FastJSONProvider
+app.json = FastJSONProvider(app)
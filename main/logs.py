@@ -0,0 +1,229 @@
+"""
+Structured logging that never blocks a request
+
+Log records are put on a bounded queue and written as JSON lines by a background thread, so a slow log disk
+only delays the thread writing them. If the queue fills up, new records are dropped and counted instead of
+waiting for space. Each record carries the id, endpoint and user of the request that logged it, and every
+request gets one access record with its status and latency, sampled for fast successful requests. Forked
+processes, such as the job workers, start a writing thread of their own.
+"""
+# Import statements
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import multiprocessing.util
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+
+from flask import g, has_request_context, request, session
+from flask.logging import default_handler
+
+from main import app
+
+# Access records for each request are logged here so they can be sampled separately
+access_logger = app.logger.getChild('access')
+
+
+class RequestContextFilter(logging.Filter):
+    """Class for adding the details of the current request to each record, run on the thread that logs it"""
+
+    def filter(self, record):
+        """
+        Function for adding the request id, endpoint and user id to a record
+        :param record: The record
+        :return: True, every record is kept
+        """
+        if has_request_context():
+            record.request_id = getattr(g, 'request_id', None)
+            record.endpoint = request.endpoint
+            # The user id is read from the session cookie or API token so logging never loads the user
+            record.user_id = session.get('_user_id') or g.get('customer_id')
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Class for keeping a fraction of the records below WARNING from loggers with a sample rate"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        """
+        Function for deciding if a record is kept
+        :param record: The record
+        :return: Boolean indicating if the record is kept
+        """
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.name, 1)
+        return rate >= 1 or random.random() < rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Class for putting records on a bounded queue, dropping them rather than waiting when it is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Function for merging the message arguments and exception into the record before it is queued
+        The arguments may change after the call returns, and the formatting is left for the listener's thread
+        :param record: The record
+        :return: A copy of the record that is safe to pass to another thread
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        """
+        Function for putting a record on the queue without waiting
+        :param record: The prepared record
+        :return:
+        """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JSONFormatter(logging.Formatter):
+    """Class for writing records as one JSON object per line"""
+
+    # Attributes added to records that are written when they are set
+    EXTRA_FIELDS = ('request_id', 'endpoint', 'user_id', 'method', 'path', 'status', 'latency_ms')
+
+    def format(self, record):
+        """
+        Function for writing a record as JSON
+        :param record: The record
+        :return: The JSON line
+        """
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.UTC).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in self.EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """
+    Function for sending the app's log records through the queue to a background thread that writes them
+    :return: The queue handler and the listener writing the records
+    """
+    log_file = app.config['LOG_FILE']
+    output = logging.FileHandler(log_file, encoding='utf-8') if log_file else logging.StreamHandler(sys.stderr)
+    output.setFormatter(JSONFormatter())
+    handler = DroppingQueueHandler(queue.Queue(app.config['LOG_QUEUE_SIZE']))
+    # Sampling is checked first so nothing is done for the records that are dropped, then the request details are
+    # read on the request's thread before the record is queued
+    handler.addFilter(SamplingFilter(app.config['LOG_SAMPLE_RATES']))
+    handler.addFilter(RequestContextFilter())
+    listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    # Write the records still on the queue when the process exits
+    atexit.register(stop_listener, listener)
+    app.logger.removeHandler(default_handler)
+    app.logger.setLevel(app.config['LOG_LEVEL'])
+    app.logger.addHandler(handler)
+    access_logger.setLevel(logging.INFO)
+    access_logger.propagate = False
+    access_logger.addHandler(handler)
+    return handler, listener
+
+
+def stop_listener(listener):
+    """
+    Function for writing the records still on the queue and stopping the listener's thread, if it is running
+    :param listener: The listener
+    :return:
+    """
+    if listener._thread is not None:
+        listener.stop()
+
+
+def restart_listener_after_fork():
+    """
+    Function for starting a new listener thread in a forked process, which only has a copy of the parent's thread
+    that isn't running, so its records would otherwise never be written
+    :return:
+    """
+    # The parent's queue may have been locked by another thread when it forked, so the child starts a new one
+    queue_handler.queue = queue.Queue(app.config['LOG_QUEUE_SIZE'])
+    queue_listener.queue = queue_handler.queue
+    queue_listener._thread = None
+    queue_listener.start()
+
+
+def stop_listener_at_exit(listener):
+    """
+    Function for stopping the listener when a process started by multiprocessing exits, as those processes exit
+    without running atexit but do run multiprocessing's finalizers
+    :param listener: The listener
+    :return:
+    """
+    multiprocessing.util.Finalize(listener, stop_listener, args=(listener,), exitpriority=0)
+
+
+queue_handler, queue_listener = configure_logging()
+os.register_at_fork(after_in_child=restart_listener_after_fork)
+# Registered with multiprocessing, which clears the finalizers copied from the parent after the fork hooks run
+multiprocessing.util.register_after_fork(queue_listener, stop_listener_at_exit)
+
+
+@app.before_request
+def start_request_log():
+    """
+    Function for giving each request an id, reusing the one set by a proxy in front of the app if there is one
+    :return:
+    """
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def log_request(response):
+    """
+    Function for logging the request's status and latency and returning its id to the client
+    Fast successful requests are sampled, slow requests and errors are always logged
+    :param response: The response
+    :return: The response with an X-Request-ID header
+    """
+    started = getattr(g, 'request_started', None)
+    if started is None:
+        return response
+    latency_ms = round((time.perf_counter() - started) * 1000, 2)
+    response.headers['X-Request-ID'] = g.request_id
+    slow = latency_ms >= app.config['LOG_SLOW_REQUEST_MS']
+    level = logging.WARNING if response.status_code >= 500 or slow else logging.INFO
+    access_logger.log(level, '%s %s %s', request.method, request.path, response.status_code, extra={
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'latency_ms': latency_ms,
+    })
+    return response
@@ -0,0 +1,14 @@
+"""
+Creates the tables that don't exist yet
+"""
+# Import statements
+from main import db
+
+
+def upgrade(connection):
+    """
+    Function for creating the missing tables, older databases keep their existing tables
+    :param connection: The database connection
+    :return:
+    """
+    db.metadata.create_all(connection)
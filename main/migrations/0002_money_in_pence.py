@@ -0,0 +1,35 @@
+"""
+Converts prices and revenue stored as floating point pounds to whole pence
+"""
+# Import statements
+from main.migrations import column_names, rebuild_table
+from main.models import Order, Product, ProductSales, SalesDay
+
+# The old order price was the total of the whole cart it was ordered with, and each of the cart's orders has the
+# same customer and price. An order that was the only item in its cart is worth the total divided by its quantity,
+# otherwise the price of one item is taken from its product, which the products' conversion has already put in pence
+ORDER_PRICE_PENCE = (
+    'COALESCE('
+    'CASE WHEN EXISTS (SELECT 1 FROM "order" AS other WHERE other.customer_id = "order".customer_id'
+    ' AND other.price = "order".price AND other.id != "order".id)'
+    ' THEN (SELECT product.price_pence FROM product WHERE product.id = "order".product_id) END, '
+    'CAST(ROUND("price" * 100 / MAX("quantity", 1)) AS INTEGER))'
+)
+# The tables converted, with the old column, the column that replaces it and the expression converting it
+CONVERSIONS = (
+    (Product.__table__, 'price', 'price_pence', 'CAST(ROUND("price" * 100) AS INTEGER)'),
+    (Order.__table__, 'price', 'price_pence', ORDER_PRICE_PENCE),
+    (SalesDay.__table__, 'revenue', 'revenue_pence', 'CAST(ROUND("revenue" * 100) AS INTEGER)'),
+    (ProductSales.__table__, 'revenue', 'revenue_pence', 'CAST(ROUND("revenue" * 100) AS INTEGER)'),
+)
+
+
+def upgrade(connection):
+    """
+    Function for converting the tables that still have the old columns
+    :param connection: The database connection
+    :return:
+    """
+    for table, old_column, new_column, expression in CONVERSIONS:
+        if old_column in column_names(connection, table.name):
+            rebuild_table(connection, table, {new_column: expression})
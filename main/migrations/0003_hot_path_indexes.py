@@ -0,0 +1,25 @@
+"""
+Adds indexes for the columns the routes filter and sort on
+"""
+# Import statements
+from main.models import Cart, Customer, Order, Product
+
+# Indexes declared on the models, named after their table and columns
+INDEXES = {
+    Cart.__table__: ('ix_cart_customer_id_product_id', 'ix_cart_product_id'),
+    Order.__table__: ('ix_order_customer_id', 'ix_order_product_id', 'ix_order_status_id'),
+    Product.__table__: ('ix_product_date_added',),
+    Customer.__table__: ('ix_customer_date_joined',),
+}
+
+
+def upgrade(connection):
+    """
+    Function for creating the indexes that don't exist yet
+    :param connection: The database connection
+    :return:
+    """
+    for table, names in INDEXES.items():
+        for index in table.indexes:
+            if index.name in names:
+                index.create(connection, checkfirst=True)
@@ -0,0 +1,15 @@
+"""
+Adds the tables for the weak password audit
+"""
+# Import statements
+from main.models import PasswordAudit, WeakAccount
+
+
+def upgrade(connection):
+    """
+    Function for creating the password audit tables
+    :param connection: The database connection
+    :return:
+    """
+    for table in (PasswordAudit.__table__, WeakAccount.__table__):
+        table.create(connection, checkfirst=True)
@@ -0,0 +1,17 @@
+"""
+Adds the time each order was placed, so the sales per day can be rebuilt from the orders
+"""
+# Import statements
+from sqlalchemy import text
+
+from main.migrations import column_names
+
+
+def upgrade(connection):
+    """
+    Function for adding the placed at column, which is left empty for the orders already placed
+    :param connection: The database connection
+    :return:
+    """
+    if 'placed_at' not in column_names(connection, 'order'):
+        connection.execute(text('ALTER TABLE "order" ADD COLUMN placed_at DATETIME'))
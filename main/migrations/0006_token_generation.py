@@ -0,0 +1,17 @@
+"""
+Adds the generation of each customer's API tokens, so tokens can be revoked
+"""
+# Import statements
+from sqlalchemy import text
+
+from main.migrations import column_names
+
+
+def upgrade(connection):
+    """
+    Function for adding the token generation column, starting every customer at generation 0
+    :param connection: The database connection
+    :return:
+    """
+    if 'token_generation' not in column_names(connection, 'customer'):
+        connection.execute(text('ALTER TABLE customer ADD COLUMN token_generation INTEGER NOT NULL DEFAULT 0'))
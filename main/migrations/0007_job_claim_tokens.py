@@ -0,0 +1,17 @@
+"""
+Adds the token of the worker's claim on each job, so a worker can only record the outcome of a job it still holds
+"""
+# Import statements
+from sqlalchemy import text
+
+from main.migrations import column_names
+
+
+def upgrade(connection):
+    """
+    Function for adding the claim token column
+    :param connection: The database connection
+    :return:
+    """
+    if 'claim_token' not in column_names(connection, 'job'):
+        connection.execute(text('ALTER TABLE job ADD COLUMN claim_token VARCHAR(32)'))
@@ -0,0 +1,32 @@
+"""
+Moves the stock held in carts for sharded products into their shards, so holding stock doesn't update one row
+"""
+# Import statements
+from sqlalchemy import text
+
+from main.migrations import column_names
+from main.stock_shards import shard_sizes
+
+
+def upgrade(connection):
+    """
+    Function for adding the reserved column to the shards and spreading each sharded product's reserved stock
+    :param connection: The database connection
+    :return:
+    """
+    if 'reserved' in column_names(connection, 'stock_shard'):
+        return
+    connection.execute(text('ALTER TABLE stock_shard ADD COLUMN reserved INTEGER NOT NULL DEFAULT 0'))
+    sharded = connection.execute(text(
+        'SELECT reserved_stock.product_id, reserved_stock.quantity, COUNT(stock_shard.shard) FROM reserved_stock'
+        ' JOIN stock_shard ON stock_shard.product_id = reserved_stock.product_id'
+        ' WHERE reserved_stock.quantity > 0 GROUP BY reserved_stock.product_id, reserved_stock.quantity'
+    )).all()
+    for product_id, reserved, shards in sharded:
+        for shard, size in enumerate(shard_sizes(reserved, shards)):
+            connection.execute(
+                text('UPDATE stock_shard SET reserved = :size WHERE product_id = :product_id AND shard = :shard'),
+                {'size': size, 'product_id': product_id, 'shard': shard}
+            )
+        connection.execute(text('UPDATE reserved_stock SET quantity = 0 WHERE product_id = :product_id'),
+                           {'product_id': product_id})
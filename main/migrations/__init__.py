@@ -0,0 +1,151 @@
+"""
+Versioned schema migrations
+
+Each migration is a module in this package named with a 4 digit version and a description, such as
+0002_money_in_pence.py, with an upgrade(connection) function. Pending migrations are applied in version
+order in one transaction and recorded in the schema_migrations table.
+
+Migrations describe the target schema with the models as they are now, so a new database created by
+0001_initial already has every later change and each migration checks whether its change is needed.
+"""
+# Import statements
+import datetime
+import importlib
+import os
+import re
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.schema import CreateTable
+
+from main import db
+
+MIGRATIONS_DIRECTORY = os.path.dirname(__file__)
+MIGRATION_NAME = re.compile(r'^(\d{4})_\w+\.py$')
+
+
+def migrations():
+    """
+    Function for finding the migrations in this package
+    :return: A list of the version and module name of each migration in version order
+    """
+    found = []
+    for file_name in os.listdir(MIGRATIONS_DIRECTORY):
+        match = MIGRATION_NAME.match(file_name)
+        if match:
+            found.append((match.group(1), file_name[:-3]))
+    return sorted(found)
+
+
+def migration_engine(url=None):
+    """
+    Function for creating an engine whose transactions include schema changes
+    The SQLite driver commits before each schema change on its own, so the engine begins the transactions
+    itself, taking the write lock straight away so only one process migrates the database at a time
+    :param url: The database URL, defaults to the app's database
+    :return: The engine
+    """
+    engine = create_engine(url or db.engine.url)
+
+    @event.listens_for(engine, 'connect')
+    def disable_driver_transactions(dbapi_connection, connection_record):
+        """Stops the driver starting and committing transactions itself"""
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin_immediate(connection):
+        """Starts each transaction with the write lock"""
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+    return engine
+
+
+def applied_versions(connection):
+    """
+    Function for getting the migrations already applied to the database
+    :param connection: The database connection
+    :return: A set of the applied versions
+    """
+    connection.execute(text('CREATE TABLE IF NOT EXISTS schema_migrations '
+                            '(version VARCHAR(4) NOT NULL PRIMARY KEY, name VARCHAR(100) NOT NULL, '
+                            'applied_at DATETIME NOT NULL)'))
+    return set(connection.execute(text('SELECT version FROM schema_migrations')).scalars())
+
+
+def upgrade(url=None):
+    """
+    Function for applying the pending migrations
+    :param url: The database URL, defaults to the app's database
+    :return: The names of the migrations applied
+    """
+    engine = migration_engine(url)
+    applied = []
+    try:
+        with engine.begin() as connection:
+            done = applied_versions(connection)
+            for version, name in migrations():
+                if version in done:
+                    continue
+                importlib.import_module(f'{__name__}.{name}').upgrade(connection)
+                connection.execute(
+                    text('INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :now)'),
+                    {'version': version, 'name': name, 'now': datetime.datetime.now(datetime.UTC)}
+                )
+                applied.append(name)
+    finally:
+        engine.dispose()
+    return applied
+
+
+def status(url=None):
+    """
+    Function for listing the migrations and whether they have been applied
+    :param url: The database URL, defaults to the app's database
+    :return: A list of the name of each migration and a boolean indicating if it has been applied
+    """
+    engine = migration_engine(url)
+    try:
+        with engine.begin() as connection:
+            done = applied_versions(connection)
+    finally:
+        engine.dispose()
+    return [(name, version in done) for version, name in migrations()]
+
+
+def column_names(connection, table_name):
+    """
+    Function for getting the columns a table has in the database
+    :param connection: The database connection
+    :param table_name: The name of the table
+    :return: A set of the column names, empty if the table doesn't exist
+    """
+    if not inspect(connection).has_table(table_name):
+        return set()
+    return {column['name'] for column in inspect(connection).get_columns(table_name)}
+
+
+def rebuild_table(connection, table, expressions):
+    """
+    Function for changing a table to match its model by copying it into a new table
+    SQLite can't change the type of a column so this follows its documented steps for altering a table
+    :param connection: The database connection
+    :param table: The table as described by its model
+    :param expressions: SQL expressions for the new columns keyed by column name, the other columns are copied
+    :return:
+    """
+    new_name = f'{table.name}_new'
+    new_table = table.to_metadata(table.metadata, name=new_name)
+    try:
+        connection.execute(CreateTable(new_table))
+    finally:
+        table.metadata.remove(new_table)
+    old_columns = column_names(connection, table.name)
+    columns = [column.name for column in table.columns if column.name in expressions or column.name in old_columns]
+    quoted = [f'"{column}"' for column in columns]
+    values = [expressions.get(column, f'"{column}"') for column in columns]
+    connection.execute(text(
+        f'INSERT INTO "{new_name}" ({", ".join(quoted)}) SELECT {", ".join(values)} FROM "{table.name}"'
+    ))
+    connection.execute(text(f'DROP TABLE "{table.name}"'))
+    connection.execute(text(f'ALTER TABLE "{new_name}" RENAME TO "{table.name}"'))
+    for index in table.indexes:
+        index.create(connection, checkfirst=True)
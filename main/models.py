@@ -6,6 +6,7 @@ import datetime
 from flask_login import UserMixin
 from main import db, login_manager
 from main import bcrypt
+from main.passwords import needs_rehash, target_rounds
 
 
 @login_manager.user_loader
@@ -26,7 +27,10 @@ class Customer(db.Model, UserMixin):
     email = db.Column(db.String(200), unique=True, nullable=False)
     username = db.Column(db.String(100), unique=True, nullable=False)
     password_hash = db.Column(db.String(length=60), nullable=False)
-    date_joined = db.Column(db.DateTime, default=datetime.datetime.now(datetime.UTC))
+    # Pass the function so each customer gets the time they joined, not the time the app started
+    date_joined = db.Column(db.DateTime, default=lambda: datetime.datetime.now(datetime.UTC), index=True)
+    # Signed into each API token and increased to revoke the tokens issued before, such as when the password changes
+    token_generation = db.Column(db.Integer, nullable=False, default=0)
     cart_items = db.relationship('Cart', backref=db.backref('customer', lazy=True))
     orders = db.relationship('Order', backref=db.backref('customer', lazy=True))
 
@@ -46,17 +50,23 @@ class Customer(db.Model, UserMixin):
         :param password: The plain text password
         :return:
         """
-        # Applying hashing algorithm to the password
-        self.password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+        # Applying hashing algorithm to the password with the configured cost
+        self.password_hash = bcrypt.generate_password_hash(password, target_rounds()).decode('utf-8')
 
     def verify_password(self, password):
         """
         Function for checking the password entered is correct
+        If the password was hashed with a different cost it is hashed again, the caller commits the change
         :param password: The entered password
         :return: Boolean indicating if the entered password is correct
         """
         # Verify the user's password
-        return bcrypt.check_password_hash(self.password_hash, password)
+        if not bcrypt.check_password_hash(self.password_hash, password):
+            return False
+        # Bring the hash up to the current cost while the plain text password is known
+        if needs_rehash(self.password_hash):
+            self.password = password
+        return True
 
     def __str__(self):
         """
@@ -72,11 +82,13 @@ class Product(db.Model):
     """
     id = db.Column(db.Integer(), primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
-    price = db.Column(db.Float, nullable=False)
+    # Prices are stored in pence so they add up exactly
+    price_pence = db.Column(db.Integer, nullable=False)
     description = db.Column(db.String(1024), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     product_image = db.Column(db.String(1000), nullable=False)
-    date_added = db.Column(db.DateTime, default=datetime.datetime.now(datetime.UTC))
+    # Pass the function so each product gets the time it was added, not the time the app started
+    date_added = db.Column(db.DateTime, default=lambda: datetime.datetime.now(datetime.UTC), index=True)
     carts = db.relationship('Cart', backref=db.backref('product', lazy=True))
     orders = db.relationship('Order', backref=db.backref('product', lazy=True))
 
@@ -85,20 +97,136 @@ class Cart(db.Model):
     """
     Class for the cart table
     """
+    # A customer's cart is looked up by customer, and by customer and product when adding to it
+    __table_args__ = (db.Index('ix_cart_customer_id_product_id', 'customer_id', 'product_id'),)
     id = db.Column(db.Integer, primary_key=True)
     quantity = db.Column(db.Integer, nullable=False)
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
 
 
 class Order(db.Model):
     """
     Class for the order table
     """
+    # Orders are filtered by status and then read in id order by the bulk updates and exports
+    __table_args__ = (db.Index('ix_order_status_id', 'status', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     quantity = db.Column(db.Integer, nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    # The price in pence paid for each item
+    price_pence = db.Column(db.Integer, nullable=False)
     status = db.Column(db.String(100), nullable=False)
     payment_id = db.Column(db.String(1000), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    # The time the cart was checked out, the same for every item in it and unknown for orders placed before it
+    # was recorded
+    placed_at = db.Column(db.DateTime)
+
+
+class ReservedStock(db.Model):
+    """
+    Class for the reserved stock table, a running total of the stock held in carts for each product
+    """
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+
+
+class StockHold(db.Model):
+    """
+    Class for the stock hold table, the stock held for a customer's cart until the hold expires
+    """
+    __table_args__ = (db.UniqueConstraint('customer_id', 'product_id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+
+
+class StockShard(db.Model):
+    """
+    Class for the stock shard table, the stock of a hot product split across rows so sales don't all update one row
+    """
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    # The stock of the shard held in carts, used instead of the product's reserved stock row
+    reserved = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Job(db.Model):
+    """
+    Class for the job table, a durable queue of work run in the background by the worker processes
+    """
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    idempotency_key = db.Column(db.String(200), unique=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    run_at = db.Column(db.DateTime, nullable=False)
+    locked_until = db.Column(db.DateTime)
+    # Changed each time the job is claimed, so a worker whose lease ran out can't change the job once it is reclaimed
+    claim_token = db.Column(db.String(32))
+    last_error = db.Column(db.Text)
+
+
+class SalesDay(db.Model):
+    """
+    Class for the sales day table, the orders placed and revenue taken each day
+    """
+    day = db.Column(db.Date, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    items = db.Column(db.Integer, nullable=False, default=0)
+    revenue_pence = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ProductSales(db.Model):
+    """
+    Class for the product sales table, the running totals sold of each product
+    """
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue_pence = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+
+class OrderStatusCount(db.Model):
+    """
+    Class for the order status count table, the number of orders with each status
+    """
+    status = db.Column(db.String(100), primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+
+
+class SignupDay(db.Model):
+    """
+    Class for the signup day table, the customers who joined each day
+    """
+    day = db.Column(db.Date, primary_key=True)
+    customers = db.Column(db.Integer, nullable=False, default=0)
+
+
+class PasswordAudit(db.Model):
+    """
+    Class for the password audit table, each run of the weak password audit
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    wordlist = db.Column(db.String(1000), nullable=False)
+    accounts_checked = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, default=lambda: datetime.datetime.now(datetime.UTC))
+    finished_at = db.Column(db.DateTime)
+    weak_accounts = db.relationship('WeakAccount', backref=db.backref('audit', lazy=True))
+
+
+class WeakAccount(db.Model):
+    """
+    Class for the weak account table, the accounts an audit found with a password from the wordlist
+    """
+    # The password found is never stored
+    audit_id = db.Column(db.Integer, db.ForeignKey('password_audit.id'), primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), primary_key=True)
+    customer = db.relationship('Customer')
@@ -0,0 +1,73 @@
+"""
+Money helpers, prices and totals are stored and added up as whole pence so they are always exact
+"""
+# Import statements
+from decimal import Decimal, ROUND_HALF_UP
+
+from sqlalchemy import func, select
+
+from main import app, db
+from main.models import Cart, Order, Product
+
+
+def to_pence(amount):
+    """
+    Function for converting an amount in pounds to pence
+    :param amount: The amount in pounds as a Decimal, string, integer or float
+    :return: The amount in pence as an integer, rounded to the nearest penny
+    """
+    # Going through the string stops a float like 0.285 being rounded down to 28 pence
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def format_money(pence):
+    """
+    Function for displaying an amount in pence as pounds
+    :param pence: The amount in pence
+    :return: The amount in pounds with 2 decimal places
+    """
+    return f'{Decimal(pence or 0).scaleb(-2):.2f}'
+
+
+@app.template_filter('money')
+def money_filter(pence):
+    """
+    Template filter for displaying an amount in pence as pounds
+    :param pence: The amount in pence
+    :return: The amount in pounds with 2 decimal places
+    """
+    return format_money(pence)
+
+
+def lines_total(items, products):
+    """
+    Function for adding up the cost of cart items that have already been loaded
+    :param items: The cart items
+    :param products: The products in the cart keyed by id
+    :return: The total in pence
+    """
+    return sum(products[item.product_id].price_pence * item.quantity for item in items)
+
+
+def cart_total(customer_id):
+    """
+    Function for adding up the cost of a customer's cart in the database without loading it
+    :param customer_id: The id of the customer
+    :return: The total in pence
+    """
+    return db.session.execute(
+        select(func.coalesce(func.sum(Cart.quantity * Product.price_pence), 0))
+        .join(Product, Product.id == Cart.product_id)
+        .where(Cart.customer_id == customer_id)
+    ).scalar_one()
+
+
+def orders_total(*criteria):
+    """
+    Function for adding up the value of orders in a single pass over the order table
+    :param criteria: Conditions the orders must meet, such as Order.status == 'Delivered'
+    :return: The total in pence
+    """
+    return db.session.execute(
+        select(func.coalesce(func.sum(Order.quantity * Order.price_pence), 0)).where(*criteria)
+    ).scalar_one()
@@ -0,0 +1,258 @@
+"""
+Weak password audit, checking every account's password against a list of common passwords
+
+bcrypt is slow on purpose, so the accounts are checked in parallel by a pool of processes, each account stops
+being checked at the first password that matches, and the audit is run by the job workers so it never holds up
+a web request. A wordlist too large to keep in memory is split into pieces, and each piece is checked against
+every account in a batch before the next is read, so each process reads the wordlist once per batch rather than
+once per account. Pieces are also small enough to check an account against in a fraction of the job's lease,
+which is renewed as the accounts are checked, so no other worker takes the audit while it is still running. The
+passwords found are never stored, only the accounts that have one.
+"""
+# Import statements
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import time
+
+import bcrypt
+from sqlalchemy import select, update
+
+from main import app, db
+from main.jobs import LeaseLost, heartbeat, job_handler, utc_now
+from main.models import Customer, PasswordAudit, WeakAccount
+from main.passwords import target_rounds
+
+# Audit statuses
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def iter_wordlist(path):
+    """
+    Function for reading the passwords in a wordlist one at a time, so a large wordlist is never held in memory
+    :param path: The path of the wordlist, one password per line
+    :return: A generator of the passwords
+    """
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            password = line.rstrip('\r\n')
+            if password:
+                yield password
+
+
+@functools.lru_cache(maxsize=8)
+def load_wordlist(path):
+    """
+    Function for reading a wordlist once and keeping it for every later check in this process
+    :param path: The path of the wordlist, one password per line
+    :return: A tuple of the passwords
+    """
+    return tuple(iter_wordlist(path))
+
+
+def wordlist_pieces(path, piece_bytes, piece_passwords):
+    """
+    Function for splitting a wordlist into pieces, each ending at the end of a line
+    :param path: The path of the wordlist
+    :param piece_bytes: The most bytes in a piece, unless its only line is longer
+    :param piece_passwords: The most lines in a piece
+    :return: A list of the start and end offset of each piece
+    """
+    pieces = []
+    start = end = lines = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if lines and (lines == piece_passwords or end + len(line) - start > piece_bytes):
+                pieces.append((start, end))
+                start, lines = end, 0
+            end += len(line)
+            lines += 1
+    if lines:
+        pieces.append((start, end))
+    return pieces
+
+
+def hash_seconds():
+    """
+    Function for measuring how long checking a password takes at the current bcrypt cost
+    :return: The number of seconds one check took
+    """
+    hashed = bcrypt.hashpw(b'password', bcrypt.gensalt(target_rounds()))
+    started = time.perf_counter()
+    bcrypt.checkpw(b'password', hashed)
+    return time.perf_counter() - started
+
+
+@functools.lru_cache(maxsize=1)
+def read_wordlist_piece(path, start, end):
+    """
+    Function for reading a piece of a wordlist, keeping the last piece read for the following checks in this process
+    :param path: The path of the wordlist
+    :param start: The offset the piece starts at
+    :param end: The offset the piece ends at
+    :return: A tuple of the passwords in the piece
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8', errors='ignore')
+    return tuple(password for password in (line.rstrip('\r') for line in text.split('\n')) if password)
+
+
+def is_weak(password_hash, path, start, end):
+    """
+    Function for checking if a password hash is of a password in a piece of the wordlist, run in the pool's processes
+    :param password_hash: The account's bcrypt hash
+    :param path: The path of the wordlist
+    :param start: The offset the piece of the wordlist starts at
+    :param end: The offset the piece of the wordlist ends at
+    :return: Boolean indicating if a password in the piece matches the hash
+    """
+    passwords = read_wordlist_piece(path, start, end)
+    try:
+        hashed = password_hash.encode('utf-8')
+        # Stop at the first match, there is no need to know more than one weak password
+        return any(bcrypt.checkpw(password.encode('utf-8'), hashed) for password in passwords)
+    except (AttributeError, ValueError):
+        # Not a bcrypt hash, so it can't be checked
+        return False
+
+
+def account_batches(batch_size):
+    """
+    Function for reading the accounts in batches ordered by id, so the whole table is never loaded at once
+    :param batch_size: The number of accounts in each batch
+    :return: A generator of lists of (customer id, password hash)
+    """
+    last_id = 0
+    while True:
+        batch = db.session.execute(
+            select(Customer.id, Customer.password_hash)
+            .where(Customer.id > last_id)
+            .order_by(Customer.id)
+            .limit(batch_size)
+        ).all()
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1][0]
+
+
+def weak_accounts(batch, path, pieces, executor):
+    """
+    Function for finding the accounts in a batch with a password in the wordlist, one piece of the wordlist at a time
+    The job's lease is renewed as the accounts are checked, as a batch can take longer than the lease
+    :param batch: The customer id and password hash of each account
+    :param path: The path of the wordlist
+    :param pieces: The start and end offset of each piece of the wordlist
+    :param executor: The pool of processes checking the hashes, or None to check them in this process
+    :return: The ids of the customers with a weak password
+    """
+    renew_every = app.config['JOB_LEASE_SECONDS'] / 3
+    renewed = time.monotonic()
+    weak_ids = []
+    unchecked = list(batch)
+    for start, end in pieces:
+        if not unchecked:
+            break
+        check = functools.partial(is_weak, path=path, start=start, end=end)
+        hashes = [password_hash for _, password_hash in unchecked]
+        # Accounts are sent to the pool one at a time, so their results come back as each one is checked
+        results = []
+        for result in (executor.map(check, hashes) if executor else map(check, hashes)):
+            results.append(result)
+            if time.monotonic() - renewed >= renew_every:
+                heartbeat()
+                renewed = time.monotonic()
+        weak_ids.extend(customer_id for (customer_id, _), result in zip(unchecked, results) if result)
+        # Accounts already found to be weak aren't checked against the later pieces
+        unchecked = [account for account, result in zip(unchecked, results) if not result]
+    return weak_ids
+
+
+def audit_passwords(audit_id, processes=None):
+    """
+    Function for running an audit, recording the weak accounts and progress after each batch of accounts
+    :param audit_id: The id of the audit
+    :param processes: The number of processes checking passwords, defaults to PASSWORD_AUDIT_PROCESSES
+    :return: The number of weak accounts found
+    """
+    audit = db.session.get(PasswordAudit, audit_id)
+    processes = processes or app.config['PASSWORD_AUDIT_PROCESSES'] or os.cpu_count() or 1
+    # Checking an account against a piece takes at most a third of the lease, so the lease is renewed in time
+    piece_passwords = max(int(app.config['JOB_LEASE_SECONDS'] / 3 / hash_seconds()), 1)
+    pieces = wordlist_pieces(audit.wordlist, app.config['PASSWORD_AUDIT_CACHE_BYTES'], piece_passwords)
+    # Start again from the beginning if an earlier attempt at the audit failed part way through
+    WeakAccount.query.filter_by(audit_id=audit_id).delete()
+    audit.accounts_checked = 0
+    audit.status = RUNNING
+    db.session.commit()
+    executor = None
+    if processes > 1:
+        # The forked processes only hash passwords and never use the database connections they inherit
+        executor = concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'))
+    weak = 0
+    try:
+        for batch in account_batches(app.config['PASSWORD_AUDIT_BATCH_SIZE']):
+            weak_ids = weak_accounts(batch, audit.wordlist, pieces, executor)
+            if weak_ids:
+                db.session.add_all(WeakAccount(audit_id=audit_id, customer_id=customer_id) for customer_id in weak_ids)
+            weak += len(weak_ids)
+            db.session.execute(
+                update(PasswordAudit)
+                .where(PasswordAudit.id == audit_id)
+                .values(accounts_checked=PasswordAudit.accounts_checked + len(batch))
+            )
+            db.session.commit()
+            # Keep the job's lease while the audit is still making progress
+            heartbeat()
+    except LeaseLost:
+        # Another worker has taken over the audit and its progress
+        db.session.rollback()
+        raise
+    except Exception:
+        db.session.rollback()
+        db.session.execute(update(PasswordAudit).where(PasswordAudit.id == audit_id)
+                           .values(status=FAILED, finished_at=utc_now()))
+        db.session.commit()
+        raise
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    db.session.execute(update(PasswordAudit).where(PasswordAudit.id == audit_id)
+                       .values(status=DONE, finished_at=utc_now()))
+    db.session.commit()
+    return weak
+
+
+def start_audit(wordlist=None):
+    """
+    Function for creating an audit, the caller runs it or queues it
+    :param wordlist: The path of the wordlist, defaults to PASSWORD_AUDIT_WORDLIST
+    :return: The audit
+    """
+    audit = PasswordAudit(status=QUEUED, wordlist=wordlist or app.config['PASSWORD_AUDIT_WORDLIST'])
+    db.session.add(audit)
+    db.session.flush()
+    return audit
+
+
+@job_handler('password_audit')
+def run_audit_job(audit_id):
+    """
+    Job for running an audit in a background worker
+    :param audit_id: The id of the audit
+    :return:
+    """
+    audit_passwords(audit_id)
+
+
+def latest_audit():
+    """
+    Function for getting the most recent audit and the accounts it found
+    :return: The audit, or None if no audit has been run
+    """
+    return PasswordAudit.query.order_by(PasswordAudit.id.desc()).first()
@@ -0,0 +1,77 @@
+"""
+Password hashing cost, chosen to fit the time a login can spend hashing on this hardware
+"""
+# Import statements
+import time
+
+from main import app, bcrypt
+
+# The lowest and highest costs bcrypt accepts
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+
+
+def target_rounds():
+    """
+    Function for getting the cost new password hashes are made with
+    :return: The cost as a number of log2 rounds
+    """
+    return app.config['BCRYPT_LOG_ROUNDS']
+
+
+def hash_cost(password_hash):
+    """
+    Function for reading the cost a bcrypt hash was made with
+    :param password_hash: The hash in the form $2b$12$...
+    :return: The cost as a number of log2 rounds, or None if the hash isn't a bcrypt hash
+    """
+    try:
+        return int(password_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def needs_rehash(password_hash):
+    """
+    Function for checking if a hash was made with a different cost to the current one
+    :param password_hash: The stored hash
+    :return: Boolean indicating if the password should be hashed again
+    """
+    return hash_cost(password_hash) != target_rounds()
+
+
+def measure_hash_time(rounds, samples=3):
+    """
+    Function for timing how long hashing a password takes at a cost
+    :param rounds: The cost as a number of log2 rounds
+    :param samples: The number of hashes timed, the fastest is used
+    :return: The time in milliseconds
+    """
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        bcrypt.generate_password_hash('calibration password', rounds)
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def calibrate(target_ms, samples=3, max_rounds=20):
+    """
+    Function for finding the highest cost whose hashes take no longer than the target time
+    :param target_ms: The most milliseconds a hash should take
+    :param samples: The number of hashes timed at each cost
+    :param max_rounds: The highest cost tried
+    :return: The chosen cost and a list of the cost and time of each measurement
+    """
+    measurements = []
+    chosen = MIN_ROUNDS
+    for rounds in range(MIN_ROUNDS, min(max_rounds, MAX_ROUNDS) + 1):
+        elapsed = measure_hash_time(rounds, samples)
+        measurements.append((rounds, elapsed))
+        if elapsed > target_ms:
+            break
+        chosen = rounds
+        # Each extra round doubles the time, so stop once the next one is sure to be too slow
+        if elapsed * 2 > target_ms * 1.5:
+            break
+    return chosen, measurements
@@ -0,0 +1,43 @@
+"""
+Payments for orders, taken in the background by the job queue
+"""
+# Import statements
+import uuid
+
+from main import app
+from main.jobs import job_handler
+from main.models import Order
+
+# The payment id of an order before its payment has been taken
+PAYMENT_PENDING = 'pending'
+
+
+def charge(customer_id, amount_pence, idempotency_key):
+    """
+    Function standing in for the payment provider, it accepts every payment
+    :param customer_id: The id of the customer paying
+    :param amount_pence: The amount to take in pence
+    :param idempotency_key: A key identifying the payment so retrying it doesn't charge twice
+    :return: The payment id
+    """
+    app.logger.info('Taking payment of %s pence from customer %s', amount_pence, customer_id)
+    # The same key always gives the same payment id, like a real provider would
+    return f'stub_{uuid.uuid5(uuid.NAMESPACE_URL, idempotency_key).hex}'
+
+
+@job_handler('take_payment')
+def take_payment(order_ids, customer_id, amount_pence):
+    """
+    Function for taking the payment for an order and recording the payment id
+    :param order_ids: The ids of the order rows placed together
+    :param customer_id: The id of the customer paying
+    :param amount_pence: The amount to take in pence
+    :return:
+    """
+    orders = Order.query.filter(Order.id.in_(order_ids), Order.payment_id == PAYMENT_PENDING).all()
+    # Nothing to do if the payment has already been recorded
+    if not orders:
+        return
+    payment_id = charge(customer_id, amount_pence, f'orders-{min(order_ids)}')
+    for order in orders:
+        order.payment_id = payment_id
@@ -0,0 +1,119 @@
+"""
+Read-through cache of the product details that rarely change, shared by the requests each worker process handles
+
+Products are kept as small records, without the stock, which changes with every sale and is always read from the
+database so checkout never sees a stale quantity. The least recently used products are evicted when the cache is
+full. The cache is emptied whenever the catalogue version changes, which happens on every committed write to the
+product table in any process other than a change to only the stock, such as a sale, so a product is never served
+after it has been changed or deleted.
+"""
+# Import statements
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from main import app, db
+from main.cache import catalogue_version
+from main.models import Product
+
+
+class CachedProduct:
+    """Class for the cached details of a product"""
+
+    # Slots keep each record small and stop attributes being added to a record that is shared between requests
+    __slots__ = ('id', 'name', 'price_pence', 'description', 'product_image', 'date_added')
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f'<CachedProduct {self.id} {self.name!r}>'
+
+
+# The columns read for each record, in the order of its slots
+CACHED_COLUMNS = tuple(getattr(Product, name) for name in CachedProduct.__slots__)
+
+
+class ProductCache:
+    """Class for looking up products by id, reading the ones that aren't cached from the database"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.products = OrderedDict()
+        # The catalogue version the cached products were read at
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """
+        Function for removing every product from the cache
+        :return:
+        """
+        with self.lock:
+            self.products.clear()
+            self.version = None
+
+    def get(self, product_id):
+        """
+        Function for getting a product
+        :param product_id: The id of the product
+        :return: The product, or None if it doesn't exist
+        """
+        return self.get_many([product_id]).get(product_id)
+
+    def get_many(self, product_ids):
+        """
+        Function for getting several products, reading the ones that aren't cached in one query
+        :param product_ids: The ids of the products
+        :return: A dictionary of the products keyed by id, products that don't exist are left out
+        """
+        product_ids = list(dict.fromkeys(product_ids))
+        # Products changed by this session and not yet committed are read from the database and not cached, so
+        # the request sees its own changes and nothing is cached that could still be rolled back
+        if db.session.info.get('catalogue_changed'):
+            return read_products(product_ids)
+        version = catalogue_version()
+        found = {}
+        missing = []
+        with self.lock:
+            if version != self.version:
+                self.products.clear()
+                self.version = version
+            for product_id in product_ids:
+                product = self.products.get(product_id)
+                if product is None:
+                    missing.append(product_id)
+                else:
+                    self.products.move_to_end(product_id)
+                    found[product_id] = product
+            self.hits += len(found)
+            self.misses += len(missing)
+        if missing:
+            loaded = read_products(missing)
+            with self.lock:
+                # Keep them unless another lookup found a newer catalogue version while they were read
+                if version == self.version:
+                    self.products.update(loaded)
+                    while len(self.products) > self.max_size:
+                        self.products.popitem(last=False)
+            found.update(loaded)
+        return {product_id: found[product_id] for product_id in product_ids if product_id in found}
+
+
+def read_products(product_ids):
+    """
+    Function for reading products from the database
+    :param product_ids: The ids of the products
+    :return: A dictionary of the products keyed by id
+    """
+    if not product_ids:
+        return {}
+    rows = db.session.execute(select(*CACHED_COLUMNS).where(Product.id.in_(product_ids))).all()
+    return {row.id: CachedProduct(*row) for row in rows}
+
+
+product_cache = ProductCache(app.config['PRODUCT_CACHE_SIZE'])
@@ -0,0 +1,133 @@
+"""
+Typo tolerant product search
+
+Product names are split into trigrams, the three character sequences of each word padded with spaces, and the
+index maps each trigram to the products whose names contain it. A search looks up the trigrams of the query,
+counts how many of them each product shares and ranks the products by the fraction of the query's trigrams they
+contain, so "aple watch" still finds Apple Watch. Each worker process keeps the index in memory, with the products
+listed in arrays of integers, and rebuilds it when products are added, renamed or deleted in any process.
+"""
+# Import statements
+import re
+import threading
+from array import array
+from collections import Counter, defaultdict
+
+from sqlalchemy import select
+
+from main import app, db
+from main.cache import product_names_version
+from main.models import Product
+
+WORD = re.compile(r'\w+')
+
+
+def trigrams(text):
+    """
+    Function for splitting text into the trigrams of its words, ignoring case and punctuation
+    :param text: The text
+    :return: The set of trigrams
+    """
+    grams = set()
+    for word in WORD.findall(text.lower()):
+        # Two spaces before and one after each word, so the start of a word counts for more than its end
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    """Class for finding products by the trigrams of their names"""
+
+    def __init__(self, products):
+        # Products are numbered by their position in these arrays, which is what the postings list
+        self.ids = array('q')
+        self.sizes = array('I')
+        # Lower case names, for matching the query as a substring like the search did before
+        self.names = []
+        postings = defaultdict(list)
+        for position, (product_id, name) in enumerate(products):
+            grams = trigrams(name)
+            self.ids.append(product_id)
+            self.sizes.append(len(grams))
+            self.names.append(name.lower())
+            for gram in grams:
+                postings[gram].append(position)
+        self.postings = {gram: array('I', positions) for gram, positions in postings.items()}
+
+    def search(self, query, min_score):
+        """
+        Function for finding the products whose names are most like the query
+        :param query: The search query
+        :param min_score: The fraction of the query's trigrams a name must contain to match
+        :return: The ids of the matching products, best match first
+        """
+        grams = trigrams(query)
+        if not grams:
+            return []
+        # Count the trigrams each product shares with the query, only products sharing one are looked at
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        text = query.lower()
+        ranked = []
+        for position, count in shared.items():
+            score = count / len(grams)
+            if score >= min_score or text in self.names[position]:
+                # Between equal scores, names with fewer trigrams that aren't in the query are more alike
+                similarity = count / (len(grams) + self.sizes[position] - count)
+                ranked.append((-score, -similarity, self.ids[position]))
+        ranked.sort()
+        return [product_id for _, _, product_id in ranked]
+
+
+class SearchIndex:
+    """Class for holding the index of the current product names, rebuilt when they change"""
+
+    def __init__(self):
+        self.index = None
+        # The product names version the index was built at
+        self.version = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Function for getting the index, rebuilding it if product names have changed since it was built
+        :return: The index
+        """
+        version = product_names_version()
+        with self.lock:
+            if version != self.version:
+                # The version is read before the names, so names changed while they are read are picked up next time
+                rows = db.session.execute(select(Product.id, Product.name).order_by(Product.id)).all()
+                self.index = TrigramIndex(rows)
+                self.version = version
+            return self.index
+
+    def clear(self):
+        """
+        Function for throwing away the index so it is rebuilt when it is next used
+        :return:
+        """
+        with self.lock:
+            self.index = None
+            self.version = None
+
+
+search_index = SearchIndex()
+
+
+def search_products(query):
+    """
+    Function for finding the products matching a search, allowing for typing mistakes
+    :param query: The search query
+    :return: The matching products, best match first
+    """
+    # The trigrams of a query of one or two characters are mostly padding, so it is matched as a substring
+    if len(query.strip()) < 3:
+        return Product.query.filter(Product.name.ilike(f'%{query}%')).all()
+    product_ids = search_index.get().search(query.strip(), app.config['SEARCH_MIN_SCORE'])
+    if not product_ids:
+        return []
+    products = {product.id: product for product in Product.query.filter(Product.id.in_(product_ids))}
+    return [products[product_id] for product_id in product_ids if product_id in products]
@@ -0,0 +1,77 @@
+"""
+Query plan checks, finding the queries that read a whole table instead of using an index
+"""
+# Import statements
+from sqlalchemy import event
+
+from main import db
+
+# Statements whose plans are checked, inserts don't search a table
+CHECKED_STATEMENTS = ('SELECT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def explain(connection, statement, parameters=()):
+    """
+    Function for getting the query plan SQLite chooses for a statement
+    :param connection: The database connection
+    :param statement: The SQL of the statement
+    :param parameters: The parameters of the statement
+    :return: A list of the steps of the plan
+    """
+    rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+    return [row[-1] for row in rows]
+
+
+def full_scans(plan):
+    """
+    Function for finding the steps of a query plan that read every row of a table
+    :param plan: The steps of the query plan
+    :return: A list of the steps that scan a table without an index
+    """
+    # An index scan such as 'SCAN product USING INDEX ix_product_date_added' reads the rows in order
+    return [step for step in plan
+            if step.startswith('SCAN ') and ' USING ' not in step and step != 'SCAN CONSTANT ROW']
+
+
+class QueryPlanRecorder:
+    """Class for recording the statements run while it is active and checking their query plans"""
+
+    def __init__(self, engine=None):
+        self.engine = engine or db.engine
+        self.statements = {}
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def record(self, connection, cursor, statement, parameters, context, executemany):
+        """
+        Function for recording a statement as it is run
+        :param connection: The database connection
+        :param cursor: The database cursor
+        :param statement: The SQL of the statement
+        :param parameters: The parameters of the statement
+        :param context: The execution context
+        :param executemany: Boolean indicating if the statement is run once for each set of parameters
+        :return:
+        """
+        if statement.lstrip().upper().startswith(CHECKED_STATEMENTS):
+            # The plan doesn't depend on the values so the first parameters are kept for each statement
+            self.statements.setdefault(statement, parameters[0] if executemany else parameters)
+
+    def full_scans(self):
+        """
+        Function for checking the plans of the recorded statements
+        :return: A dictionary of the full table scans keyed by the statement that does them
+        """
+        scans = {}
+        # The session's connection sees the same tables and uncommitted changes the statements did
+        connection = db.session.connection()
+        for statement, parameters in self.statements.items():
+            steps = full_scans(explain(connection, statement, parameters))
+            if steps:
+                scans[statement] = steps
+        return scans
@@ -0,0 +1,235 @@
+"""
+Token bucket rate limits for the endpoints that hash passwords
+
+Each limit is a bucket of tokens per client IP address or per account that refills at a steady rate.
+Every request takes a token and is rejected when the bucket is empty. Limits are checked before the view
+runs, so a rejected request never queries the database or hashes a password. Behind reverse proxies, the client
+address is read from the X-Forwarded-For header set by the number of proxies in TRUSTED_PROXIES.
+"""
+# Import statements
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from flask import request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from main import app
+
+
+class MemoryStore:
+    """Class for keeping the buckets in this process"""
+
+    def __init__(self, max_keys=100000):
+        self.buckets = {}
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        """
+        Function for taking a token from a bucket
+        :param key: The bucket key
+        :param capacity: The most tokens the bucket holds
+        :param rate: The tokens added each second
+        :param now: The current time in seconds
+        :return: The number of seconds until a token is available, 0 if one was taken
+        """
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens, wait = refill_and_take(tokens, updated, capacity, rate, now)
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.prune()
+            return wait
+
+    def prune(self):
+        """
+        Function for forgetting the least recently used half of the buckets, the lock must be held
+        :return:
+        """
+        by_age = sorted(self.buckets, key=lambda key: self.buckets[key][1])
+        for key in by_age[:len(by_age) // 2]:
+            del self.buckets[key]
+
+    def reset(self):
+        """
+        Function for emptying the store
+        :return:
+        """
+        with self.lock:
+            self.buckets.clear()
+
+
+class SQLiteStore:
+    """Class for keeping the buckets in a SQLite file shared by every worker process on the host"""
+
+    def __init__(self, path, max_age=60 * 60, prune_interval=60):
+        self.path = path
+        # A bucket unused for longer than the longest limit has refilled, and is the same as no bucket at all
+        self.max_age = max_age
+        self.prune_interval = prune_interval
+        self.pruned_at = None
+        self.local = threading.local()
+
+    def connection(self):
+        """
+        Function for getting this thread's connection, creating the table the first time
+        :return: The connection
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # Transactions are started explicitly so taking a token is atomic across processes
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket '
+                               '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self.local.connection = connection
+        return connection
+
+    def take(self, key, capacity, rate, now):
+        """
+        Function for taking a token from a bucket
+        :param key: The bucket key
+        :param capacity: The most tokens the bucket holds
+        :param rate: The tokens added each second
+        :param now: The current time in seconds
+        :return: The number of seconds until a token is available, 0 if one was taken
+        """
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens, wait = refill_and_take(tokens, updated, capacity, rate, now)
+            connection.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                               (key, tokens, now))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        if self.pruned_at is None or now - self.pruned_at >= self.prune_interval:
+            self.prune(now)
+        return wait
+
+    def prune(self, now):
+        """
+        Function for removing the buckets that have refilled since they were last used
+        :param now: The current time in seconds
+        :return: The number of buckets removed
+        """
+        self.pruned_at = now
+        return self.connection().execute('DELETE FROM bucket WHERE updated < ?', (now - self.max_age,)).rowcount
+
+    def reset(self):
+        """
+        Function for emptying the store
+        :return:
+        """
+        self.connection().execute('DELETE FROM bucket')
+
+
+def refill_and_take(tokens, updated, capacity, rate, now):
+    """
+    Function for refilling a bucket for the time since it was last used and taking a token
+    :param tokens: The tokens in the bucket when it was last used
+    :param updated: The time the bucket was last used
+    :param capacity: The most tokens the bucket holds
+    :param rate: The tokens added each second
+    :param now: The current time in seconds
+    :return: The tokens left and the seconds until a token is available, 0 if one was taken
+    """
+    tokens = min(capacity, tokens + max(now - updated, 0) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+store_lock = threading.Lock()
+stores = {}
+
+
+def get_store():
+    """
+    Function for getting the store configured by RATE_LIMIT_STORAGE
+    :return: A SQLite store if a file is configured, otherwise a store in this process
+    """
+    path = app.config['RATE_LIMIT_STORAGE']
+    with store_lock:
+        if path not in stores:
+            if path:
+                max_age = max((seconds for limits in app.config['RATE_LIMITS'].values()
+                               for _, _, seconds, _ in limits), default=0)
+                stores[path] = SQLiteStore(path, max_age, app.config['RATE_LIMIT_PRUNE_INTERVAL'])
+            else:
+                stores[path] = MemoryStore(app.config['RATE_LIMIT_MAX_KEYS'])
+        return stores[path]
+
+
+def configure_proxies():
+    """
+    Function for taking the client address from the headers set by the TRUSTED_PROXIES reverse proxies
+    :return:
+    """
+    wsgi_app = app.wsgi_app.app if isinstance(app.wsgi_app, ProxyFix) else app.wsgi_app
+    proxies = app.config['TRUSTED_PROXIES']
+    app.wsgi_app = ProxyFix(wsgi_app, x_for=proxies, x_proto=proxies) if proxies else wsgi_app
+
+
+def client_key(scope):
+    """
+    Function for getting the key a request is counted against for a scope
+    :param scope: ip to count requests from the same address, account to count requests for the same email
+    :return: The key, or None if the request has nothing to count in that scope
+    """
+    if scope == 'ip':
+        return f'ip:{request.remote_addr}'
+    if scope == 'account':
+        # The account is the email submitted in the form or JSON body, so no query is needed to find it
+        email = request.form.get('email') or (request.get_json(silent=True) or {}).get('email')
+        email = email.strip().lower() if isinstance(email, str) else ''
+        return f'account:{email}' if email else None
+    raise ValueError(f'Unknown rate limit scope {scope}')
+
+
+def check_rate_limits(endpoint):
+    """
+    Function for taking a token from each bucket the request counts against
+    :param endpoint: The endpoint being requested
+    :return: The seconds until the request would be allowed, 0 if it is allowed
+    """
+    limits = app.config['RATE_LIMITS'].get(endpoint, ())
+    if not limits:
+        return 0
+    store = get_store()
+    now = time.time()
+    wait = 0
+    for scope, requests, seconds, methods in limits:
+        key = client_key(scope) if request.method in methods else None
+        if key is not None:
+            wait = max(wait, store.take(f'{endpoint}:{key}', requests, requests / seconds, now))
+    return wait
+
+
+@app.before_request
+def enforce_rate_limits():
+    """
+    Function for rejecting requests over their rate limit before the view runs
+    :return: A 429 response if the request is over a limit, otherwise None
+    """
+    if not app.config['RATE_LIMIT_ENABLED'] or request.endpoint is None:
+        return None
+    wait = check_rate_limits(request.endpoint)
+    if not wait:
+        return None
+    app.logger.warning('Rate limit exceeded for %s from %s', request.endpoint, request.remote_addr)
+    # A plain response so nothing is loaded from the database to render it
+    response = app.response_class('Too many requests, please try again later', status=429, mimetype='text/plain')
+    response.headers['Retry-After'] = str(math.ceil(wait))
+    return response
+
+
+configure_proxies()
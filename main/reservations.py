@@ -0,0 +1,248 @@
+"""
+Stock reservations, holding stock for items in a customer's cart until checkout or the hold expires
+"""
+# Import statements
+import datetime
+import threading
+import time
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from main import app, db
+from main.models import Product, ReservedStock, StockHold
+from main.stock_shards import (on_hand, release_from_shards, reserve_in_shards, reserved_stock, sell_from_shards,
+                               sync_sharded_totals)
+
+
+class OutOfStockError(Exception):
+    """Class for when there isn't enough unreserved stock of a product"""
+
+
+def utc_now():
+    """
+    Function for getting the current time
+    :return: The current time in UTC
+    """
+    return datetime.datetime.now(datetime.UTC)
+
+
+def available_to_sell(product_id):
+    """
+    Function for getting the stock of a product that isn't held in a cart
+    :param product_id: The id of the product
+    :return: The available stock
+    """
+    # The stock and reserved stock are looked up by key so no holds are scanned
+    return db.session.execute(
+        select(on_hand(product_id) - reserved_stock(product_id))
+    ).scalar_one_or_none() or 0
+
+
+def increase_reserved_stock(product_id, quantity):
+    """
+    Function for adding to the reserved stock of a product if enough stock is available
+    :param product_id: The id of the product
+    :param quantity: The amount to reserve
+    :return: Boolean indicating if the stock was reserved
+    """
+    # Hot products hold the stock in one of their shards instead of the reserved stock row
+    reserved = reserve_in_shards(product_id, quantity)
+    if reserved is not None:
+        return reserved
+    db.session.execute(insert(ReservedStock).values(product_id=product_id, quantity=0).on_conflict_do_nothing())
+    # The check and the increase are one statement so concurrent reservations can't oversell
+    result = db.session.execute(
+        update(ReservedStock)
+        .where(ReservedStock.product_id == product_id, ReservedStock.quantity + quantity <= on_hand(product_id))
+        .values(quantity=ReservedStock.quantity + quantity)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+def decrease_reserved_stock(product_id, quantity):
+    """
+    Function for taking released stock off the reserved stock of a product
+    :param product_id: The id of the product
+    :param quantity: The amount released
+    :return:
+    """
+    if release_from_shards(product_id, quantity) is not None:
+        return
+    db.session.execute(
+        update(ReservedStock)
+        .where(ReservedStock.product_id == product_id)
+        .values(quantity=ReservedStock.quantity - quantity)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def reserve(customer_id, product_id, quantity=1):
+    """
+    Function for holding stock of a product for a customer's cart, the caller commits the change
+    :param customer_id: The id of the customer
+    :param product_id: The id of the product
+    :param quantity: The amount to hold
+    :raises: OutOfStockError: if there isn't enough unreserved stock
+    :return:
+    """
+    if not increase_reserved_stock(product_id, quantity):
+        # Release any expired holds on the product before giving up
+        if not reap_expired_holds(product_id=product_id) or not increase_reserved_stock(product_id, quantity):
+            raise OutOfStockError(f'Not enough stock of product {product_id}')
+    statement = insert(StockHold).values(
+        customer_id=customer_id,
+        product_id=product_id,
+        quantity=quantity,
+        expires_at=utc_now() + datetime.timedelta(seconds=app.config['STOCK_HOLD_SECONDS'])
+    )
+    # Add to the customer's existing hold and extend it
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[StockHold.customer_id, StockHold.product_id],
+        set_={'quantity': StockHold.quantity + statement.excluded.quantity,
+              'expires_at': statement.excluded.expires_at}
+    ))
+
+
+def release(customer_id, product_id, quantity=None):
+    """
+    Function for releasing stock held for a customer's cart, the caller commits the change
+    :param customer_id: The id of the customer
+    :param product_id: The id of the product
+    :param quantity: The amount to release, or None to release the whole hold
+    :return: The amount released
+    """
+    hold = StockHold.query.filter_by(customer_id=customer_id, product_id=product_id).first()
+    if hold is None:
+        return 0
+    released = hold.quantity if quantity is None else min(quantity, hold.quantity)
+    decrease_reserved_stock(product_id, released)
+    hold.quantity -= released
+    if hold.quantity <= 0:
+        db.session.delete(hold)
+    return released
+
+
+def sell(customer_id, product_id, quantity):
+    """
+    Function for turning the stock held for a customer into a sale, the caller commits the change
+    :param customer_id: The id of the customer
+    :param product_id: The id of the product
+    :param quantity: The amount sold
+    :raises: OutOfStockError: if the hold is too small and there isn't enough unreserved stock to cover it
+    :return:
+    """
+    hold = StockHold.query.filter_by(customer_id=customer_id, product_id=product_id).first()
+    held = hold.quantity if hold else 0
+    if held < quantity:
+        # The hold expired or was never placed, so try to hold the rest now
+        reserve(customer_id, product_id, quantity - held)
+    elif held > quantity:
+        release(customer_id, product_id, held - quantity)
+    # Hot products take the stock and its reservation from one of their shards instead of the product row
+    sold = sell_from_shards(product_id, quantity)
+    if sold is None:
+        decrease_reserved_stock(product_id, quantity)
+        result = db.session.execute(
+            update(Product)
+            .where(Product.id == product_id, Product.quantity >= quantity)
+            .values(quantity=Product.quantity - quantity)
+            .execution_options(synchronize_session=False)
+        )
+        sold = result.rowcount == 1
+    if not sold:
+        raise OutOfStockError(f'Not enough stock of product {product_id}')
+    db.session.execute(delete(StockHold).where(StockHold.customer_id == customer_id,
+                                               StockHold.product_id == product_id))
+
+
+def reap_expired_holds(batch_size=None, product_id=None):
+    """
+    Function for releasing a batch of expired holds, the caller commits the change
+    :param batch_size: The most holds released at once
+    :param product_id: Only release the holds on this product
+    :return: The number of holds released
+    """
+    query = select(StockHold.id, StockHold.product_id, StockHold.quantity).where(StockHold.expires_at <= utc_now())
+    if product_id is not None:
+        query = query.where(StockHold.product_id == product_id)
+    expired = db.session.execute(
+        query.order_by(StockHold.expires_at).limit(batch_size or app.config['STOCK_HOLD_REAP_BATCH_SIZE'])
+    ).all()
+    if not expired:
+        return 0
+    released = {}
+    for _, hold_product_id, quantity in expired:
+        released[hold_product_id] = released.get(hold_product_id, 0) + quantity
+    for hold_product_id, quantity in released.items():
+        decrease_reserved_stock(hold_product_id, quantity)
+    db.session.execute(
+        delete(StockHold)
+        .where(StockHold.id.in_([hold_id for hold_id, _, _ in expired]))
+        .execution_options(synchronize_session='fetch')
+    )
+    return len(expired)
+
+
+def sweep_expired_holds():
+    """
+    Function for releasing every expired hold, committing after each batch
+    :return: The number of holds released
+    """
+    batch_size = app.config['STOCK_HOLD_REAP_BATCH_SIZE']
+    total = 0
+    while True:
+        reaped = reap_expired_holds(batch_size)
+        db.session.commit()
+        total += reaped
+        if reaped < batch_size:
+            return total
+
+
+def sweep():
+    """
+    Function for the background housekeeping of stock, releasing expired holds and refreshing sharded totals
+    :return:
+    """
+    sweep_expired_holds()
+    sync_sharded_totals()
+    db.session.commit()
+
+
+def run_hold_sweeper(interval):
+    """
+    Function for sweeping expired holds in the background until the process exits
+    :param interval: The number of seconds between sweeps
+    :return:
+    """
+    while True:
+        time.sleep(interval)
+        with app.app_context():
+            try:
+                sweep()
+            except Exception:  # pylint: disable=broad-exception-caught
+                # Keep the sweeper running, the holds will be swept next time
+                app.logger.exception('Sweeping stock failed')
+                db.session.rollback()
+
+
+sweeper_lock = threading.Lock()
+sweeper_thread = None
+
+
+@app.before_request
+def start_hold_sweeper():
+    """
+    Function for starting the background sweeper in each worker process when it serves its first request
+    :return:
+    """
+    global sweeper_thread  # pylint: disable=global-statement
+    interval = app.config['STOCK_HOLD_SWEEP_INTERVAL']
+    if sweeper_thread is not None or not interval or app.testing:
+        return
+    with sweeper_lock:
+        if sweeper_thread is None:
+            sweeper_thread = threading.Thread(target=run_hold_sweeper, args=(interval,),
+                                              name='stock-hold-sweeper', daemon=True)
+            sweeper_thread.start()
@@ -2,20 +2,35 @@
 Routes of the application
 """
 # Import statements
+import io
 import os
 
-from flask import render_template, redirect, url_for, flash, request, send_from_directory, jsonify
+from flask import (render_template, redirect, url_for, flash, request, send_from_directory, jsonify,
+                   stream_with_context)
 from flask_login import login_user, logout_user, login_required, current_user
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
 
 from main import app, db
-from main.forms import RegisterForm, LoginForm, ChangePasswordForm, ShopItemsForm, OrderForm
+from main.bulk import bulk_update_products, bulk_update_order_status
+from main.cache import cached_catalogue_page
+from main.checkout import checkout
+from main.exports import ExportError, export_lines, parse_date
+from main.forms import (RegisterForm, LoginForm, ChangePasswordForm, ShopItemsForm, OrderForm,
+                        ImportProductsForm, BulkProductUpdateForm, BulkOrderStatusForm, PasswordAuditForm, parse_ids)
+from main.imports import ImageSource, import_products, iter_rows
+from main.jobs import enqueue
+from main.migrations import upgrade
 from main.models import Product, Customer, Cart, Order
-
-
-class CustomException(Exception):
-    """Class for custom exceptions"""
+from main.money import cart_total, format_money, lines_total, to_pence
+from main.password_audit import latest_audit, load_wordlist, start_audit
+from main.product_cache import product_cache
+from main.product_search import search_products
+from main.reservations import OutOfStockError, reserve, release
+from main.sales import dashboard, record_signup, record_status_change
+from main.stock_shards import respread_changed_shards, sharded_totals, sync_sharded_totals
+from main.streaming import keyset_rows, stream_page
 
 
 # Constants
@@ -23,9 +38,10 @@ ACCESS_DENIED_HTML = 'access-denied.html'
 ADMIN_EMAIL = 'admin@admin.com'
 API_PUBLISHABLE_KEY = os.getenv("API_PUBLISHABLE_KEY")
 API_TOKEN = os.getenv("API_TOKEN")
-# Creating the tables if they don't exist
-with app.app_context():
-    db.create_all()
+# Bring the database up to date when the app starts, unless migrations are run as a separate step
+if app.config['MIGRATE_ON_STARTUP']:
+    with app.app_context():
+        upgrade()
 
 
 @app.route('/media/<path:filename>')
@@ -41,6 +57,7 @@ def get_image(filename):
 
 @app.route('/')
 @app.route('/home')
+@cached_catalogue_page
 def home_page():
     """
     Home Api
@@ -51,15 +68,15 @@ def home_page():
     Response:
         If successful, returns 200 status code
 
+        If the page hasn't changed since the ETag sent in If-None-Match, returns 304 status code
+
     Example request:
         GET http://127.0.0.1:5000/
 
     """
     items = Product.query.all()
-    return render_template("home.html",
-                           items=items,
-                           cart=Cart.query.filter_by(customer_id=current_user.id).all()
-                           if current_user.is_authenticated else [])  # Get the users cart
+    # Sharded products' stock is read from their shards, which sales change without touching the product
+    return render_template("home.html", items=items, stock=sharded_totals())
 
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -96,6 +113,8 @@ def register_page():
 
         Then if the registration is successful you are redirected to the home page
 
+        The account is inserted straight away and a taken username or email is reported when the insert fails
+
         Otherwise the user is alert there has been an error creating the account
     """
     form = RegisterForm()
@@ -113,18 +132,25 @@ def register_page():
             customer.username = username
             customer.email = email
             customer.password = confirm_password
-            # Add new user to the customers table
+            # Add new user to the customers table, the unique constraints reject a taken username or email
             db.session.add(customer)
-            db.session.commit()
-            # Automatically log in the user after registering
-            login_user(customer)
-            # Notify the user they have created an account and logged in
-            flash(
-                f'Account created successfully! You are now logged in as {customer.username}',
-                category='success'
-            )
-            # Redirect the user to the home page after logging in
-            return redirect(url_for('home_page'))
+            try:
+                record_signup()
+                db.session.commit()
+            except IntegrityError as error:
+                db.session.rollback()
+                # Find out which of the username and email is taken
+                form.check_available(error)
+            else:
+                # Automatically log in the user after registering
+                login_user(customer)
+                # Notify the user they have created an account and logged in
+                flash(
+                    f'Account created successfully! You are now logged in as {customer.username}',
+                    category='success'
+                )
+                # Redirect the user to the home page after logging in
+                return redirect(url_for('home_page'))
     # If there are errors alert the user
     if form.errors != {}:
         for err_msg in form.errors.values():
@@ -171,6 +197,8 @@ def login_page():
         # Login the user if the credentials are correct
         attempted_user = Customer.query.filter_by(email=form.email.data).first()
         if attempted_user and attempted_user.verify_password(password=form.password.data):
+            # Save the password hash if it was made again with the current cost
+            db.session.commit()
             login_user(attempted_user)
             # Alter the user they are logged in
             flash(f'You are now logged in as: {attempted_user.username}', category='success')
@@ -284,6 +312,8 @@ def change_password_page(customer_id):
             # Check the new password
             if new_password == confirm_password:
                 customer.password = confirm_password
+                # Revoke the API tokens issued with the old password
+                customer.token_generation += 1
                 # Update the password
                 db.session.commit()
                 # Alert the user the password has been changed
@@ -295,6 +325,10 @@ def change_password_page(customer_id):
         else:
             # Alert the user if the current password is incorrect
             flash('Current password is incorrect', category='danger')
+    # If there are errors, alert the user
+    if form.errors != {}:
+        for err_msg in form.errors.values():
+            flash(f'There was an error with updating the password: {err_msg}', category='danger')
     # Load the change password page if the user has been verified
     if current_user.id == customer_id:
         return render_template('change-password.html', form=form)
@@ -348,7 +382,7 @@ def create_product():
         if form.validate_on_submit():
             # Create a new product using the data from the form
             product_name = form.product_name.data
-            price = form.price.data
+            price_pence = to_pence(form.price.data)
             quantity = form.quantity.data
             description = form.description.data
             file = form.product_image.data
@@ -358,7 +392,7 @@ def create_product():
             file.save(product_image)
             new_product = Product(
                 name=product_name,
-                price=price,
+                price_pence=price_pence,
                 quantity=quantity,
                 description=description,
                 product_image=product_image
@@ -380,6 +414,70 @@ def create_product():
     return render_template(ACCESS_DENIED_HTML)
 
 
+@app.route('/import-products', methods=['GET', 'POST'])
+@login_required
+def import_products_page():
+    """
+    Import products API
+
+    Description:
+        Adds or updates products in bulk from a CSV or JSON file
+
+    Response:
+        If successful, returns 200 status code
+
+    Example request:
+        POST http://127.0.0.1:5000/import-products
+
+    Request Body:
+        csrf_token: IjBlOTcwMzZiYWZjNGY5MjUwZWYyM2I4NzY2NGVmMjFlNzZjM2FhOTIi.ZlOQgA.SAXfqP3Ja7yjE3bG1V3azh4r5oU
+
+        products_file: products.csv
+
+        images_archive: images.zip
+
+        import_products: Import Products
+
+    How it works:
+        First the import products page is loaded
+
+        Then the user uploads a file with the columns product_name, price, quantity, description and
+        product_image, and optionally a ZIP archive of the images
+
+        Then each row is validated and the products are saved in batches, matching existing products by name
+
+        Rows that fail validation are listed without stopping the rest of the import
+    """
+    # Verifies the user is the administrator
+    if current_user.email == ADMIN_EMAIL:
+        form = ImportProductsForm()
+        report = None
+        # If validation checks have passed
+        if form.validate_on_submit():
+            products_file = form.products_file.data
+            try:
+                image_source = ImageSource(form.images_archive.data.stream if form.images_archive.data else None)
+            except ValueError as error:
+                flash(f'There was an error with importing products: {error}', category='danger')
+                return render_template('import-products.html', form=form, report=report)
+            try:
+                # Read the uploaded file a row at a time
+                stream = io.TextIOWrapper(products_file.stream, encoding='utf-8', newline='')
+                report = import_products(iter_rows(stream, products_file.filename), image_source)
+            finally:
+                image_source.close()
+            # Alert the user how many products have been imported
+            flash(str(report), category='success' if not report.errors else 'warning')
+        # If there are errors, alert the user
+        if form.errors != {}:
+            for err_msg in form.errors.values():
+                flash(f'There was an error with importing products: {err_msg}', category='danger')
+        # Display the import products page
+        return render_template('import-products.html', form=form, report=report)
+    # Display the access denied page if the user is not an administrator
+    return render_template(ACCESS_DENIED_HTML)
+
+
 @app.route('/view-shop-items', methods=['GET', 'POST'])
 @login_required
 def shop_items():
@@ -398,9 +496,11 @@ def shop_items():
     """
     # Verify the user is an administrator
     if current_user.email == ADMIN_EMAIL:
-        # Get all items and display them on the page in a table
-        items = Product.query.order_by(Product.date_added).all()
-        return render_template('shop_items.html', items=items)
+        # Stream the items into the table in batches instead of loading them all at once
+        items = keyset_rows(select(Product.id, Product.date_added, Product.name, Product.price_pence,
+                                   Product.description, Product.quantity, Product.product_image),
+                            Product.date_added, Product.id)
+        return stream_page('shop_items.html', items=items)
     # Display the access denied page if the user in not an administrator
     return render_template(ACCESS_DENIED_HTML)
 
@@ -432,11 +532,12 @@ def update_item(product_id):
     # Check the user is an administrator
     if current_user.email == ADMIN_EMAIL:
         form = ShopItemsForm()
-        # Default the values in the form to the product you're updating
-        item_to_update = Product.query.get(product_id)
+        # Default the values in the form to the product you're updating, the stock isn't cached so it is read here
+        item_to_update = product_cache.get(product_id)
         form.product_name.render_kw = {'placeholder': item_to_update.name}
-        form.price.render_kw = {'placeholder': item_to_update.price}
-        form.quantity.render_kw = {'placeholder': item_to_update.quantity}
+        form.price.render_kw = {'placeholder': format_money(item_to_update.price_pence)}
+        form.quantity.render_kw = {'placeholder': db.session.scalar(select(Product.quantity)
+                                                                    .where(Product.id == product_id))}
         form.description.render_kw = {'placeholder': item_to_update.description}
         # If the validation checks have passed
         if form.validate_on_submit():
@@ -444,18 +545,21 @@ def update_item(product_id):
             product_name = form.product_name.data
             quantity = form.quantity.data
             description = form.description.data
-            price = form.price.data
+            price_pence = to_pence(form.price.data)
             file = form.product_image.data
             file_name = secure_filename(file.filename)
             file_path = f'./media/{file_name}'
             file.save(file_path)
+            # Bring the totals of sharded products up to date before the stock is replaced
+            sync_sharded_totals()
             Product.query.filter_by(id=product_id).update({
                 "name": product_name,
-                "price": price,
+                "price_pence": price_pence,
                 "quantity": quantity,
                 "description": description,
                 "product_image": file_path
             })
+            respread_changed_shards()
             # Update the product in the database
             db.session.commit()
             # Alert the user the product has been updated
@@ -472,6 +576,77 @@ def update_item(product_id):
     return render_template(ACCESS_DENIED_HTML)
 
 
+@app.route('/bulk-update-items', methods=['GET', 'POST'])
+@login_required
+def bulk_update_items():
+    """
+    Bulk update items Api
+
+    Description:
+        This changes the price and stock of many products at once
+
+    Response:
+        If successful, returns 302 status code
+
+    Example request:
+        POST http://127.0.0.1:5000/bulk-update-items
+
+    Request Body:
+        csrf_token: IjBlOTcwMzZiYWZjNGY5MjUwZWYyM2I4NzY2NGVmMjFlNzZjM2FhOTIi.ZlOQgA.SAXfqP3Ja7yjE3bG1V3azh4r5oU
+
+        product_ids: 1,2,3
+
+        name_contains: Apple
+
+        all_products: n
+
+        price_change: percent
+
+        price_value: -10
+
+        quantity_change: adjust
+
+        quantity_value: 50
+
+        update_products: Update Products
+
+    How it works:
+        First the bulk update items page is loaded
+
+        Then the user chooses the products by id, name or all products and the changes to make
+
+        Then if the validation checks pass every matching product is updated in a single statement
+
+        Otherwise the user is alert there has been an error updating the products
+    """
+    # Check the user is an administrator
+    if current_user.email == ADMIN_EMAIL:
+        form = BulkProductUpdateForm()
+        # If the validation checks have passed
+        if form.validate_on_submit():
+            # Update every matching product using the data from the form
+            updated = bulk_update_products(
+                product_ids=parse_ids(form.product_ids),
+                name_contains=form.name_contains.data,
+                price_change=form.price_change.data,
+                price_value=form.price_value.data,
+                quantity_change=form.quantity_change.data,
+                quantity_value=form.quantity_value.data
+            )
+            # Alert the user how many products have been updated
+            flash(f'{updated} Products Updated Successfully', category='success')
+            # Redirect the user after updating the products
+            return redirect(url_for('shop_items'))
+        # If there are errors, alert the user
+        if form.errors != {}:
+            for err_msg in form.errors.values():
+                flash(f'There was an error with updating the products: {err_msg}', category='danger')
+        # Display the bulk update items page
+        return render_template('bulk_update_items.html', form=form)
+    # Display the access denied page if a non-administrator attempts to bulk update products
+    return render_template(ACCESS_DENIED_HTML)
+
+
 @app.route('/delete-item/<int:product_id>', methods=['GET', 'DELETE'])
 @login_required
 def delete_item(product_id):
@@ -522,9 +697,22 @@ def add_to_cart(product_id):
 
     Example request:
         GET http://127.0.0.1:5000/add-to-cart/1
+
+    How it works:
+        The item is held for the user for a short time so it can't be sold to someone else before they check out
+
+        If all the remaining stock is held or sold the item isn't added
     """
     # Get the product
-    item_to_add = Product.query.get(product_id)
+    item_to_add = product_cache.get(product_id)
+    # Hold the item for the user so it is still available when they check out
+    try:
+        reserve(current_user.id, product_id)
+    except OutOfStockError:
+        db.session.rollback()
+        # Alert the user there is no more stock to add to their cart
+        flash(f'{item_to_add.name} is out of stock', category='danger')
+        return redirect(request.referrer)
     # Check if the item is already in your cart
     item_exists = Cart.query.filter_by(product_id=product_id, customer_id=current_user.id).first()
     # If the item is already in your cart increase the quantity
@@ -543,7 +731,7 @@ def add_to_cart(product_id):
     db.session.add(new_cart_item)
     db.session.commit()
     # Alert the user the item has been added to their cart
-    flash(f'{new_cart_item.product.name} Added Successfully', category='success')
+    flash(f'{item_to_add.name} Added Successfully', category='success')
     return redirect(request.referrer)
 
 
@@ -568,18 +756,24 @@ def increase_quantity():
     # Get the cart for the user and increase the quantity of the item
     cart_id = request.args.get('cart_id')
     cart_item = Cart.query.get(cart_id)
-    cart_item.quantity += 1
-    # Update the database
-    db.session.commit()
+    error = None
+    try:
+        # Hold the extra item for the user
+        reserve(current_user.id, cart_item.product_id)
+        cart_item.quantity += 1
+        # Update the database
+        db.session.commit()
+    except OutOfStockError:
+        db.session.rollback()
+        error = f'{product_cache.get(cart_item.product_id).name} is out of stock'
     # Update the values in the cart
-    cart = Cart.query.filter_by(customer_id=current_user.id).all()
-    amount = 0
-    for item in cart:
-        amount += item.product.price * item.quantity
     data = {
         'quantity': cart_item.quantity,
-        'amount': amount,
+        # The total is added up in the database without loading the cart
+        'amount': format_money(cart_total(current_user.id)),
     }
+    if error:
+        data['error'] = error
     return jsonify(data)
 
 
@@ -605,16 +799,15 @@ def decrease_quantity():
     cart_id = request.args.get('cart_id')
     cart_item = Cart.query.get(cart_id)
     cart_item.quantity -= 1
+    # Release the item held for the user
+    release(current_user.id, cart_item.product_id, 1)
     # Update the database
     db.session.commit()
     # Update the values in the cart
-    cart = Cart.query.filter_by(customer_id=current_user.id).all()
-    amount = 0
-    for item in cart:
-        amount += item.product.price * item.quantity
     data = {
         'quantity': cart_item.quantity,
-        'amount': amount,
+        # The total is added up in the database without loading the cart
+        'amount': format_money(cart_total(current_user.id)),
     }
     return jsonify(data)
 
@@ -640,17 +833,16 @@ def remove_from_cart():
     # Get the cart for the user and remove the item from the cart
     cart_id = request.args.get('cart_id')
     cart_item = Cart.query.get(cart_id)
+    # Release the items held for the user
+    release(current_user.id, cart_item.product_id)
     # Update the database
     db.session.delete(cart_item)
     db.session.commit()
     # Update the values in the cart
-    cart = Cart.query.filter_by(customer_id=current_user.id).all()
-    amount = 0
-    for item in cart:
-        amount += item.product.price * item.quantity
     data = {
         'quantity': cart_item.quantity,
-        'amount': amount,
+        # The total is added up in the database without loading the cart
+        'amount': format_money(cart_total(current_user.id)),
     }
     return jsonify(data)
 
@@ -670,14 +862,13 @@ def show_cart():
     Example request:
         GET http://127.0.0.1:5000/cart
     """
-    # Get the items in the cart
+    # Get the items in the cart and their products
     cart = Cart.query.filter_by(customer_id=current_user.id).all()
+    products = product_cache.get_many(item.product_id for item in cart)
     # Calculate the price
-    amount = 0
-    for item in cart:
-        amount += item.product.price * item.quantity
+    amount = lines_total(cart, products)
     # Display the cart page
-    return render_template('cart.html', cart=cart, amount=amount)
+    return render_template('cart.html', cart=cart, products=products, amount=amount)
 
 
 @app.route('/place-order')
@@ -695,44 +886,26 @@ def place_order():
     Example request:
         GET http://127.0.0.1:5000/place-order
     """
-    # Get the items in the cart
-    customer_cart = Cart.query.filter_by(customer_id=current_user.id)
-    # Check the cart isn't empty
-    if customer_cart:
-        try:
-            # Calculate the total
-            total = 0
-            for item in customer_cart:
-                total += item.product.price * item.quantity
-            for item in customer_cart:
-                # Create order
-                new_order = Order()
-                new_order.quantity = item.quantity
-                new_order.price = total
-                new_order.status = 'Pending'
-                new_order.payment_id = 1
-                new_order.product_id = item.product_id
-                new_order.customer_id = item.customer_id
-                # Update database
-                db.session.add(new_order)
-                # Update stock
-                product = Product.query.get(item.product_id)
-                if product.quantity - item.quantity >= 0:
-                    product.quantity -= item.quantity
-                    db.session.delete(item)
-                    db.session.commit()
-                else:
-                    # Raise exception if the item isn't available
-                    raise CustomException('Item is not available')
-            # Alert the user their order has been placed
-            flash('Order Placed Successfully', category='success')
-            # Redirect the user to order history page
-            return redirect(url_for('my_orders'))
-        except CustomException:
-            # Alert the user if the order couldn't be placed
-            flash('Order not placed', category='danger')
-            # Redirect the user to the home page
-            return redirect(url_for('home_page'))
+    try:
+        # Turn the cart into orders, taking the stock and queuing the payment
+        new_orders = checkout(current_user.id)
+    except OutOfStockError:
+        db.session.rollback()
+        # Alert the user if the order couldn't be placed
+        flash('Order not placed', category='danger')
+        # Redirect the user to the home page
+        return redirect(url_for('home_page'))
+    # Check the cart wasn't empty
+    if new_orders:
+        # Place the whole order in one transaction
+        db.session.commit()
+        # Alert the user their order has been placed
+        flash('Order Placed Successfully', category='success')
+        # Redirect the user to order history page
+        return redirect(url_for('my_orders'))
+    # Alert the user if there is nothing in their cart to order
+    flash('Your cart is empty', category='info')
+    return redirect(url_for('show_cart'))
 
 
 @app.route('/orders')
@@ -752,11 +925,13 @@ def my_orders():
     """
     # Get the users order history
     orders = Order.query.filter_by(customer_id=current_user.id).all()
+    products = product_cache.get_many(order.product_id for order in orders)
     # Display users order history page
-    return render_template('orders.html', orders=orders)
+    return render_template('orders.html', orders=orders, products=products)
 
 
 @app.route('/search', methods=['GET', 'POST'])
+@cached_catalogue_page
 def search():
     """
     Search Api
@@ -767,9 +942,13 @@ def search():
     Response:
         If successful, returns 200 status code
 
+        If a GET search hasn't changed since the ETag sent in If-None-Match, returns 304 status code
+
     Example request:
         POST http://127.0.0.1:5000/search
 
+        GET http://127.0.0.1:5000/search?search=Apple%20Watch
+
     Request Body:
         search: Apple Watch
         search_btn:
@@ -779,17 +958,15 @@ def search():
 
         Then the user inputs the search term and clicks the search_btn
 
-        Then the search results are displayed
-    """
-    if request.method == 'POST':
-        # Get the search query from the form
-        search_query = request.form.get('search')
-        # Check the search query against items in the database
-        items = Product.query.filter(Product.name.ilike(f'%{search_query}%')).all()
-        # Display items matching the search query
-        return render_template('search.html', items=items,
-                               cart=Cart.query.filter_by(customer_id=current_user.id).all()
-                               if current_user.is_authenticated else [])
+        Then the search results are displayed, best match first, including names that are spelt slightly differently
+    """
+    # Get the search query from the form or the query string so searches can be cached
+    search_query = request.values.get('search')
+    if search_query is not None:
+        # Find the items most like the search query, allowing for typing mistakes
+        items = search_products(search_query)
+        # Display items matching the search query, best match first
+        return render_template('search.html', items=items, stock=sharded_totals())
     # Load the search page
     return render_template('search.html')
 
@@ -812,9 +989,14 @@ def order_view():
     """
     # Verify the user is the administrator
     if current_user.email == ADMIN_EMAIL:
-        # Get a list of all orders and display them on screen
-        orders = Order.query.all()
-        return render_template('view_orders.html', orders=orders)
+        # Stream the orders with their customer and product read in the same query
+        orders = keyset_rows(select(Order.id, Order.payment_id, Customer.username, Customer.email,
+                                    Product.name.label('product_name'), Order.price_pence, Order.quantity,
+                                    Product.product_image, Order.status)
+                             .outerjoin(Customer, Customer.id == Order.customer_id)
+                             .outerjoin(Product, Product.id == Order.product_id),
+                             Order.id)
+        return stream_page('view_orders.html', orders=orders)
     # Display the access denied page if a non-administrator attempts to view the orders page
     return render_template(ACCESS_DENIED_HTML)
 
@@ -858,6 +1040,7 @@ def update_order(order_id):
         if form.validate_on_submit():
             # Update the status of the order using the data from the form
             status = form.order_status.data
+            record_status_change(order.status, status)
             order.status = status
             # Update the database
             db.session.commit()
@@ -871,6 +1054,60 @@ def update_order(order_id):
     return render_template(ACCESS_DENIED_HTML)
 
 
+@app.route('/bulk-update-orders', methods=['GET', 'POST'])
+@login_required
+def bulk_update_orders():
+    """
+    Bulk update order status Api
+
+    Description:
+        This updates the status of many orders at once
+
+    Response:
+        If successful, returns 302 status code
+
+    Example request:
+        POST http://127.0.0.1:5000/bulk-update-orders
+
+    Request Body:
+        current_status: Accepted
+
+        order_ids:
+
+        new_status: Out for delivery
+
+    How it works:
+        First the bulk update orders page is loaded
+
+        Then the user chooses the orders by current status or id and the status to change them to
+
+        Then if the validation checks pass every matching order is updated in a single statement
+    """
+    # Verify the user is an administrator
+    if current_user.email == ADMIN_EMAIL:
+        form = BulkOrderStatusForm()
+        # If the validation checks pass
+        if form.validate_on_submit():
+            # Update the status of every matching order using the data from the form
+            updated = bulk_update_order_status(
+                form.new_status.data,
+                current_status=form.current_status.data,
+                order_ids=parse_ids(form.order_ids)
+            )
+            # Alert the user how many orders have been updated
+            flash(f'{updated} Orders Updated successfully', category='success')
+            # Redirect the user to the order view page
+            return redirect(url_for('order_view'))
+        # If there are errors, alert the user
+        if form.errors != {}:
+            for err_msg in form.errors.values():
+                flash(f'There was an error with updating the orders: {err_msg}', category='danger')
+        # Display the bulk update orders page
+        return render_template('bulk_update_orders.html', form=form)
+    # Display the access denied page if the user is not an administrator
+    return render_template(ACCESS_DENIED_HTML)
+
+
 @app.route('/customers')
 @login_required
 def display_customers():
@@ -889,9 +1126,10 @@ def display_customers():
     """
     # Verify the user is an administrator
     if current_user.email == ADMIN_EMAIL:
-        # Get a list of users and display it to the user
-        customers = Customer.query.all()
-        return render_template('customers.html', customers=customers)
+        # Stream the list of users to the page in batches
+        customers = keyset_rows(select(Customer.id, Customer.username, Customer.email, Customer.date_joined),
+                                Customer.id)
+        return stream_page('customers.html', customers=customers)
     # Display the access denied page if the user is not an administrator
     return render_template(ACCESS_DENIED_HTML)
 
@@ -919,6 +1157,9 @@ def delete_customer(customer_id):
     if current_user.email == ADMIN_EMAIL:
         # Delete the customer and update the database
         account_to_delete = Customer.query.get(customer_id)
+        # Take the customer off the signups for the day they joined
+        if account_to_delete.date_joined:
+            record_signup(account_to_delete.date_joined.date(), -1)
         db.session.delete(account_to_delete)
         db.session.commit()
         # Alert the user the account has been deleted
@@ -931,17 +1172,71 @@ def delete_customer(customer_id):
     return render_template(ACCESS_DENIED_HTML)
 
 
+@app.route('/export/<string:table>')
+@login_required
+def export_table(table):
+    """
+    Export Api
+
+    Description:
+        Streams the customers, products or orders tables as CSV or NDJSON
+
+    Parameters:
+        table: customers, products or orders
+
+    Query Parameters:
+        format: csv (default) or ndjson
+
+        start: Only include customers or products added, or orders placed, on or after this date (YYYY-MM-DD)
+
+        end: Only include customers or products added, or orders placed, on or before this date (YYYY-MM-DD)
+
+        status: Only include orders with this status
+
+        after: Only include rows with an id greater than this, used to resume an interrupted export
+
+    Response:
+        If successful, returns 200 status code
+
+        If the filters are not valid, returns 400 status code
+
+    Example request:
+        GET http://127.0.0.1:5000/export/orders?format=ndjson&status=Pending&after=1000
+
+    How it works:
+        The rows are read in chunks ordered by id and sent as soon as each chunk is read
+
+        To resume an export, pass the id of the last row received as the after parameter
+    """
+    # Verify the user is an administrator
+    if current_user.email == ADMIN_EMAIL:
+        export_format = request.args.get('format', 'csv')
+        try:
+            lines = export_lines(
+                table,
+                export_format,
+                start=parse_date(request.args.get('start'), 'start'),
+                end=parse_date(request.args.get('end'), 'end'),
+                status=request.args.get('status'),
+                after=request.args.get('after', 0, type=int)
+            )
+        except ExportError as error:
+            return jsonify({'error': str(error)}), 400
+        mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        response = app.response_class(stream_with_context(lines), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename={table}.{export_format}'
+        return response
+    # Display the access denied page if the user is not an administrator
+    return render_template(ACCESS_DENIED_HTML)
+
+
 def common_passwords():
     """
     Function for reading the common passwords for the common passwords file
     :return: A list of common passwords
     """
-    # Read the list of common passwords from the common passwords file
-    script_dir = os.path.dirname(__file__)
-    script_dir.replace("\\", '/')
-    with open(f'{script_dir}/common_passwords.txt', 'r', encoding="utf-8") as f:
-        most_common_passwords = f.read().split('\n')
-    return most_common_passwords
+    # The file is only read the first time, later calls reuse the passwords already loaded
+    return load_wordlist(app.config['PASSWORD_AUDIT_WORDLIST'])
 
 
 @app.route('/attacker/dictionary-attack', methods=['GET', 'POST'])
@@ -963,12 +1258,80 @@ def dictionary_attack():
     """
     app.config['WTF_CSRF_ENABLED'] = False
     # Check the administrator's password is in the list of common passwords
-    for password in common_passwords():
-        attempted_user = Customer.query.filter_by(email='admin@admin.com').first()
-        if attempted_user and attempted_user.verify_password(password=password):
+    attempted_user = Customer.query.filter_by(email='admin@admin.com').first()
+    for password in common_passwords() if attempted_user else ():
+        if attempted_user.verify_password(password=password):
             # Display the password to the attacker
             flash(f"Password is {password}'", category='success')
             # Login the user
             login_user(attempted_user)
             # Redirect the user to the home page
             return redirect(url_for('home_page'))
+
+
+@app.route('/dashboard')
+@login_required
+def sales_dashboard():
+    """
+    Sales dashboard Api
+
+    Description:
+        This shows the revenue and orders per day, the top products, orders by status and new customers per day
+
+    Parameters:
+        days: The number of days shown, from 1 to 366, defaults to 30
+
+    Response:
+        If successful, returns 200 status code
+
+    Example request:
+        GET http://127.0.0.1:5000/dashboard?days=7
+
+    How it works:
+        The figures are read from summary tables kept up to date as orders are placed and updated,
+        so only one row per day shown is read
+    """
+    # Verify the user is an administrator
+    if current_user.email == ADMIN_EMAIL:
+        days = min(max(request.args.get('days', 30, type=int), 1), 366)
+        # Display the dashboard page
+        return render_template('dashboard.html', days=days, **dashboard(days))
+    # Display the access denied page if the user is not an administrator
+    return render_template(ACCESS_DENIED_HTML)
+
+
+@app.route('/password-audit', methods=['GET', 'POST'])
+@login_required
+def password_audit():
+    """
+    Password audit Api
+
+    Description:
+        This checks every account's password against the list of common passwords and lists the accounts that
+        use one
+
+    Response:
+        If successful, returns 200 status code
+
+    Example request:
+        POST http://127.0.0.1:5000/password-audit
+
+    How it works:
+        Starting an audit queues it for the background workers, which check the accounts in parallel,
+        and the page shows the progress and results of the latest audit
+    """
+    # Verify the user is an administrator
+    if current_user.email == ADMIN_EMAIL:
+        form = PasswordAuditForm()
+        # If validation checks have passed
+        if form.validate_on_submit():
+            audit = start_audit()
+            # Queue the audit in the same transaction so it is never lost or run twice
+            enqueue('password_audit', {'audit_id': audit.id}, idempotency_key=f'password-audit-{audit.id}')
+            db.session.commit()
+            flash('The password audit has been started', category='success')
+            return redirect(url_for('password_audit'))
+        # Display the password audit page
+        return render_template('password-audit.html', form=form, audit=latest_audit())
+    # Display the access denied page if the user is not an administrator
+    return render_template(ACCESS_DENIED_HTML)
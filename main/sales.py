@@ -0,0 +1,183 @@
+"""
+Sales reporting for the admin dashboard
+
+The dashboard reads small summary tables that are kept up to date as orders are placed and updated and
+customers join, so loading it never scans the order or customer tables.
+"""
+# Import statements
+import datetime
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.sqlite import insert
+
+from main import db
+from main.models import Customer, Order, OrderStatusCount, Product, ProductSales, SalesDay, SignupDay
+
+# The number of products shown in the top products table
+TOP_PRODUCTS = 10
+
+
+def today():
+    """
+    Function for getting the current day
+    :return: The current date in UTC
+    """
+    return datetime.datetime.now(datetime.UTC).date()
+
+
+def add_to_totals(model, keys, **amounts):
+    """
+    Function for adding to the running totals in a summary table, creating the row if needed
+    :param model: The summary table
+    :param keys: The primary key values of the row
+    :param amounts: The amount to add to each column
+    :return:
+    """
+    statement = insert(model).values(**keys, **amounts)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={column: getattr(model, column) + statement.excluded[column] for column in amounts}
+    ))
+
+
+def record_order(lines, status, day=None):
+    """
+    Function for adding an order to the summary tables, the caller commits the change
+    :param lines: The product id, quantity and price paid in pence for each item in the order
+    :param status: The status the order rows were placed with
+    :param day: The day the order was placed, defaults to today
+    :return:
+    """
+    add_to_totals(SalesDay, {'day': day or today()}, orders=1,
+                  items=sum(quantity for _, quantity, _ in lines),
+                  revenue_pence=sum(revenue for _, _, revenue in lines))
+    for product_id, quantity, revenue in lines:
+        add_to_totals(ProductSales, {'product_id': product_id}, quantity=quantity, revenue_pence=revenue)
+    # Each item is its own row in the order table
+    add_to_totals(OrderStatusCount, {'status': status}, orders=len(lines))
+
+
+def record_status_change(old_status, new_status, orders=1):
+    """
+    Function for moving orders between statuses in the summary table, the caller commits the change
+    :param old_status: The status the orders had
+    :param new_status: The status the orders have now
+    :param orders: The number of orders changed
+    :return:
+    """
+    if old_status == new_status or not orders:
+        return
+    add_to_totals(OrderStatusCount, {'status': old_status}, orders=-orders)
+    add_to_totals(OrderStatusCount, {'status': new_status}, orders=orders)
+
+
+def record_bulk_status_change(query, new_status):
+    """
+    Function for recording a status change of every order matched by a query, call it before the update
+    :param query: The query of the orders being updated
+    :param new_status: The status the orders are changed to
+    :return:
+    """
+    counts = query.with_entities(Order.status, func.count()).group_by(Order.status).all()
+    for old_status, orders in counts:
+        record_status_change(old_status, new_status, orders)
+
+
+def record_signup(day=None, customers=1):
+    """
+    Function for adding customers to the signups of a day, the caller commits the change
+    :param day: The day the customers joined, defaults to today
+    :param customers: The number of customers, negative when accounts are deleted
+    :return:
+    """
+    add_to_totals(SignupDay, {'day': day or today()}, customers=customers)
+
+
+def rebuild_aggregates():
+    """
+    Function for recalculating the summary tables from the order and customer tables
+    Orders placed before their time was recorded have no day, so the sales of the days before the first order with
+    a time are left as they are
+    :return: The number of orders and customers counted
+    """
+    db.session.execute(delete(ProductSales))
+    db.session.execute(delete(OrderStatusCount))
+    db.session.execute(delete(SignupDay))
+    first_placed = db.session.scalar(select(func.min(Order.placed_at)))
+    if first_placed is not None:
+        db.session.execute(delete(SalesDay).where(SalesDay.day >= first_placed.date()))
+        # The items of a cart are separate rows with the same customer and time, and are counted as one order
+        carts = (
+            select(func.date(Order.placed_at).label('day'),
+                   func.sum(Order.quantity).label('quantity'),
+                   func.sum(Order.quantity * Order.price_pence).label('revenue_pence'))
+            .where(Order.placed_at.is_not(None))
+            .group_by(Order.customer_id, Order.placed_at)
+            .subquery()
+        )
+        db.session.execute(insert(SalesDay).from_select(
+            ['day', 'orders', 'items', 'revenue_pence'],
+            select(carts.c.day, func.count(), func.sum(carts.c.quantity), func.sum(carts.c.revenue_pence))
+            .group_by(carts.c.day)
+        ))
+    db.session.execute(insert(ProductSales).from_select(
+        ['product_id', 'quantity', 'revenue_pence'],
+        select(Order.product_id, func.sum(Order.quantity), func.sum(Order.quantity * Order.price_pence))
+        .group_by(Order.product_id)
+    ))
+    db.session.execute(insert(OrderStatusCount).from_select(
+        ['status', 'orders'],
+        select(Order.status, func.count()).group_by(Order.status)
+    ))
+    db.session.execute(insert(SignupDay).from_select(
+        ['day', 'customers'],
+        select(func.date(Customer.date_joined), func.count())
+        .where(Customer.date_joined.is_not(None))
+        .group_by(func.date(Customer.date_joined))
+    ))
+    db.session.commit()
+    orders = db.session.scalar(select(func.coalesce(func.sum(OrderStatusCount.orders), 0)))
+    customers = db.session.scalar(select(func.coalesce(func.sum(SignupDay.customers), 0)))
+    return orders, customers
+
+
+def dashboard(days):
+    """
+    Function for getting the figures shown on the dashboard
+    :param days: The number of days of sales and signups shown
+    :return: A dictionary of the daily sales, signups, top products and orders by status
+    """
+    first_day = today() - datetime.timedelta(days=days - 1)
+    sales = {sales_day.day: sales_day for sales_day in SalesDay.query.filter(SalesDay.day >= first_day)}
+    signups = dict(db.session.execute(
+        select(SignupDay.day, SignupDay.customers).where(SignupDay.day >= first_day)
+    ).all())
+    # Fill in the days with no sales or signups, newest first
+    daily = []
+    for offset in range(days):
+        day = first_day + datetime.timedelta(days=days - 1 - offset)
+        sales_day = sales.get(day)
+        daily.append({
+            'day': day,
+            'orders': sales_day.orders if sales_day else 0,
+            'items': sales_day.items if sales_day else 0,
+            'revenue': sales_day.revenue_pence if sales_day else 0,
+            'customers': signups.get(day, 0),
+        })
+    top_products = db.session.execute(
+        select(Product.name, ProductSales.quantity, ProductSales.revenue_pence)
+        .join(Product, Product.id == ProductSales.product_id)
+        .order_by(ProductSales.revenue_pence.desc())
+        .limit(TOP_PRODUCTS)
+    ).all()
+    statuses = db.session.execute(
+        select(OrderStatusCount.status, OrderStatusCount.orders)
+        .where(OrderStatusCount.orders != 0)
+        .order_by(OrderStatusCount.status)
+    ).all()
+    return {
+        'daily': daily,
+        'revenue': sum(row['revenue'] for row in daily),
+        'top_products': top_products,
+        'statuses': statuses,
+    }
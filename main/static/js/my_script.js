@@ -19,6 +19,10 @@ $('.increase-quantity').click(function(){
              * Update the quantity of the item and price of order in your cart
              */
             console.log(data)
+            if (data.error) {
+                // Tell the user if there wasn't enough stock to add another item
+                alert(data.error)
+            }
             quantity.innerText = data.quantity
             document.getElementById(`quantity${id}`).innerText = data.quantity
             document.getElementById('total').innerText = data.amount
@@ -0,0 +1,249 @@
+"""
+Sharded stock counters for hot products
+
+The stock of a sharded product is the sum of its shards, and so is the stock held in carts. Holds and sales take
+stock from a random shard so concurrent carts and checkouts of the same product update different rows, and a
+sale moves the stock out of a shard's stock and its reserved stock in one update. The product's quantity column
+is a copy of the total refreshed by sync_sharded_totals, so pages showing the stock read the shards instead.
+"""
+# Import statements
+import random
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from main import db
+from main.models import Product, ReservedStock, StockShard
+
+
+def shard_sizes(quantity, shards):
+    """
+    Function for splitting stock evenly across shards
+    :param quantity: The stock to split
+    :param shards: The number of shards
+    :return: A list of the stock in each shard
+    """
+    size, remainder = divmod(max(quantity, 0), shards)
+    return [size + (1 if shard < remainder else 0) for shard in range(shards)]
+
+
+def on_hand(product_id):
+    """
+    Function for getting an expression for the stock on hand of a product
+    :param product_id: The id of the product
+    :return: A scalar subquery of the sum of the shards, or the product's quantity if it isn't sharded
+    """
+    shard_total = select(func.sum(StockShard.quantity)).where(StockShard.product_id == product_id).scalar_subquery()
+    return (select(func.coalesce(shard_total, Product.quantity))
+            .where(Product.id == product_id)
+            .scalar_subquery())
+
+
+def reserved_stock(product_id):
+    """
+    Function for getting an expression for the stock of a product held in carts
+    :param product_id: The id of the product
+    :return: A scalar expression of the sum of the shards' reserved stock, or the product's reserved stock row if it
+    isn't sharded
+    """
+    shard_total = select(func.sum(StockShard.reserved)).where(StockShard.product_id == product_id).scalar_subquery()
+    reserved = select(ReservedStock.quantity).where(ReservedStock.product_id == product_id).scalar_subquery()
+    return func.coalesce(shard_total, reserved, 0)
+
+
+# The stock of each product, read from its shards if it has any, for selecting with the product's other columns
+stock_on_hand = func.coalesce(
+    select(func.sum(StockShard.quantity)).where(StockShard.product_id == Product.id).scalar_subquery(),
+    Product.quantity
+)
+
+
+def sharded_totals():
+    """
+    Function for getting the stock of each sharded product, which the product's quantity only copies now and then
+    :return: A dictionary of the stock keyed by product id
+    """
+    return dict(db.session.execute(
+        select(StockShard.product_id, func.sum(StockShard.quantity)).group_by(StockShard.product_id)
+    ).all())
+
+
+def set_shards(product_id, quantity, reserved, shards):
+    """
+    Function for replacing the shards of a product with shards splitting its stock and reserved stock evenly
+    The stock and reserved stock are split the same way, so no shard has more reserved than in stock unless the
+    product does
+    :param product_id: The id of the product
+    :param quantity: The stock of the product
+    :param reserved: The stock of the product held in carts
+    :param shards: The number of shards
+    :return:
+    """
+    db.session.execute(delete(StockShard).where(StockShard.product_id == product_id))
+    db.session.execute(
+        StockShard.__table__.insert(),
+        [{'product_id': product_id, 'shard': shard, 'quantity': size, 'reserved': reserved_size}
+         for shard, (size, reserved_size) in enumerate(zip(shard_sizes(quantity, shards),
+                                                             shard_sizes(reserved, shards)))]
+    )
+
+
+def shard_stock(product_id, shards):
+    """
+    Function for splitting the stock of a product across shards, or merging it back with 1 shard or fewer
+    :param product_id: The id of the product
+    :param shards: The number of shards
+    :return:
+    """
+    # Start from the current total so no sales are lost when the shards are replaced
+    sync_sharded_totals()
+    quantity, reserved = db.session.execute(
+        select(Product.quantity, reserved_stock(product_id)).where(Product.id == product_id)
+    ).one()
+    # The reserved stock moves to the shards, or back to the product's row when it is no longer sharded
+    db.session.execute(insert(ReservedStock).values(product_id=product_id, quantity=0).on_conflict_do_update(
+        index_elements=[ReservedStock.product_id], set_={'quantity': 0 if shards > 1 else reserved}
+    ))
+    if shards > 1:
+        set_shards(product_id, quantity, reserved, shards)
+    else:
+        db.session.execute(delete(StockShard).where(StockShard.product_id == product_id))
+    db.session.commit()
+
+
+def change_shards(product_id, quantity, room, changes):
+    """
+    Function for applying an amount to the shards of a product, to one random shard if one has room for all of it,
+    otherwise to as many shards as it takes
+    :param product_id: The id of the product
+    :param quantity: The amount
+    :param room: A function giving the expression for how much of the amount a shard can take
+    :param changes: A function giving the values that change a shard by an amount
+    :return: None if the product isn't sharded, otherwise a boolean indicating if all of the amount was applied
+    """
+    shards = db.session.execute(
+        select(StockShard.shard, room()).where(StockShard.product_id == product_id)
+    ).all()
+    if not shards:
+        return None
+    random.shuffle(shards)
+    # Apply all of it to a random shard that has room so only one row is updated
+    for shard, shard_room in shards:
+        if shard_room >= quantity and change_shard(product_id, shard, quantity, room, changes):
+            return True
+    # Otherwise spread it over as many shards as it takes
+    applied = []
+    remaining = quantity
+    for shard, _ in shards:
+        shard_room = db.session.execute(
+            select(room()).where(StockShard.product_id == product_id, StockShard.shard == shard)
+        ).scalar_one()
+        amount = min(shard_room, remaining)
+        if amount > 0 and change_shard(product_id, shard, amount, room, changes):
+            applied.append((shard, amount))
+            remaining -= amount
+        if not remaining:
+            return True
+    # Undo the part applied so the shards are left as they were
+    for shard, amount in applied:
+        db.session.execute(
+            update(StockShard.__table__)
+            .where(StockShard.product_id == product_id, StockShard.shard == shard)
+            .values(**changes(-amount))
+        )
+    return False
+
+
+def change_shard(product_id, shard, amount, room, changes):
+    """
+    Function for applying an amount to a shard if it still has room for it
+    :param product_id: The id of the product
+    :param shard: The shard number
+    :param amount: The amount
+    :param room: A function giving the expression for how much of the amount the shard can take
+    :param changes: A function giving the values that change the shard by the amount
+    :return: Boolean indicating if the shard was changed
+    """
+    result = db.session.execute(
+        update(StockShard.__table__)
+        .where(StockShard.product_id == product_id, StockShard.shard == shard, room() >= amount)
+        .values(**changes(amount))
+    )
+    return result.rowcount == 1
+
+
+def reserve_in_shards(product_id, quantity):
+    """
+    Function for holding stock of a product in its shards
+    :param product_id: The id of the product
+    :param quantity: The amount to hold
+    :return: None if the product isn't sharded, otherwise a boolean indicating if there was enough unreserved stock
+    """
+    return change_shards(product_id, quantity, lambda: StockShard.quantity - StockShard.reserved,
+                         lambda amount: {'reserved': StockShard.reserved + amount})
+
+
+def release_from_shards(product_id, quantity):
+    """
+    Function for releasing stock of a product held in its shards
+    :param product_id: The id of the product
+    :param quantity: The amount to release
+    :return: None if the product isn't sharded, otherwise a boolean indicating if that much was held
+    """
+    return change_shards(product_id, quantity, lambda: StockShard.reserved,
+                         lambda amount: {'reserved': StockShard.reserved - amount})
+
+
+def sell_from_shards(product_id, quantity):
+    """
+    Function for taking sold stock that was held in a cart out of the shards of a product
+    :param product_id: The id of the product
+    :param quantity: The amount sold
+    :return: None if the product isn't sharded, otherwise a boolean indicating if there was enough held stock
+    """
+    sold = change_shards(product_id, quantity, lambda: func.min(StockShard.quantity, StockShard.reserved),
+                         lambda amount: {'quantity': StockShard.quantity - amount,
+                                         'reserved': StockShard.reserved - amount})
+    if sold:
+        # The stock shown on the catalogue pages has changed, although the product's row hasn't
+        db.session.info['stock_changed'] = True
+    return sold
+
+
+def sync_sharded_totals():
+    """
+    Function for copying the sum of the shards to the quantity of each sharded product
+    :return: The number of products whose quantity changed
+    """
+    shard_total = (select(func.sum(StockShard.quantity))
+                   .where(StockShard.product_id == Product.id)
+                   .scalar_subquery())
+    result = db.session.execute(
+        update(Product.__table__)
+        .where(Product.id.in_(select(StockShard.product_id)), Product.quantity != shard_total)
+        .values(quantity=shard_total)
+    )
+    if result.rowcount:
+        # The stock shown on the catalogue pages has changed
+        db.session.info['stock_changed'] = True
+    return result.rowcount
+
+
+def respread_changed_shards():
+    """
+    Function for spreading stock set by an administrator across the shards of the product
+    Call sync_sharded_totals before changing the stock so only products changed since are spread
+    :return:
+    """
+    shard_total = (select(func.sum(StockShard.quantity))
+                   .where(StockShard.product_id == Product.id)
+                   .correlate(Product)
+                   .scalar_subquery())
+    changed = db.session.execute(
+        select(Product.id, Product.quantity, func.sum(StockShard.reserved), func.count(StockShard.shard))
+        .join(StockShard, StockShard.product_id == Product.id)
+        .where(Product.quantity != shard_total)
+        .group_by(Product.id, Product.quantity)
+    ).all()
+    for product_id, quantity, reserved, shards in changed:
+        set_shards(product_id, quantity, reserved, shards)
@@ -0,0 +1,61 @@
+"""
+Helpers for streaming large pages to the client while they are rendered
+"""
+# Import statements
+from flask import get_flashed_messages, stream_with_context
+from sqlalchemy import and_, or_
+
+from main import app, db
+
+
+def after_row(keys, values):
+    """
+    Function for building the condition for the rows ordered after a row, where NULLs are ordered first
+    :param keys: The columns the rows are ordered by, the last one must be unique and not NULL
+    :param values: The values of the columns in the row
+    :return: The condition
+    """
+    key, value = keys[0], values[0]
+    later = key.is_not(None) if value is None else key > value
+    if len(keys) == 1:
+        return later
+    same = key.is_(None) if value is None else key == value
+    return or_(later, and_(same, after_row(keys[1:], values[1:])))
+
+
+def keyset_rows(query, *keys):
+    """
+    Generator for reading the rows of a query a chunk at a time, each chunk starting after the last row of the one
+    before, so no cursor or read transaction is left open while the rows are sent
+    :param query: The select statement
+    :param keys: The columns the rows are ordered by, the last one must be unique and not NULL
+    :return: Each row
+    """
+    chunk_size = app.config['STREAM_BATCH_SIZE']
+    query = query.order_by(*keys).limit(chunk_size)
+    chunk = db.session.execute(query).all()
+    while True:
+        # End the read transaction before the chunk is rendered so writers are never held up by the page
+        db.session.rollback()
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]._mapping
+        chunk = db.session.execute(query.where(after_row(keys, [last[key] for key in keys]))).all()
+
+
+def stream_page(template_name, **context):
+    """
+    Function for rendering a template as a stream so the first byte is sent straight away
+    :param template_name: The name of the template
+    :param context: The variables passed to the template, such as the rows from keyset_rows
+    :return: The streamed response
+    """
+    # Pop the flashed messages now so the session is saved before the body is sent
+    get_flashed_messages()
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+    stream = template.stream(context)
+    # Send the rendered html in chunks instead of one write per template statement
+    stream.enable_buffering(app.config['STREAM_BUFFER_SIZE'])
+    return app.response_class(stream_with_context(stream), mimetype='text/html')
@@ -0,0 +1,41 @@
+"""
+Compiled templates shared between worker processes
+
+Compiled templates are written to a bytecode cache directory, so a new worker process loads each one instead of
+compiling it again, and flask compile-templates fills the cache when deploying so no worker compiles any. A
+template is compiled again if its source has changed since it was cached. Outside debug mode templates aren't
+checked for changes on every render.
+"""
+# Import statements
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+from main import app
+
+
+def configure_template_cache():
+    """
+    Function for caching the compiled templates in TEMPLATE_CACHE_DIR, or only in memory if it isn't set
+    :return:
+    """
+    directory = app.config['TEMPLATE_CACHE_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    else:
+        app.jinja_env.bytecode_cache = None
+
+
+def compile_templates():
+    """
+    Function for compiling every template, loading them into memory and writing them to the bytecode cache
+    :return: The names of the templates
+    """
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+
+configure_template_cache()
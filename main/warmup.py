@@ -0,0 +1,133 @@
+"""
+Warming up a worker process before it serves requests
+
+The first requests to a new worker would otherwise configure the mappers, compile the SQL of each query, build the
+search index, compile and first render the templates and open the database connections. Warming up does all of
+that once, when the worker starts, and reports how long each step took. Set WARM_UP_ON_STARTUP=1 in the
+environment of the web server's workers to run it as the app is imported, or run flask warm-up to see the timings.
+With a server that forks its workers from an app loaded once, such as gunicorn --preload, load the app without
+warming it up and run warm_up in each worker once it has started, so no database connection is shared between
+processes.
+"""
+# Import statements
+import time
+
+from flask import render_template
+from sqlalchemy import func, select
+from sqlalchemy.orm import configure_mappers
+
+from main import app, db
+from main.models import Cart, Customer, Order, Product
+from main.money import cart_total
+from main.product_cache import read_products
+from main.product_search import search_index
+from main.reservations import available_to_sell
+from main.templating import compile_templates
+
+
+def first_row(query):
+    """
+    Function for running a query that returns every row but only reading the first one
+    :param query: The query
+    :return:
+    """
+    # Reading the rows one at a time doesn't change the compiled statement, so the cached SQL is the one used by
+    # the query's .all()
+    for _ in query.yield_per(1):
+        break
+
+
+def run_hot_queries():
+    """
+    Function for running the queries behind the busiest pages once, so their SQL is compiled and cached
+    The ids used don't exist, so the lookups are cheap and nothing is loaded
+    :return: The number of queries run
+    """
+    queries = [
+        # Home page and search results
+        lambda: first_row(Product.query),
+        lambda: Product.query.filter(Product.id.in_([0])).all(),
+        # Logging in and loading the user on every request
+        lambda: Customer.query.filter_by(email='').first(),
+        lambda: Customer.query.get(0),
+        # Cart count in the navigation bar, the cart, its total and the products in it
+        lambda: db.session.scalar(select(func.count()).select_from(Cart).where(Cart.customer_id == 0)),
+        lambda: Cart.query.filter_by(customer_id=0).all(),
+        lambda: Cart.query.filter_by(product_id=0, customer_id=0).first(),
+        lambda: cart_total(0),
+        lambda: read_products([0]),
+        lambda: available_to_sell(0),
+        # Order history
+        lambda: Order.query.filter_by(customer_id=0).all(),
+    ]
+    try:
+        for query in queries:
+            query()
+    finally:
+        db.session.rollback()
+    return len(queries)
+
+
+def render_key_templates():
+    """
+    Function for rendering the busiest pages once with no data
+    :return: The number of templates rendered
+    """
+    pages = [
+        ('home.html', {'items': []}),
+        ('search.html', {'items': []}),
+        ('cart.html', {'cart': [], 'products': {}, 'amount': 0}),
+        ('orders.html', {'orders': [], 'products': {}}),
+    ]
+    with app.test_request_context('/'):
+        for template_name, context in pages:
+            render_template(template_name, **context)
+    return len(pages)
+
+
+def open_connections():
+    """
+    Function for filling the connection pool so requests don't wait for a connection to be opened
+    :return: The number of connections opened
+    """
+    connections = []
+    try:
+        # The connections are held open together so each one is a new connection rather than the same one reused
+        for _ in range(app.config['WARM_UP_CONNECTIONS']):
+            connection = db.engine.connect()
+            connections.append(connection)
+            connection.exec_driver_sql('SELECT 1')
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+# The warm-up steps, in the order they run
+STEPS = [
+    ('mappers', configure_mappers),
+    ('connections', open_connections),
+    ('queries', run_hot_queries),
+    ('search', search_index.get),
+    ('templates', compile_templates),
+    ('renders', render_key_templates),
+]
+
+
+def warm_up():
+    """
+    Function for warming up the worker, logging how long each step took
+    :return: A list of the name of each step and the seconds it took
+    """
+    timings = []
+    with app.app_context():
+        for name, step in STEPS:
+            started = time.perf_counter()
+            step()
+            timings.append((name, time.perf_counter() - started))
+            app.logger.info('Warm-up step %s took %.1f ms', name, timings[-1][1] * 1000)
+    return timings
+
+
+if app.config['WARM_UP_ON_STARTUP']:
+    warm_up()
@@ -1,169 +1,245 @@
-"""File for performing automated tests using playwright"""
+"""File for performing automated tests using playwright
 
+The app is served in this process on a free port against the test database, and each test runs in a transaction
+that is rolled back afterwards, with the customers and product it needs added first. The browser is headless, set
+HEADED=1 to watch it and SLOW_MO to a number of milliseconds to slow it down.
+"""
+
+import os
 import re
 
-from playwright.sync_api import sync_playwright, Playwright, expect
+import pytest
+
+# The harness sets up the test database, so it is imported before the app
+from harness import LiveServer, RollbackTransaction
+from main import app, db
+from main.models import Customer, Product
+
+sync_api = pytest.importorskip('playwright.sync_api')
+sync_playwright, expect = sync_api.sync_playwright, sync_api.expect
+
+
+def add_customer(username, email, password='123456'):
+    """
+    Adding a customer to the database
+    :param username: The username of the customer
+    :param email: The email of the customer
+    :param password: The password of the customer
+    :return:
+    """
+    customer = Customer(username=username, email=email)
+    customer.password = password
+    db.session.add(customer)
+    db.session.commit()
+
+
+def seed_database():
+    """
+    Adding the customers and product the tests use, sam is customer 1, the administrator is customer 2 and the
+    Apple Watch is product 1
+    :return:
+    """
+    with app.app_context():
+        add_customer('sam', 'sam@sam.com')
+        add_customer('admin', 'admin@admin.com')
+        db.session.add(Product(name='Apple Watch Ultra', price_pence=79999, description='Apple Smart Watch',
+                               quantity=10, product_image='./media/AppleWatch.jpg'))
+        db.session.commit()
+
+
+@pytest.fixture(scope='module')
+def live_server():
+    """
+    Serving the app on a free port for the tests in this file
+    :return: The URL of the app
+    """
+    app.config['TESTING'] = True
+    app.config['RATE_LIMIT_ENABLED'] = False
+    server = LiveServer()
+    server.start()
+    yield server.url
+    server.stop()
 
 
-def test_place_order(playwright: Playwright):
+@pytest.fixture(scope='module')
+def browser():
+    """
+    Launching one browser for the tests in this file
+    :return: The browser
+    """
+    with sync_playwright() as playwright:
+        chromium = playwright.chromium  # or "firefox" or "webkit".
+        launched = chromium.launch(headless=not os.getenv('HEADED'), slow_mo=int(os.getenv('SLOW_MO', '0')))
+        yield launched
+        launched.close()
+
+
+@pytest.fixture
+def page(browser, live_server):
+    """
+    Opening a new page in a fresh browser context with the test data in a transaction
+    :param browser: The browser
+    :param live_server: The URL of the app
+    :return: The page
+    """
+    transaction = RollbackTransaction()
+    transaction.begin()
+    seed_database()
+    context = browser.new_context()
+    yield context.new_page()
+    context.close()
+    transaction.rollback()
+
+
+def test_place_order(page, live_server):
     """
     Automated test for placing an order
-    :param playwright: Playwright instance
+    :param page: Playwright page
+    :param live_server: The URL of the app
     :return:
     """
-    chromium = playwright.chromium  # or "firefox" or "webkit".
-    browser = chromium.launch(headless=False, slow_mo=500)
-    page = browser.new_page()
     # Load home page
-    page.goto("http://localhost:5000/")
+    page.goto(f"{live_server}/")
     expect(page).to_have_title(re.compile(r".*Home Page"))
-    expect(page).to_have_url("http://localhost:5000/")
+    expect(page).to_have_url(f"{live_server}/")
     # Load Login page
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/login"]').click()
     expect(page).to_have_title(re.compile(r".*Login Page"))
-    expect(page).to_have_url("http://localhost:5000/login")
+    expect(page).to_have_url(f"{live_server}/login")
     # Enter credentials and log in
     page.locator("[name='email']").fill("admin@admin.com")
     page.locator("[name='password']").fill("123456")
     page.locator("[name='submit']").click()
-    expect(page).to_have_url("http://localhost:5000/home")
+    expect(page).to_have_url(f"{live_server}/home")
     # Add item to cart and place order
     page.locator('[href*="/add-to-cart/1"]').click()
     page.locator('[href*="/cart"]').click()
-    expect(page).to_have_url("http://localhost:5000/cart")
+    expect(page).to_have_url(f"{live_server}/cart")
     expect(page).to_have_title(re.compile(r".*Cart Page"))
     page.locator('[href*="/place-order"]').click()
-    # other actions...
-    browser.close()
 
 
-def test_register(playwright: Playwright):
+def test_register(page, live_server):
     """
     Automated test for creating a new user
-    :param playwright: Playwright instance
+    :param page: Playwright page
+    :param live_server: The URL of the app
     :return:
     """
-    chromium = playwright.chromium  # or "firefox" or "webkit".
-    browser = chromium.launch(headless=False, slow_mo=500)
-    page = browser.new_page()
     # Load home page
-    page.goto("http://localhost:5000/")
+    page.goto(f"{live_server}/")
     expect(page).to_have_title(re.compile(r".*Home Page"))
-    expect(page).to_have_url("http://localhost:5000/")
+    expect(page).to_have_url(f"{live_server}/")
     # Load Login page
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/login"]').click()
     expect(page).to_have_title(re.compile(r".*Login Page"))
-    expect(page).to_have_url("http://localhost:5000/login")
+    expect(page).to_have_url(f"{live_server}/login")
     # Load Register Page
     page.locator('[href*="/register"]').click()
     expect(page).to_have_title(re.compile(r".*Register Page"))
-    expect(page).to_have_url("http://localhost:5000/register")
+    expect(page).to_have_url(f"{live_server}/register")
     # Enter credentials and create account
     page.locator("[name='username']").fill("test")
     page.locator("[name='email']").fill("test@test.com")
     page.locator("[name='password']").fill("123456")
     page.locator("[name='confirm_password']").fill("123456")
     page.locator("[name='submit']").click()
-    expect(page).to_have_url("http://localhost:5000/home")
-    # other actions...
-    browser.close()
+    expect(page).to_have_url(f"{live_server}/home")
 
 
-def test_delete_user(playwright: Playwright):
+def test_delete_user(page, live_server):
     """
     Automated test deleting a user
-    :param playwright: Playwright instance
+    :param page: Playwright page
+    :param live_server: The URL of the app
     :return:
     """
-    chromium = playwright.chromium  # or "firefox" or "webkit".
-    browser = chromium.launch(headless=False, slow_mo=500)
-    page = browser.new_page()
+    # Add the user to delete as customer 3
+    with app.app_context():
+        add_customer('test', 'test@test.com')
     # Load home page
-    page.goto("http://localhost:5000/")
+    page.goto(f"{live_server}/")
     expect(page).to_have_title(re.compile(r".*Home Page"))
-    expect(page).to_have_url("http://localhost:5000/")
+    expect(page).to_have_url(f"{live_server}/")
     # Load Login page
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/login"]').click()
     expect(page).to_have_title(re.compile(r".*Login Page"))
-    expect(page).to_have_url("http://localhost:5000/login")
+    expect(page).to_have_url(f"{live_server}/login")
     # Login to admin account
     page.locator("[name='email']").fill("admin@admin.com")
     page.locator("[name='password']").fill("123456")
     page.locator("[name='submit']").click()
-    expect(page).to_have_url("http://localhost:5000/home")
+    expect(page).to_have_url(f"{live_server}/home")
     # Go to manager users page and delete the newly created user
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/customers"]').click()
     expect(page).to_have_title(re.compile(r".*Customer Page"))
-    expect(page).to_have_url("http://localhost:5000/customers")
+    expect(page).to_have_url(f"{live_server}/customers")
     page.locator('[href*="/customers/3"]').click()
     assert page.locator('tr').count() == 3
-    browser.close()
 
 
-def test_changing_order_status(playwright: Playwright):
+def test_changing_order_status(page, live_server):
     """
     Automated test for updating the status of an order
-    :param playwright: Playwright instance
+    :param page: Playwright page
+    :param live_server: The URL of the app
     :return:
     """
-    chromium = playwright.chromium  # or "firefox" or "webkit".
-    browser = chromium.launch(headless=False, slow_mo=500)
-    page = browser.new_page()
     # Load home page
-    page.goto("http://localhost:5000/")
+    page.goto(f"{live_server}/")
     expect(page).to_have_title(re.compile(r".*Home Page"))
-    expect(page).to_have_url("http://localhost:5000/")
+    expect(page).to_have_url(f"{live_server}/")
     # Load Login page
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/login"]').click()
     expect(page).to_have_title(re.compile(r".*Login Page"))
-    expect(page).to_have_url("http://localhost:5000/login")
+    expect(page).to_have_url(f"{live_server}/login")
     # Load Register Page
     page.locator('[href*="/register"]').click()
     expect(page).to_have_title(re.compile(r".*Register Page"))
-    expect(page).to_have_url("http://localhost:5000/register")
+    expect(page).to_have_url(f"{live_server}/register")
     # Enter credentials and create account
     page.locator("[name='username']").fill("test")
     page.locator("[name='email']").fill("test@test.com")
     page.locator("[name='password']").fill("123456")
     page.locator("[name='confirm_password']").fill("123456")
     page.locator("[name='submit']").click()
-    expect(page).to_have_url("http://localhost:5000/home")
+    expect(page).to_have_url(f"{live_server}/home")
     # Add item to cart and place order
     page.locator('[href*="/add-to-cart/1"]').click()
     page.locator('[href*="/cart"]').click()
-    expect(page).to_have_url("http://localhost:5000/cart")
+    expect(page).to_have_url(f"{live_server}/cart")
     expect(page).to_have_title(re.compile(r".*Cart Page"))
     page.locator('[href*="/place-order"]').click()
     expect(page).to_have_title(re.compile(r".*Orders Page"))
-    expect(page).to_have_url("http://localhost:5000/orders")
+    expect(page).to_have_url(f"{live_server}/orders")
     # Logout of customer account
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/logout"]').click()
     expect(page).to_have_title(re.compile(r".*Home Page"))
-    expect(page).to_have_url("http://localhost:5000/home")
+    expect(page).to_have_url(f"{live_server}/home")
     # Load Login page
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/login"]').click()
     expect(page).to_have_title(re.compile(r".*Login Page"))
-    expect(page).to_have_url("http://localhost:5000/login")
+    expect(page).to_have_url(f"{live_server}/login")
     # Login to admin account
     page.locator("[name='email']").fill("admin@admin.com")
     page.locator("[name='password']").fill("123456")
     page.locator("[name='submit']").click()
-    expect(page).to_have_url("http://localhost:5000/home")
+    expect(page).to_have_url(f"{live_server}/home")
     # Go to manager orders page and update the order status
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/view-order"]').click()
     expect(page).to_have_title(re.compile(r".*View Orders Page"))
-    expect(page).to_have_url("http://localhost:5000/view-orders")
-    page.locator('[href*="/update-order/2"]').click()
+    expect(page).to_have_url(f"{live_server}/view-orders")
+    page.locator('[href*="/update-order/1"]').click()
     expect(page).to_have_title(re.compile(r".*Update Orders Page"))
-    expect(page).to_have_url("http://localhost:5000/update-order/2")
+    expect(page).to_have_url(f"{live_server}/update-order/1")
     page.locator("[name='order_status']").select_option('Accepted')
     # page.locator("[name='order_status']").click()
     # page.locator("[value='Accepted']").click()
@@ -172,156 +248,135 @@ def test_changing_order_status(playwright: Playwright):
     # Logout of admin account
     page.locator('[href*="/logout"]').click()
     expect(page).to_have_title(re.compile(r".*Home Page"))
-    expect(page).to_have_url("http://localhost:5000/home")
+    expect(page).to_have_url(f"{live_server}/home")
     # Load Login page
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/login"]').click()
     expect(page).to_have_title(re.compile(r".*Login Page"))
-    expect(page).to_have_url("http://localhost:5000/login")
+    expect(page).to_have_url(f"{live_server}/login")
     # Enter credentials and log in
     page.locator("[name='email']").fill("test@test.com")
     page.locator("[name='password']").fill("123456")
     page.locator("[name='submit']").click()
-    expect(page).to_have_url("http://localhost:5000/home")
+    expect(page).to_have_url(f"{live_server}/home")
     # View order with updated order status
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/orders"]').click()
-    browser.close()
 
 
-def test_edit_cart(playwright: Playwright):
+def test_edit_cart(page, live_server):
     """
     Automated test for updating your cart
-    :param playwright: Playwright instance
+    :param page: Playwright page
+    :param live_server: The URL of the app
     :return:
     """
-    chromium = playwright.chromium  # or "firefox" or "webkit".
-    browser = chromium.launch(headless=False, slow_mo=500)
-    page = browser.new_page()
     # Load home page
-    page.goto("http://localhost:5000/")
+    page.goto(f"{live_server}/")
     expect(page).to_have_title(re.compile(r".*Home Page"))
-    expect(page).to_have_url("http://localhost:5000/")
+    expect(page).to_have_url(f"{live_server}/")
     # Load Login page
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/login"]').click()
     expect(page).to_have_title(re.compile(r".*Login Page"))
-    expect(page).to_have_url("http://localhost:5000/login")
+    expect(page).to_have_url(f"{live_server}/login")
     # Enter credentials and log in
     page.locator("[name='email']").fill("admin@admin.com")
     page.locator("[name='password']").fill("123456")
     page.locator("[name='submit']").click()
-    expect(page).to_have_url("http://localhost:5000/home")
+    expect(page).to_have_url(f"{live_server}/home")
     # Search
     page.locator("[name='search']").fill("Apple Watch")
     page.locator("[name='search_btn']").click()
-    expect(page).to_have_url("http://localhost:5000/search")
+    expect(page).to_have_url(f"{live_server}/search")
     # Add item to cart and place order
     page.locator('[href*="/add-to-cart/1"]').click()
     page.locator('[href*="/cart"]').click()
-    expect(page).to_have_url("http://localhost:5000/cart")
+    expect(page).to_have_url(f"{live_server}/cart")
     # Edit cart
     page.locator("[name='decrease_quantity']").click()
     page.locator("[name='increase_quantity']").click()
     page.locator("[name='remove_from_cart_btn']").click()
     heading = page.query_selector("h1").text_content()
     assert heading == "Your Cart is Empty"
-    # other actions...
-    browser.close()
 
 
-def test_error_page(playwright: Playwright):
+def test_error_page(page, live_server):
     """
     Automated test for error pages
-    :param playwright: Playwright instance
+    :param page: Playwright page
+    :param live_server: The URL of the app
     :return:
     """
-    chromium = playwright.chromium  # or "firefox" or "webkit".
-    browser = chromium.launch(headless=False, slow_mo=500)
-    page = browser.new_page()
     # Load home page
-    page.goto("http://localhost:5000/")
+    page.goto(f"{live_server}/")
     expect(page).to_have_title(re.compile(r".*Home Page"))
-    expect(page).to_have_url("http://localhost:5000/")
+    expect(page).to_have_url(f"{live_server}/")
     # Load Login page
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/login"]').click()
     expect(page).to_have_title(re.compile(r".*Login Page"))
-    expect(page).to_have_url("http://localhost:5000/login")
+    expect(page).to_have_url(f"{live_server}/login")
     # Enter credentials and log in
     page.locator("[name='email']").fill("sam@sam.com")
     page.locator("[name='password']").fill("123456")
     page.locator("[name='submit']").click()
-    expect(page).to_have_url("http://localhost:5000/home")
-    page.goto("http://localhost:5000/customers")
+    expect(page).to_have_url(f"{live_server}/home")
+    page.goto(f"{live_server}/customers")
     heading = page.query_selector("h1").text_content()
     assert heading == "Access Denied"
     heading = page.query_selector("h3").text_content()
     assert heading == "You don't have permission to view this page."
-    page.goto("http://localhost:5000/test")
+    page.goto(f"{live_server}/test")
     heading = page.query_selector("h1").text_content()
     assert heading == "404"
     heading = page.query_selector("h2").text_content()
     assert heading == "Page not found"
-    browser.close()
 
 
-def test_change_password(playwright: Playwright):
+def test_change_password(page, live_server):
     """
     Automated test for changing your password
-    :param playwright: Playwright instance
+    :param page: Playwright page
+    :param live_server: The URL of the app
     :return:
     """
-    chromium = playwright.chromium  # or "firefox" or "webkit".
-    browser = chromium.launch(headless=False, slow_mo=500)
-    page = browser.new_page()
     # Load home page
-    page.goto("http://localhost:5000/")
+    page.goto(f"{live_server}/")
     expect(page).to_have_title(re.compile(r".*Home Page"))
-    expect(page).to_have_url("http://localhost:5000/")
+    expect(page).to_have_url(f"{live_server}/")
     # Load Login page
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/login"]').click()
     expect(page).to_have_title(re.compile(r".*Login Page"))
-    expect(page).to_have_url("http://localhost:5000/login")
+    expect(page).to_have_url(f"{live_server}/login")
     # Enter credentials and log in
     page.locator("[name='email']").fill("sam@sam.com")
     page.locator("[name='password']").fill("123456")
     page.locator("[name='submit']").click()
     # Change password
-    expect(page).to_have_url("http://localhost:5000/home")
+    expect(page).to_have_url(f"{live_server}/home")
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/profile/1"]').click()
-    expect(page).to_have_url("http://localhost:5000/profile/1")
+    expect(page).to_have_url(f"{live_server}/profile/1")
     page.locator('[href*="/change_password/1"]').click()
-    expect(page).to_have_url("http://localhost:5000/change_password/1")
+    expect(page).to_have_url(f"{live_server}/change_password/1")
     page.locator("[name='current_password']").fill("123456")
     page.locator("[name='new_password']").fill("12345678")
     page.locator("[name='confirm_password']").fill("12345678")
     page.locator("[name='submit']").click()
-    expect(page).to_have_url("http://localhost:5000/profile/1")
+    expect(page).to_have_url(f"{live_server}/profile/1")
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/logout"]').click()
     expect(page).to_have_title(re.compile(r".*Home Page"))
-    expect(page).to_have_url("http://localhost:5000/home")
+    expect(page).to_have_url(f"{live_server}/home")
     # Load Login page
     page.locator("[name='account-drop-down']").click()
     page.locator('[href*="/login"]').click()
     expect(page).to_have_title(re.compile(r".*Login Page"))
-    expect(page).to_have_url("http://localhost:5000/login")
+    expect(page).to_have_url(f"{live_server}/login")
     # Enter credentials and log in
     page.locator("[name='email']").fill("sam@sam.com")
     page.locator("[name='password']").fill("12345678")
     page.locator("[name='submit']").click()
-    browser.close()
-
 
-if __name__ == "__main__":
-    with sync_playwright() as p:
-        test_place_order(p)
-        test_register(p)
-        test_delete_user(p)
-        test_changing_order_status(p)
-        test_edit_cart(p)
-        test_error_page(p)
-        test_change_password(p)
@@ -0,0 +1,123 @@
+"""
+Test harness shared by the unit tests and the browser tests
+
+Importing it points the app at a private in-memory SQLite database and the lowest bcrypt cost, so it must be
+imported before main. The tables are created once per process and each test runs inside a transaction that is
+rolled back when it finishes, so every test starts from an empty database without the tables being recreated.
+Each process has its own database, so the tests can be spread across every core with pytest -n auto.
+"""
+# Import statements
+import os
+import tempfile
+import threading
+
+# Set before the app is imported, a database URL or bcrypt cost already in the environment is used instead
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('BCRYPT_LOG_ROUNDS', '4')
+
+# pylint: disable=wrong-import-position
+from sqlalchemy import event
+from werkzeug.serving import make_server
+
+from main import app, db
+from main.product_cache import product_cache
+from main.product_search import search_index
+from main.templating import configure_template_cache
+
+
+def disable_driver_transactions(dbapi_connection, connection_record):
+    """Stops the SQLite driver starting and committing transactions itself, so savepoints work"""
+    dbapi_connection.isolation_level = None
+
+
+def begin_transaction(connection):
+    """Starts each transaction, which the driver no longer does"""
+    connection.exec_driver_sql('BEGIN')
+
+
+def prepare_database():
+    """
+    Function for creating the tables in the test database, run once per process when the harness is imported
+    :return:
+    """
+    # Files the app writes go in a directory of this process's own
+    directory = tempfile.mkdtemp(prefix='test-')
+    app.config['CATALOGUE_VERSION_FILE'] = os.path.join(directory, 'catalogue.version')
+    app.config['PRODUCT_NAMES_VERSION_FILE'] = os.path.join(directory, 'product-names.version')
+    app.config['STOCK_VERSION_FILE'] = os.path.join(directory, 'stock.version')
+    app.config['CART_VERSION_DIR'] = os.path.join(directory, 'cart-versions')
+    app.config['TEMPLATE_CACHE_DIR'] = os.path.join(directory, 'template-cache')
+    configure_template_cache()
+    with app.app_context():
+        engine = db.engine
+        event.listen(engine, 'connect', disable_driver_transactions)
+        event.listen(engine, 'begin', begin_transaction)
+        # Reconnect so the listeners apply to the connection, which is the in-memory database
+        engine.dispose()
+        db.create_all()
+        # Commits made by the app release a savepoint instead of ending the test's transaction
+        db.session.remove()
+        db.session.configure(join_transaction_mode='create_savepoint')
+
+
+class RollbackTransaction:
+    """Class for running a test inside a transaction that is rolled back afterwards"""
+
+    def __init__(self):
+        self.engine = None
+        self.connection = None
+        self.transaction = None
+
+    def begin(self):
+        """
+        Function for starting the transaction and pointing the app's sessions at it
+        :return:
+        """
+        with app.app_context():
+            engines = db.engines
+            self.engine = engines[None]
+            self.connection = self.engine.connect()
+            self.transaction = self.connection.begin()
+            engines[None] = self.connection
+
+    def rollback(self):
+        """
+        Function for throwing away everything the test did and pointing the app back at the engine
+        :return:
+        """
+        with app.app_context():
+            db.session.remove()
+            self.transaction.rollback()
+            self.connection.close()
+            db.engines[None] = self.engine
+        # The products the test cached and indexed no longer exist
+        product_cache.clear()
+        search_index.clear()
+
+
+class LiveServer:
+    """Class for serving the app on a free port in a background thread, for tests that drive a browser"""
+
+    def __init__(self):
+        # Port 0 lets the operating system choose a free port
+        self.server = make_server('127.0.0.1', 0, app)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, name='live-server', daemon=True)
+
+    def start(self):
+        """
+        Function for starting to serve requests
+        :return:
+        """
+        self.thread.start()
+
+    def stop(self):
+        """
+        Function for stopping the server
+        :return:
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+prepare_database()
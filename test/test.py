@@ -1,10 +1,47 @@
 """Unit test for the application"""
+import datetime
+import decimal
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
 import os
+import queue
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event, func, inspect, select, text
 
 from flask_testing import TestCase
 
+# The harness sets up the test database, so it is imported before the app
+from harness import RollbackTransaction
 from main import db, app
-from main.models import Customer, load_user
+from main.breached_passwords import BloomFilter, build_filter
+from main.imports import import_products, iter_json_rows
+from main.logs import DroppingQueueHandler, JSONFormatter, queue_handler, queue_listener
+from main import json_provider
+from main import password_audit
+from main.jobs import (DEAD, DONE, LeaseLost, claim_job, current_job, enqueue, finish_job, heartbeat, job_handler,
+                       run_pending_jobs, utc_now)
+from main.migrations import status, upgrade
+from main.models import (Customer, Job, Order, OrderStatusCount, Product, ProductSales, ReservedStock, StockHold,
+                         SalesDay, StockShard, load_user)
+from main.cache import bump_catalogue_version, catalogue_version, product_names_version, stock_version
+from main.reservations import OutOfStockError, available_to_sell, reserve, sweep, sweep_expired_holds
+from main.money import cart_total, format_money, orders_total, to_pence
+from main.sales import dashboard, rebuild_aggregates
+from main.password_audit import (audit_passwords, load_wordlist, read_wordlist_piece, start_audit,
+                                 wordlist_pieces)
+from main.passwords import hash_cost
+from main.product_cache import product_cache
+from main.product_search import TrigramIndex, search_index, search_products
+from main.templating import compile_templates, configure_template_cache
+from main.warmup import warm_up
+from main.query_plans import QueryPlanRecorder
+from main.rate_limit import SQLiteStore, configure_proxies, get_store
+from main.stock_shards import shard_stock
 
 
 # noinspection PyPep8Naming
@@ -18,26 +55,26 @@ class test(TestCase):
         """
         app.config['TESTING'] = True
         app.config['WTF_CSRF_ENABLED'] = False
+        app.config['RATE_LIMIT_ENABLED'] = False
         app.config['SECRET_KEY'] = os.getenv("SECRET_KEY")
         return app
 
-    SQLALCHEMY_DATABASE_URI = "sqlite://"
     TESTING = True
 
     def setUp(self):
         """
-        Creating the tables before every test
+        Starting a transaction before every test, the tables are created once by the harness
         :return:
         """
-        db.create_all()
+        self.transaction = RollbackTransaction()
+        self.transaction.begin()
 
     def tearDown(self):
         """
-        Delete the tables after every test
+        Rolling back everything the test did after every test
         :return:
         """
-        db.session.remove()
-        db.drop_all()
+        self.transaction.rollback()
 
     def login(self, email, password):
         """
@@ -268,6 +305,70 @@ class test(TestCase):
         """
         return self.client.get('/view-orders', follow_redirects=True)
 
+    def home_page(self, etag=None):
+        """
+        Loading the home page
+        :param etag: The ETag of a previously loaded home page
+        :return:
+        """
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.client.get('/', headers=headers)
+
+    def import_products(self, products_file, file_name):
+        """
+        Importing products from a file
+        :param products_file: The contents of the file
+        :param file_name: The name of the file
+        :return:
+        """
+        return self.client.post('/import-products', data={
+            'products_file': (io.BytesIO(products_file), file_name)
+        }, follow_redirects=True)
+
+    def bulk_update_items(self, **data):
+        """
+        Updating many products at once
+        :param data: The bulk update form fields
+        :return:
+        """
+        return self.client.post('/bulk-update-items', data=data, follow_redirects=True)
+
+    def bulk_update_orders(self, **data):
+        """
+        Updating the status of many orders at once
+        :param data: The bulk update form fields
+        :return:
+        """
+        return self.client.post('/bulk-update-orders', data=data, follow_redirects=True)
+
+    def sales_dashboard(self, days=30):
+        """
+        Viewing the sales dashboard
+        :param days: The number of days shown
+        :return:
+        """
+        return self.client.get(f'/dashboard?days={days}', follow_redirects=True)
+
+    def api_token(self, email, password):
+        """
+        Getting a JSON API token
+        :param email: The email of the user
+        :param password: The password of the user
+        :return: The authorization headers for the token
+        """
+        rv = self.client.post('/api/v1/tokens', json={'email': email, 'password': password})
+        return {'Authorization': f'Bearer {rv.json["token"]}'}
+
+    def password_audit(self, start=False):
+        """
+        Viewing the password audit page
+        :param start: Whether to start an audit
+        :return:
+        """
+        if start:
+            return self.client.post('/password-audit', data=dict(start_audit='Start Audit'), follow_redirects=True)
+        return self.client.get('/password-audit', follow_redirects=True)
+
     def test_register(self):
         """
         Register a new user
@@ -678,8 +779,8 @@ class test(TestCase):
         self.login("admin@admin.com", "123456")
         self.create_product("Apple Watch Ultra", 1, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
         self.add_to_cart(1)
-        self.add_to_cart(1)
         self.view_cart()
+        self.bulk_update_items(product_ids='1', price_change='none', quantity_change='set', quantity_value=0)
         rv = self.place_order()
         assert 'Order not placed' in rv.data.decode('utf-8')
 
@@ -799,3 +900,1360 @@ class test(TestCase):
         :return:
         """
         self.get_image('AppleWatch.jpg')
+
+
+    def test_home_page_not_modified(self):
+        """
+        Testing the home page returns 304 when it hasn't changed since it was last loaded
+        :return:
+        """
+        rv = self.home_page()
+        etag = rv.headers['ETag']
+        assert etag.startswith('W/')
+        assert 'public' in rv.headers['Cache-Control']
+        assert 'Cookie' in rv.headers['Vary']
+        rv = self.home_page(etag)
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b'')
+
+    def test_catalogue_version_changes_within_one_clock_tick(self):
+        """
+        Testing every change to the catalogue gives a new version, even if the version file's modification time
+        doesn't change
+        :return:
+        """
+        path = app.config['CATALOGUE_VERSION_FILE']
+        versions = []
+        for _ in range(3):
+            versions.append(bump_catalogue_version())
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(catalogue_version(), versions[-1])
+        self.assertEqual(len(set(versions)), 3)
+
+    def test_home_page_modified_when_product_added(self):
+        """
+        Testing the home page is rendered again once the catalogue has changed
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        etag = self.home_page().headers['ETag']
+        self.create_product("Apple Watch Ultra", 10000, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        rv = self.home_page(etag)
+        self.assertEqual(rv.status_code, 200)
+        assert 'private' in rv.headers['Cache-Control']
+        assert 'Apple Watch Ultra' in rv.data.decode('utf-8')
+
+    def test_search_with_query_string(self):
+        """
+        Searching for a product using the query string
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10000, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        rv = self.client.get('/search?search=Apple', follow_redirects=True)
+        assert 'Apple Watch Ultra' in rv.data.decode('utf-8')
+        rv = self.client.get('/search?search=Apple', headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+
+    def test_manage_customers_is_streamed(self):
+        """
+        Testing the manage customers page is streamed to the administrator
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        rv = self.client.get('/customers')
+        self.assertTrue(rv.is_streamed)
+        assert 'admin@admin.com' in rv.data.decode('utf-8')
+
+    def test_admin_pages_are_streamed_in_chunks(self):
+        """
+        Testing the admin tables read every row in order a chunk at a time, without a read transaction left open
+        while each chunk is sent
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        for number in range(4):
+            self.register(f"test{number}", f"test{number}@test.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Apple Watch SE", 10, 199.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Xbox Series X", 10, 500, "Microsoft Game Console", 'AppleWatch.jpg')
+        # Products added before the date was recorded come first
+        Product.query.filter_by(id=3).update({'date_added': None})
+        db.session.commit()
+        self.add_to_cart(1)
+        self.add_to_cart(2)
+        self.place_order()
+        app.config['STREAM_BATCH_SIZE'] = 2
+        try:
+            rv = self.client.get('/customers')
+            self.addCleanup(rv.close)
+            chunks = []
+            for chunk in rv.response:
+                chunks.append(chunk)
+                self.assertFalse(db.session().in_transaction())
+            page = b''.join(chunks).decode('utf-8')
+            positions = [page.index(f'test{number}@test.com') for number in range(4)]
+            self.assertEqual(positions, sorted(positions))
+            page = self.view_products().data.decode('utf-8')
+            positions = [page.index(name) for name in ('Xbox Series X', 'Apple Watch Ultra', 'Apple Watch SE')]
+            self.assertEqual(positions, sorted(positions))
+            page = self.view_orders().data.decode('utf-8')
+            positions = [page.index(name) for name in ('Apple Watch Ultra', 'Apple Watch SE')]
+            self.assertEqual(positions, sorted(positions))
+            assert 'admin@admin.com' in page
+        finally:
+            app.config['STREAM_BATCH_SIZE'] = 500
+
+    def test_manage_products_with_no_products(self):
+        """
+        Testing the manage products page when there are no products
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        rv = self.view_products()
+        assert 'No Shop Items' in rv.data.decode('utf-8')
+
+    def test_view_orders(self):
+        """
+        Testing the administrator can view all orders
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10000, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.add_to_cart(1)
+        self.place_order()
+        rv = self.view_orders()
+        assert 'Update Status' in rv.data.decode('utf-8')
+        assert 'Order Placed Successfully' not in rv.data.decode('utf-8')
+
+    def test_export_products_as_csv(self):
+        """
+        Exporting the products as CSV
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10000, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Xbox Series X", 20000, 500, "Microsoft Game Console", 'AppleWatch.jpg')
+        rv = self.client.get('/export/products?format=csv')
+        lines = rv.data.decode('utf-8').splitlines()
+        self.assertEqual(rv.mimetype, 'text/csv')
+        assert lines[0].startswith('id,name,price_pence')
+        self.assertEqual(len(lines), 3)
+        rv = self.client.get('/export/products?format=csv&after=1')
+        assert 'Apple Watch Ultra' not in rv.data.decode('utf-8')
+        assert 'Xbox Series X' in rv.data.decode('utf-8')
+
+    def test_export_products_added_in_a_date_range(self):
+        """
+        Exporting the products added between two dates, each product has the time it was added
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10000, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        # The first product was added ten days ago
+        today = datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+        Product.query.filter_by(id=1).update({'date_added': today - datetime.timedelta(days=10)})
+        db.session.commit()
+        self.create_product("Xbox Series X", 20000, 500, "Microsoft Game Console", 'AppleWatch.jpg')
+        self.assertGreaterEqual(db.session.get(Product, 2).date_added, today)
+        start = (today - datetime.timedelta(days=5)).date().isoformat()
+        rv = self.client.get(f'/export/products?format=ndjson&start={start}')
+        self.assertEqual([json.loads(line)['name'] for line in rv.data.decode('utf-8').splitlines()],
+                         ['Xbox Series X'])
+        rv = self.client.get(f'/export/products?format=ndjson&end={start}')
+        self.assertEqual([json.loads(line)['name'] for line in rv.data.decode('utf-8').splitlines()],
+                         ['Apple Watch Ultra'])
+
+    def test_export_orders_as_ndjson_filtered_by_status(self):
+        """
+        Exporting the orders with a given status as NDJSON
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10000, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.add_to_cart(1)
+        self.place_order()
+        rv = self.client.get('/export/orders?format=ndjson&status=Pending')
+        self.assertEqual(len(rv.data.decode('utf-8').splitlines()), 1)
+        assert '"status": "Pending"' in rv.data.decode('utf-8')
+        rv = self.client.get('/export/orders?format=ndjson&status=Delivered')
+        self.assertEqual(rv.data, b'')
+
+    def test_export_orders_placed_in_a_date_range(self):
+        """
+        Exporting the orders placed between two dates, each order has the time it was placed
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10000, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.add_to_cart(1)
+        self.place_order()
+        # The first order was placed ten days ago
+        today = datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+        Order.query.filter_by(id=1).update({'placed_at': today - datetime.timedelta(days=10)})
+        db.session.commit()
+        self.add_to_cart(1)
+        self.place_order()
+        start = (today - datetime.timedelta(days=5)).date().isoformat()
+        rv = self.client.get(f'/export/orders?format=ndjson&start={start}')
+        orders = [json.loads(line) for line in rv.data.decode('utf-8').splitlines()]
+        self.assertEqual([order['id'] for order in orders], [2])
+        self.assertGreaterEqual(orders[0]['placed_at'], today.isoformat(' '))
+        rv = self.client.get(f'/export/orders?format=csv&end={start}')
+        lines = rv.data.decode('utf-8').splitlines()
+        self.assertEqual(lines[0].split(',')[-1], 'placed_at')
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], ['1'])
+
+    def test_export_with_invalid_filter(self):
+        """
+        Testing an error is returned if an export filter is not valid
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        rv = self.client.get('/export/customers?start=yesterday')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_access_denied_when_non_admin_attempts_to_export(self):
+        """
+        Testing access is denied if a non-admin user attempts to export a table
+        :return:
+        """
+        self.register("test", "test@test.com", "123456", "123456")
+        self.login("test@test.com", "123456")
+        rv = self.client.get('/export/customers')
+        assert 'Access Denied' in rv.data.decode('utf-8')
+
+    def test_import_products_from_csv(self):
+        """
+        Importing products from a CSV file, updating products that already exist
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10000, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        rv = self.import_products(
+            b"product_name,price,quantity,description,product_image\n"
+            b"Apple Watch Ultra,650,5,Apple Smart Watch,AppleWatch.jpg\n"
+            b"Xbox Series X,500,20,Microsoft Game Console,AppleWatch.jpg\n"
+            b"PlayStation 5,,20,Sony Game Console,AppleWatch.jpg\n",
+            'products.csv')
+        assert '1 products created, 1 updated, 1 rows failed' in rv.data.decode('utf-8')
+        self.assertEqual(Product.query.filter_by(name="Apple Watch Ultra").first().price_pence, 65000)
+        self.assertIsNotNone(Product.query.filter_by(name="Xbox Series X").first())
+        self.assertIsNone(Product.query.filter_by(name="PlayStation 5").first())
+
+    def test_import_products_from_json(self):
+        """
+        Importing products from a JSON file read in small pieces
+        :return:
+        """
+        products = io.StringIO(
+            '[{"name": "Xbox Series X", "price": 500, "quantity": 20, "description": "Console",'
+            ' "image": "AppleWatch.jpg"},\n {"name": "PlayStation 5", "price": 480, "quantity": 10,'
+            ' "description": "Console", "image": "missing.jpg"}]')
+        report = import_products(iter_json_rows(products, read_size=16))
+        self.assertEqual(report.created, 1)
+        self.assertEqual([error.row_number for error in report.errors], [2])
+
+    def test_access_denied_if_non_admin_attempts_to_import_products(self):
+        """
+        Testing access is denied if a non-admin user attempts to import products
+        :return:
+        """
+        self.register("test", "test@test.com", "123456", "123456")
+        self.login("test@test.com", "123456")
+        rv = self.import_products(b"product_name\n", 'products.csv')
+        assert 'Access Denied' in rv.data.decode('utf-8')
+
+    def test_bulk_update_items(self):
+        """
+        Changing the price and stock of many products at once
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10, 800, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Xbox Series X", 20, 500, "Microsoft Game Console", 'AppleWatch.jpg')
+        rv = self.bulk_update_items(all_products='y', price_change='percent', price_value=-10,
+                                    quantity_change='adjust', quantity_value=-15)
+        assert '2 Products Updated Successfully' in rv.data.decode('utf-8')
+        self.assertEqual([(product.price_pence, product.quantity) for product in Product.query.order_by(Product.id)],
+                         [(72000, 0), (45000, 5)])
+
+    def test_bulk_price_reduction_leaves_every_price_at_least_a_penny(self):
+        """
+        Testing a large percentage reduction never takes a price below 1 pence
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10, 800, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Phone Case Sticker", 20, 0.01, "Sticker", 'AppleWatch.jpg')
+        self.bulk_update_items(all_products='y', price_change='percent', price_value=-99.9, quantity_change='none')
+        self.assertEqual([product.price_pence for product in Product.query.order_by(Product.id)], [80, 1])
+        rv = self.bulk_update_items(all_products='y', price_change='set', price_value=0.001, quantity_change='none')
+        assert 'The price must be at least 1 pence' in rv.data.decode('utf-8')
+        self.assertEqual([product.price_pence for product in Product.query.order_by(Product.id)], [80, 1])
+
+    def test_error_raised_if_no_products_chosen_for_bulk_update(self):
+        """
+        Testing an error is raised if no products are chosen for a bulk update
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        rv = self.bulk_update_items(price_change='set', price_value=10, quantity_change='none')
+        assert 'Choose the products to update' in rv.data.decode('utf-8')
+
+    def test_bulk_update_orders(self):
+        """
+        Changing the status of every order with a given status
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10000, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Xbox Series X", 20000, 500, "Microsoft Game Console", 'AppleWatch.jpg')
+        self.add_to_cart(1)
+        self.add_to_cart(2)
+        self.place_order()
+        self.update_order(1, "Accepted")
+        rv = self.bulk_update_orders(current_status='Accepted', order_ids='', new_status='Out for delivery')
+        assert '1 Orders Updated successfully' in rv.data.decode('utf-8')
+        self.assertEqual([order.status for order in Order.query.order_by(Order.id)], ['Out for delivery', 'Pending'])
+
+    def test_access_denied_when_non_admin_attempts_bulk_update(self):
+        """
+        Testing access is denied if a non-admin user attempts a bulk update
+        :return:
+        """
+        self.register("test", "test@test.com", "123456", "123456")
+        self.login("test@test.com", "123456")
+        rv = self.bulk_update_orders(current_status='Pending', new_status='Delivered')
+        assert 'Access Denied' in rv.data.decode('utf-8')
+        rv = self.bulk_update_items(all_products='y', price_change='set', price_value=1)
+        assert 'Access Denied' in rv.data.decode('utf-8')
+
+    def test_error_raised_when_adding_more_than_is_in_stock_to_cart(self):
+        """
+        Testing an item isn't added to the cart if all of its stock is already held
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 1, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.add_to_cart(1)
+        self.add_to_cart(1)
+        rv = self.view_cart()
+        assert 'Apple Watch Ultra is out of stock' in rv.data.decode('utf-8')
+        assert '<span id="quantity">1</span>' in rv.data.decode('utf-8')
+        rv = self.place_order()
+        assert 'Order Placed Successfully' in rv.data.decode('utf-8')
+        self.assertEqual(db.session.get(Product, 1).quantity, 0)
+        self.assertEqual(db.session.get(ReservedStock, 1).quantity, 0)
+
+    def test_expired_stock_holds_are_released(self):
+        """
+        Testing stock held by an expired hold can be held by another customer
+        :return:
+        """
+        self.register("test", "test@test.com", "123456", "123456")
+        self.register("test2", "test2@test.com", "123456", "123456")
+        db.session.add(Product(name="Apple Watch Ultra", price_pence=79999, quantity=2,
+                               description="Apple Smart Watch", product_image='./media/AppleWatch.jpg'))
+        db.session.commit()
+        reserve(1, 1, 2)
+        db.session.commit()
+        self.assertEqual(available_to_sell(1), 0)
+        with self.assertRaises(OutOfStockError):
+            reserve(2, 1)
+        db.session.rollback()
+        StockHold.query.update({StockHold.expires_at: StockHold.expires_at - datetime.timedelta(days=1)})
+        db.session.commit()
+        reserve(2, 1)
+        db.session.commit()
+        self.assertEqual(available_to_sell(1), 1)
+        StockHold.query.update({StockHold.expires_at: StockHold.expires_at - datetime.timedelta(days=1)})
+        db.session.commit()
+        self.assertEqual(sweep_expired_holds(), 1)
+        self.assertEqual(available_to_sell(1), 2)
+
+    def test_sharded_stock(self):
+        """
+        Testing the stock of a sharded product is taken from its shards and summed for display
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        shard_stock(1, 4)
+        self.assertEqual(sorted(shard.quantity for shard in StockShard.query), [2, 2, 3, 3])
+        self.add_to_cart(1)
+        self.add_to_cart(1)
+        # The holds are in the shards, the product's reserved stock row isn't updated
+        self.assertEqual(sum(shard.reserved for shard in StockShard.query), 2)
+        self.assertEqual(db.session.get(ReservedStock, 1).quantity, 0)
+        self.assertEqual(available_to_sell(1), 8)
+        self.client.get('/')
+        home = self.client.get('/')
+        self.place_order()
+        self.assertEqual(sum(shard.quantity for shard in StockShard.query), 8)
+        self.assertEqual(sum(shard.reserved for shard in StockShard.query), 0)
+        self.assertEqual(db.session.get(ReservedStock, 1).quantity, 0)
+        self.assertEqual(available_to_sell(1), 8)
+        # The sale shows on the home page before the product's quantity is refreshed
+        self.assertEqual(db.session.get(Product, 1).quantity, 10)
+        rv = self.client.get('/', headers={'If-None-Match': home.headers['ETag']})
+        self.assertEqual(rv.status_code, 200)
+        assert '8 Items Left' in rv.data.decode('utf-8')
+        self.assertEqual(self.client.get('/api/v1/products/1').get_json()['quantity'], 8)
+        sweep()
+        self.assertEqual(db.session.get(Product, 1).quantity, 8)
+        self.bulk_update_items(product_ids='1', price_change='none', quantity_change='adjust', quantity_value=4)
+        self.assertEqual(sorted(shard.quantity for shard in StockShard.query), [3, 3, 3, 3])
+
+    def test_payment_taken_in_background_after_order_placed(self):
+        """
+        Testing placing an order queues its payment and a worker records the payment id
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.add_to_cart(1)
+        rv = self.place_order()
+        assert 'Order Placed Successfully' in rv.data.decode('utf-8')
+        self.assertEqual(db.session.get(Order, 1).payment_id, 'pending')
+        self.assertEqual(Job.query.one().kind, 'take_payment')
+        self.assertEqual(run_pending_jobs(), 1)
+        self.assertTrue(db.session.get(Order, 1).payment_id.startswith('stub_'))
+        self.assertEqual(Job.query.one().status, DONE)
+
+    def test_failing_job_is_retried_then_dead_lettered(self):
+        """
+        Testing a job that keeps failing is retried and then kept as a dead job
+        :return:
+        """
+        attempts = []
+
+        @job_handler('always_fails')
+        def always_fails():
+            attempts.append(1)
+            raise RuntimeError('Payment provider unavailable')
+
+        app.config['JOB_RETRY_DELAY'] = 0
+        try:
+            enqueue('always_fails', {}, idempotency_key='fails')
+            enqueue('always_fails', {}, idempotency_key='fails')
+            db.session.commit()
+            run_pending_jobs()
+        finally:
+            app.config['JOB_RETRY_DELAY'] = 30
+        job = Job.query.one()
+        self.assertEqual(len(attempts), app.config['JOB_MAX_ATTEMPTS'])
+        self.assertEqual(job.status, DEAD)
+        assert 'Payment provider unavailable' in job.last_error
+
+    def test_job_that_stops_its_worker_is_dead_lettered(self):
+        """
+        Testing a job whose worker stopped during its last attempt is dead-lettered instead of claimed again
+        :return:
+        """
+        enqueue('take_payment', {}, idempotency_key='stops-worker')
+        db.session.commit()
+        # The lease of the last attempt has expired without the worker recording the outcome
+        Job.query.update({'status': 'running', 'attempts': app.config['JOB_MAX_ATTEMPTS'],
+                          'locked_until': datetime.datetime.now(datetime.UTC) - datetime.timedelta(seconds=1)})
+        db.session.commit()
+        self.assertEqual(run_pending_jobs(), 0)
+        job = Job.query.one()
+        self.assertEqual(job.status, DEAD)
+        self.assertEqual(job.attempts, app.config['JOB_MAX_ATTEMPTS'])
+
+    def test_worker_that_lost_its_lease_cannot_change_the_job(self):
+        """
+        Testing a worker whose job was claimed again after its lease ran out can't extend the lease or finish the job
+        :return:
+        """
+        enqueue('take_payment', {}, idempotency_key='lease-lost')
+        db.session.commit()
+        first = claim_job()
+        # The first worker's lease runs out and another worker claims the job
+        Job.query.update({'locked_until': datetime.datetime.now(datetime.UTC) - datetime.timedelta(seconds=1)})
+        db.session.commit()
+        second = claim_job()
+        self.assertNotEqual(first[-1], second[-1])
+        token = current_job.set((first[0], first[-1]))
+        try:
+            with self.assertRaises(LeaseLost):
+                heartbeat()
+        finally:
+            current_job.reset(token)
+        self.assertFalse(finish_job(first[0], first[-1]))
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('running', 2))
+        self.assertTrue(finish_job(second[0], second[-1]))
+        db.session.refresh(job)
+        self.assertEqual(job.status, DONE)
+
+    def test_sales_dashboard(self):
+        """
+        Testing the dashboard shows the sales, top products, order statuses and new customers
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10, 800, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Apple Watch SE", 10, 200, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.add_to_cart(1)
+        self.add_to_cart(2)
+        self.add_to_cart(2)
+        self.place_order()
+        self.update_order(1, 'Delivered')
+        self.bulk_update_orders(current_status='Pending', order_ids='', new_status='Cancelled')
+        figures = dashboard(7)
+        self.assertEqual(len(figures['daily']), 7)
+        self.assertEqual((figures['daily'][0]['orders'], figures['daily'][0]['items']), (1, 3))
+        self.assertEqual(figures['revenue'], 120000)
+        self.assertEqual(figures['daily'][0]['customers'], 1)
+        self.assertEqual([name for name, _, _ in figures['top_products']], ['Apple Watch Ultra', 'Apple Watch SE'])
+        self.assertEqual(dict(figures['statuses']), {'Cancelled': 1, 'Delivered': 1})
+        rv = self.sales_dashboard(7)
+        assert 'Apple Watch Ultra' in rv.data.decode('utf-8')
+
+    def test_rebuild_sales_aggregates(self):
+        """
+        Testing the dashboard figures can be rebuilt from the orders and customers
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10, 800, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.add_to_cart(1)
+        self.add_to_cart(1)
+        self.place_order()
+        ProductSales.query.delete()
+        OrderStatusCount.query.delete()
+        SalesDay.query.delete()
+        db.session.commit()
+        self.assertEqual(rebuild_aggregates(), (1, 1))
+        product_sales = db.session.get(ProductSales, 1)
+        self.assertEqual((product_sales.quantity, product_sales.revenue_pence), (2, 160000))
+        daily = dashboard(1)['daily'][0]
+        self.assertEqual((daily['orders'], daily['items'], daily['revenue'], daily['customers']), (1, 2, 160000, 1))
+
+    def test_access_denied_when_non_admin_views_sales_dashboard(self):
+        """
+        Testing a non admin can't view the sales dashboard
+        :return:
+        """
+        self.register("test", "test@test.com", "123456", "123456")
+        self.login("test@test.com", "123456")
+        rv = self.sales_dashboard()
+        assert 'Access Denied' in rv.data.decode('utf-8')
+
+    def test_money_is_added_up_exactly_in_pence(self):
+        """
+        Testing prices are stored in pence and totals are exact
+        :return:
+        """
+        self.assertEqual([to_pence('19.99'), to_pence(0.285), to_pence(0.1 + 0.2)], [1999, 29, 30])
+        self.assertEqual([format_money(79999), format_money(5), format_money(-150)], ['799.99', '0.05', '-1.50'])
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Pencil", 100, 0.1, "Pencil", 'AppleWatch.jpg')
+        self.assertEqual(db.session.get(Product, 1).price_pence, 10)
+        for _ in range(3):
+            self.add_to_cart(1)
+        self.assertEqual(cart_total(1), 30)
+        rv = self.view_cart()
+        assert '0.30' in rv.data.decode('utf-8')
+        self.place_order()
+        self.assertEqual(orders_total(), 30)
+        self.assertEqual(orders_total(Order.status == 'Delivered'), 0)
+
+    def test_migrations_upgrade_an_older_database(self):
+        """
+        Testing the migrations convert prices to pence, order totals to the price of one item, add the indexes and
+        are only applied once
+        :return:
+        """
+        path = os.path.join(app.instance_path, 'test-migrations.db')
+        url = f'sqlite:///{path}'
+        engine = create_engine(url)
+        try:
+            with engine.begin() as connection:
+                connection.execute(text('CREATE TABLE product (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(100) NOT'
+                                        ' NULL UNIQUE, price FLOAT NOT NULL, description VARCHAR(1024) NOT NULL,'
+                                        ' quantity INTEGER NOT NULL, product_image VARCHAR(1000) NOT NULL,'
+                                        ' date_added DATETIME)'))
+                connection.execute(text("INSERT INTO product VALUES (1, 'Apple Watch Ultra', 799.99,"
+                                        " 'Apple Smart Watch', 2, './media/AppleWatch.jpg', NULL)"))
+                connection.execute(text("INSERT INTO product VALUES (2, 'Xbox Series X', 500.0,"
+                                        " 'Microsoft Game Console', 5, './media/Xbox.jpg', NULL)"))
+                connection.execute(text('CREATE TABLE "order" (id INTEGER NOT NULL PRIMARY KEY, quantity INTEGER NOT'
+                                        ' NULL, price FLOAT NOT NULL, status VARCHAR(100) NOT NULL, payment_id'
+                                        ' VARCHAR(1000) NOT NULL, customer_id INTEGER NOT NULL, product_id INTEGER'
+                                        ' NOT NULL)'))
+                # Each order's price was the total of its cart: one cart of two watches, one of a watch and two
+                # consoles, and one of a product that has since been deleted
+                connection.execute(text("""INSERT INTO "order" VALUES (1, 2, 1599.98, 'Delivered', '1', 1, 1),
+                                        (2, 1, 1799.99, 'Pending', '1', 2, 1), (3, 2, 1799.99, 'Pending', '1', 2, 2),
+                                        (4, 3, 30.0, 'Delivered', '1', 3, 99)"""))
+            self.assertEqual(upgrade(url), ['0001_initial', '0002_money_in_pence', '0003_hot_path_indexes',
+                                            '0004_password_audits', '0005_order_placed_at',
+                                            '0006_token_generation', '0007_job_claim_tokens',
+                                            '0008_shard_reservations'])
+            with engine.connect() as connection:
+                products = connection.execute(text('SELECT price_pence, quantity FROM product ORDER BY id')).all()
+                # Orders are converted to the price of one item
+                order_prices = connection.execute(text('SELECT price_pence FROM "order" ORDER BY id')).scalars().all()
+                # The time the old orders were placed isn't known
+                placed = connection.execute(text('SELECT DISTINCT placed_at FROM "order"')).scalars().all()
+                indexes = {index['name'] for index in inspect(connection).get_indexes('cart')}
+            self.assertEqual(products, [(79999, 2), (50000, 5)])
+            self.assertEqual(order_prices, [79999, 79999, 50000, 1000])
+            self.assertEqual(placed, [None])
+            self.assertEqual(indexes, {'ix_cart_customer_id_product_id', 'ix_cart_product_id'})
+            self.assertEqual(upgrade(url), [])
+            self.assertTrue(all(applied for _, applied in status(url)))
+        finally:
+            engine.dispose()
+            os.remove(path)
+
+    def test_migration_adds_the_time_orders_were_placed(self):
+        """
+        Testing a database already using pence is given the column for the time orders were placed
+        :return:
+        """
+        path = os.path.join(app.instance_path, 'test-migrations.db')
+        url = f'sqlite:///{path}'
+        engine = create_engine(url)
+        try:
+            upgrade(url)
+            with engine.begin() as connection:
+                connection.execute(text('ALTER TABLE "order" DROP COLUMN placed_at'))
+                connection.execute(text("DELETE FROM schema_migrations WHERE version = '0005'"))
+            self.assertEqual(upgrade(url), ['0005_order_placed_at'])
+            with engine.connect() as connection:
+                columns = {column['name'] for column in inspect(connection).get_columns('order')}
+            self.assertIn('placed_at', columns)
+        finally:
+            engine.dispose()
+            os.remove(path)
+
+    def test_routes_do_not_scan_whole_tables(self):
+        """
+        Testing the queries run by the shopping routes use indexes instead of reading every row
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        with QueryPlanRecorder() as recorder:
+            self.profile(1)
+            self.add_to_cart(1)
+            self.add_to_cart(1)
+            self.increase_cart_quantity(1)
+            self.decrease_cart_quantity(1)
+            self.view_cart()
+            self.place_order()
+            self.viewer_my_orders()
+            # The manage orders page the updates redirect to lists every order so it isn't followed
+            self.client.post('/update-order/1', data={'order_status': 'Delivered'})
+            self.client.post('/bulk-update-orders', data={'current_status': 'Delivered', 'new_status': 'Cancelled'})
+        self.assertTrue(recorder.statements)
+        self.assertEqual(recorder.full_scans(), {})
+
+    def test_cart_badge_shown_on_every_page(self):
+        """
+        Testing the number of lines in the cart is shown in the navigation bar of every page
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Xbox Series X", 20, 500, "Microsoft Game Console", 'AppleWatch.jpg')
+        self.add_to_cart(1)
+        self.add_to_cart(1)
+        self.add_to_cart(2)
+        assert 'bi-2-square-fill' in self.home_page().data.decode('utf-8')
+        assert 'bi-2-square-fill' in self.viewer_my_orders().data.decode('utf-8')
+        self.remove_from_cart(2)
+        assert 'bi-1-square-fill' in self.profile(1).data.decode('utf-8')
+        self.place_order()
+        assert 'bi-1-square-fill' not in self.viewer_my_orders().data.decode('utf-8')
+
+    def test_register_without_checking_for_taken_details_first(self):
+        """
+        Testing a sign-up inserts the account without looking it up first and reports both taken details
+        :return:
+        """
+        statements = []
+
+        def record(connection, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.client.post('/register', data=dict(username="test", email="test@test.com", password="123456",
+                                                    confirm_password="123456"))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        # Nothing is looked up before the account is inserted
+        inserted = next(index for index, statement in enumerate(statements)
+                        if statement.startswith('INSERT INTO customer'))
+        self.assertEqual([statement for statement in statements[:inserted] if statement.startswith('SELECT')], [])
+        self.logout()
+        rv = self.register("test", "test@test.com", "123456", "123456")
+        assert "Please try a different username" in rv.data.decode('utf-8')
+        assert "Please try a different email" in rv.data.decode('utf-8')
+        self.assertEqual(Customer.query.filter_by(username="test").count(), 1)
+
+    def test_password_rehashed_on_login_when_cost_changes(self):
+        """
+        Testing a password hashed with an older cost is hashed again with the current cost when logging in
+        :return:
+        """
+        rounds = app.config['BCRYPT_LOG_ROUNDS']
+        try:
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+            self.register("test", "test@test.com", "123456", "123456")
+            self.assertEqual(hash_cost(Customer.query.filter_by(username="test").one().password_hash), 4)
+            self.logout()
+            app.config['BCRYPT_LOG_ROUNDS'] = 5
+            self.login("test@test.com", "wrong password")
+            self.assertEqual(hash_cost(Customer.query.filter_by(username="test").one().password_hash), 4)
+            rv = self.login("test@test.com", "123456")
+            assert 'You are now logged in as: test' in rv.data.decode('utf-8')
+            db.session.expire_all()
+            self.assertEqual(hash_cost(Customer.query.filter_by(username="test").one().password_hash), 5)
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = rounds
+
+    def test_login_rate_limited_before_database_is_queried(self):
+        """
+        Testing logins over the limit for an account are rejected without querying the database
+        :return:
+        """
+        self.register("test", "test@test.com", "123456", "123456")
+        self.logout()
+        limits = app.config['RATE_LIMITS']
+        app.config['RATE_LIMIT_ENABLED'] = True
+        app.config['RATE_LIMITS'] = {'login_page': [('account', 2, 60, ('POST',))]}
+        statements = []
+
+        def record(connection, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        try:
+            get_store().reset()
+            self.login("test@test.com", "wrong password")
+            self.login("test@test.com", "wrong password")
+            event.listen(db.engine, 'before_cursor_execute', record)
+            rv = self.login("TEST@test.com", "123456")
+            event.remove(db.engine, 'before_cursor_execute', record)
+            self.assertEqual(rv.status_code, 429)
+            self.assertEqual(statements, [])
+            self.assertIn('Retry-After', rv.headers)
+            rv = self.login("test2@test.com", "123456")
+            self.assertNotEqual(rv.status_code, 429)
+        finally:
+            app.config['RATE_LIMIT_ENABLED'] = False
+            app.config['RATE_LIMITS'] = limits
+
+    def test_rate_limits_shared_through_sqlite_store(self):
+        """
+        Testing the SQLite store shares buckets between stores using the same file, like separate workers
+        :return:
+        """
+        path = os.path.join(app.instance_path, 'test-rate-limits.db')
+        first, second = SQLiteStore(path), SQLiteStore(path)
+        try:
+            first.reset()
+            self.assertEqual(first.take('ip:1', 2, 1, 100), 0)
+            self.assertEqual(second.take('ip:1', 2, 1, 100), 0)
+            self.assertEqual(first.take('ip:1', 2, 1, 100), 1)
+            self.assertEqual(second.take('ip:1', 2, 1, 101), 0)
+        finally:
+            first.connection().close()
+            second.connection().close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def test_sqlite_store_prunes_refilled_buckets(self):
+        """
+        Testing the SQLite store removes the buckets that haven't been used for longer than the longest limit
+        :return:
+        """
+        path = os.path.join(app.instance_path, 'test-rate-limits.db')
+        store = SQLiteStore(path, max_age=60, prune_interval=10)
+        try:
+            store.reset()
+            store.take('ip:1', 2, 1, 100)
+            store.take('ip:2', 2, 1, 150)
+            self.assertEqual(store.connection().execute('SELECT COUNT(*) FROM bucket').fetchone()[0], 2)
+            # Buckets are only pruned once per interval
+            store.take('ip:2', 2, 1, 165)
+            store.take('ip:2', 2, 1, 170)
+            self.assertEqual(store.connection().execute('SELECT key FROM bucket').fetchall(), [('ip:2',)])
+            self.assertEqual(store.pruned_at, 165)
+        finally:
+            store.connection().close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def test_rate_limits_count_the_client_behind_trusted_proxies(self):
+        """
+        Testing requests through a trusted proxy are counted against the address it forwarded them for
+        :return:
+        """
+        limits = app.config['RATE_LIMITS']
+        app.config['RATE_LIMIT_ENABLED'] = True
+        app.config['RATE_LIMITS'] = {'login_page': [('ip', 1, 60, ('POST',))]}
+        try:
+            for proxies, statuses in ((0, [200, 429]), (1, [200, 200])):
+                app.config['TRUSTED_PROXIES'] = proxies
+                configure_proxies()
+                get_store().reset()
+                rv = [self.client.post('/login', data={}, headers={'X-Forwarded-For': address}).status_code
+                      for address in ('10.0.0.1', '10.0.0.2')]
+                self.assertEqual(rv, statuses)
+        finally:
+            app.config['RATE_LIMIT_ENABLED'] = False
+            app.config['RATE_LIMITS'] = limits
+            app.config['TRUSTED_PROXIES'] = 0
+            configure_proxies()
+
+    def test_password_audit(self):
+        """
+        Testing the audit finds the accounts with a common password, whether checked inline or by a pool
+        :return:
+        """
+        rounds = app.config['BCRYPT_LOG_ROUNDS']
+        try:
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+            self.register("test", "test@test.com", "123456", "123456")
+            self.register("test2", "test2@test.com", "a much stronger password", "a much stronger password")
+            weak_id = Customer.query.filter_by(username="test").one().id
+            strong_id = Customer.query.filter_by(username="test2").one().id
+            for processes in (1, 2):
+                audit = start_audit()
+                db.session.commit()
+                weak = audit_passwords(audit.id, processes)
+                db.session.expire_all()
+                self.assertEqual((audit.status, audit.accounts_checked), ('done', Customer.query.count()))
+                weak_ids = [weak_account.customer_id for weak_account in audit.weak_accounts]
+                self.assertEqual(len(weak_ids), weak)
+                self.assertIn(weak_id, weak_ids)
+                self.assertNotIn(strong_id, weak_ids)
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = rounds
+
+    def test_password_audit_checks_a_large_wordlist_a_piece_at_a_time(self):
+        """
+        Testing a wordlist larger than the cache is split into pieces that together hold every password, and the
+        audit still finds a password in its last piece
+        :return:
+        """
+        path = app.config['PASSWORD_AUDIT_WORDLIST']
+        pieces = wordlist_pieces(path, 40, 1000)
+        self.assertEqual(len(wordlist_pieces(path, 1000, 10)), 5)
+        self.assertGreater(len(pieces), 1)
+        self.assertEqual([password for piece in pieces for password in read_wordlist_piece(path, *piece)],
+                         list(load_wordlist(path)))
+        rounds = app.config['BCRYPT_LOG_ROUNDS']
+        cache_bytes = app.config['PASSWORD_AUDIT_CACHE_BYTES']
+        try:
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+            app.config['PASSWORD_AUDIT_CACHE_BYTES'] = 40
+            self.register("test", "test@test.com", "maggie", "maggie")
+            self.register("test2", "test2@test.com", "a much stronger password", "a much stronger password")
+            for processes in (1, 2):
+                audit = start_audit()
+                db.session.commit()
+                self.assertEqual(audit_passwords(audit.id, processes), 1)
+                self.assertEqual([weak_account.customer_id for weak_account in audit.weak_accounts], [1])
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = rounds
+            app.config['PASSWORD_AUDIT_CACHE_BYTES'] = cache_bytes
+
+    def test_password_audit_keeps_its_lease_through_a_long_batch(self):
+        """
+        Testing an audit whose batch takes longer than the job's lease renews the lease as it goes, so the job could
+        never be claimed by another worker while it runs
+        :return:
+        """
+        settings = {key: app.config[key] for key in ('BCRYPT_LOG_ROUNDS', 'JOB_LEASE_SECONDS',
+                                                     'PASSWORD_AUDIT_PROCESSES')}
+        is_weak = password_audit.is_weak
+        reclaimable = []
+
+        def checking_lease(*args, **kwargs):
+            # A job is claimed again once its lease has run out
+            reclaimable.append(db.session.scalar(select(func.count()).select_from(Job)
+                                                 .where(Job.locked_until <= utc_now())))
+            return is_weak(*args, **kwargs)
+
+        try:
+            app.config.update(BCRYPT_LOG_ROUNDS=7, JOB_LEASE_SECONDS=0.2, PASSWORD_AUDIT_PROCESSES=1)
+            self.register("test", "test@test.com", "a much stronger password", "a much stronger password")
+            self.register("test2", "test2@test.com", "maggie", "maggie")
+            audit = start_audit()
+            enqueue('password_audit', {'audit_id': audit.id})
+            db.session.commit()
+            password_audit.is_weak = checking_lease
+            started = time.monotonic()
+            self.assertEqual(run_pending_jobs(), 1)
+            # The whole batch took longer than the lease
+            self.assertGreater(time.monotonic() - started, 0.2)
+            self.assertEqual(set(reclaimable), {0})
+            db.session.expire_all()
+            self.assertEqual((audit.status, [weak.customer_id for weak in audit.weak_accounts]), ('done', [2]))
+            self.assertEqual(Job.query.one().status, DONE)
+        finally:
+            password_audit.is_weak = is_weak
+            app.config.update(settings)
+
+    def test_password_audit_page(self):
+        """
+        Testing the password audit page queues the audit for the workers and shows the weak accounts
+        :return:
+        """
+        rounds = app.config['BCRYPT_LOG_ROUNDS']
+        try:
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+            self.register("admin", "admin@admin.com", "123456", "123456")
+            self.login("admin@admin.com", "123456")
+            rv = self.password_audit(start=True)
+            assert 'The password audit has been started' in rv.data.decode('utf-8')
+            self.assertEqual(Job.query.filter_by(kind='password_audit').count(), 1)
+            app.config['PASSWORD_AUDIT_PROCESSES'] = 1
+            self.assertEqual(run_pending_jobs(), 1)
+            rv = self.password_audit()
+            assert f'done, {Customer.query.count()} accounts checked' in rv.data.decode('utf-8')
+            assert 'admin@admin.com' in rv.data.decode('utf-8')
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = rounds
+            app.config['PASSWORD_AUDIT_PROCESSES'] = None
+
+    def test_breached_password_filter(self):
+        """
+        Testing the filter finds every breached password and few others, from plain text or hashed lists
+        :return:
+        """
+        path = os.path.join(app.instance_path, 'test-breached.bloom')
+        passwords = [f'breached{number}' for number in range(1000)]
+        try:
+            self.assertEqual(build_filter(path, passwords, len(passwords), 0.01), 1000)
+            bloom_filter = BloomFilter(path)
+            self.assertTrue(all(password in bloom_filter for password in passwords))
+            false_positives = sum(f'safe{number}' in bloom_filter for number in range(10000))
+            self.assertLess(false_positives, 200)
+            bloom_filter.close()
+            hashes = [f'{hashlib.sha1(password.encode()).hexdigest().upper()}:3' for password in passwords]
+            self.assertEqual(build_filter(path, hashes, len(hashes), 0.01, hashed=True), 1000)
+            bloom_filter = BloomFilter(path)
+            self.assertTrue(all(password in bloom_filter for password in passwords))
+            bloom_filter.close()
+        finally:
+            os.remove(path)
+
+    def test_breached_passwords_rejected(self):
+        """
+        Testing a breached password can't be used to register or as a new password
+        :return:
+        """
+        path = os.path.join(app.instance_path, 'test-breached.bloom')
+        filter_path = app.config['BREACHED_PASSWORDS_FILTER']
+        try:
+            build_filter(path, ['password1'], 1, 0.001)
+            app.config['BREACHED_PASSWORDS_FILTER'] = path
+            rv = self.register("test", "test@test.com", "password1", "password1")
+            assert 'This password has appeared in a data breach' in rv.data.decode('utf-8')
+            self.assertIsNone(Customer.query.filter_by(email="test@test.com").first())
+            self.register("test", "test@test.com", "123456", "123456")
+            self.login("test@test.com", "123456")
+            customer_id = Customer.query.filter_by(email="test@test.com").one().id
+            rv = self.client.post(f'/change_password/{customer_id}', data=dict(
+                current_password='123456', new_password='password1', confirm_password='password1'
+            ), follow_redirects=True)
+            assert 'This password has appeared in a data breach' in rv.data.decode('utf-8')
+            self.assertTrue(Customer.query.get(customer_id).verify_password('123456'))
+        finally:
+            app.config['BREACHED_PASSWORDS_FILTER'] = filter_path
+            os.remove(path)
+
+    def test_request_logging(self):
+        """
+        Testing each request is logged as JSON with its id, endpoint and latency by the background thread
+        :return:
+        """
+        records = []
+        capture = logging.Handler()
+        capture.setFormatter(JSONFormatter())
+        capture.emit = lambda record: records.append(json.loads(capture.format(record)))
+        handlers = queue_listener.handlers
+        rates = dict(app.config['LOG_SAMPLE_RATES'])
+        try:
+            queue_listener.handlers = (capture,)
+            app.config['LOG_SAMPLE_RATES']['main.access'] = 1
+            rv = self.client.get('/', headers={'X-Request-ID': 'test-request'})
+            self.assertEqual(rv.headers['X-Request-ID'], 'test-request')
+            self.client.get('/no-such-page')
+            queue_handler.queue.join()
+        finally:
+            queue_listener.handlers = handlers
+            app.config['LOG_SAMPLE_RATES'].update(rates)
+        access = [record for record in records if record['logger'] == 'main.access']
+        self.assertEqual(access[0]['request_id'], 'test-request')
+        self.assertEqual((access[0]['endpoint'], access[0]['status']), ('home_page', 200))
+        self.assertIn('latency_ms', access[0])
+        not_found = [record for record in records if record['message'].startswith('Page not found')]
+        self.assertEqual(not_found[0]['request_id'], access[1]['request_id'])
+
+    def test_logging_from_forked_process(self):
+        """
+        Testing records logged by a forked process, such as a job worker, are written by a thread of its own
+        :return:
+        """
+        handlers = queue_listener.handlers
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'worker.log')
+            output = logging.FileHandler(path, encoding='utf-8')
+            output.setFormatter(JSONFormatter())
+            try:
+                queue_listener.handlers = (output,)
+                worker = multiprocessing.get_context('fork').Process(
+                    target=app.logger.warning, args=('Logged by worker %s', 1)
+                )
+                worker.start()
+                worker.join()
+            finally:
+                queue_listener.handlers = handlers
+                output.close()
+            with open(path, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual([record['message'] for record in records], ['Logged by worker 1'])
+
+    def test_full_log_queue_drops_records(self):
+        """
+        Testing records are dropped instead of waiting when the log queue is full
+        :return:
+        """
+        handler = DroppingQueueHandler(queue.Queue(1))
+        for number in range(3):
+            handler.handle(logging.LogRecord('main', logging.INFO, __file__, 1, 'Record %s', (number,), None))
+        self.assertEqual(handler.dropped, 2)
+        self.assertEqual(handler.queue.get_nowait().getMessage(), 'Record 0')
+
+    def test_api_tokens(self):
+        """
+        Testing the JSON API only accepts valid tokens
+        :return:
+        """
+        self.register("test", "test@test.com", "123456", "123456")
+        rv = self.client.post('/api/v1/tokens', json={'email': 'test@test.com', 'password': 'wrong password'})
+        self.assertEqual(rv.status_code, 401)
+        self.assertEqual(self.client.get('/api/v1/cart').status_code, 401)
+        rv = self.client.get('/api/v1/cart', headers={'Authorization': 'Bearer not-a-token'})
+        self.assertEqual(rv.status_code, 401)
+        self.assertEqual(rv.headers['WWW-Authenticate'], 'Bearer')
+        headers = self.api_token("test@test.com", "123456")
+        rv = self.client.get('/api/v1/cart', headers=headers)
+        self.assertEqual(rv.json, {'items': [], 'total_pence': 0})
+
+    def test_api_tokens_revoked(self):
+        """
+        Testing tokens stop working once the password is changed or the account is deleted
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.logout()
+        self.register("test", "test@test.com", "123456", "123456")
+        headers = self.api_token("test@test.com", "123456")
+        self.change_password(2, "123456", "12345678", "12345678")
+        self.assertEqual(self.client.get('/api/v1/cart', headers=headers).status_code, 401)
+        headers = self.api_token("test@test.com", "12345678")
+        self.assertEqual(self.client.get('/api/v1/cart', headers=headers).status_code, 200)
+        self.logout()
+        self.login("admin@admin.com", "123456")
+        self.delete_customer(2)
+        self.assertEqual(self.client.get('/api/v1/cart', headers=headers).status_code, 401)
+
+    def test_api_cart_changes_shown_on_pages(self):
+        """
+        Testing changing the cart through the JSON API changes the cart count and home page of a logged-in customer
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 10, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Xbox Series X", 20, 500, "Microsoft Game Console", 'AppleWatch.jpg')
+        self.add_to_cart(1)
+        # The first page shows the flashed message, which stops it being cached
+        self.home_page()
+        rv = self.home_page()
+        assert 'bi-1-square-fill' in rv.data.decode('utf-8')
+        headers = self.api_token("admin@admin.com", "123456")
+        self.client.put('/api/v1/cart/2', json={'quantity': 1}, headers=headers)
+        rv = self.home_page(rv.headers['ETag'])
+        self.assertEqual(rv.status_code, 200)
+        assert 'bi-2-square-fill' in rv.data.decode('utf-8')
+        self.client.delete('/api/v1/cart/1', headers=headers)
+        assert 'bi-1-square-fill' in self.home_page(rv.headers['ETag']).data.decode('utf-8')
+
+    def test_api_products(self):
+        """
+        Testing the JSON API lists products a page at a time with the fields asked for
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        for number in range(3):
+            self.create_product(f"Apple Watch {number}", 10, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        rv = self.client.get('/api/v1/products?limit=2&fields=name,price_pence')
+        self.assertEqual(rv.json['products'], [{'name': 'Apple Watch 0', 'price_pence': 79999},
+                                               {'name': 'Apple Watch 1', 'price_pence': 79999}])
+        rv = self.client.get(f'/api/v1/products?limit=2&after={rv.json["next_after"]}')
+        self.assertEqual([product['name'] for product in rv.json['products']], ['Apple Watch 2'])
+        self.assertIsNone(rv.json['next_after'])
+        self.assertEqual(self.client.get('/api/v1/products?fields=password_hash').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/products/1').json['quantity'], 10)
+        self.assertEqual(self.client.get('/api/v1/products/99').status_code, 404)
+
+    def test_api_cart_and_checkout(self):
+        """
+        Testing the JSON API can fill the cart, check out and list the orders without a query per row
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 3, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Apple Watch SE", 10, 199.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.logout()
+        self.register("test", "test@test.com", "123456", "123456")
+        headers = self.api_token("test@test.com", "123456")
+        rv = self.client.put('/api/v1/cart/1', json={'quantity': 4}, headers=headers)
+        self.assertEqual(rv.status_code, 409)
+        self.client.put('/api/v1/cart/1', json={'quantity': 3}, headers=headers)
+        self.client.put('/api/v1/cart/2', json={'quantity': 2}, headers=headers)
+        rv = self.client.put('/api/v1/cart/1', json={'quantity': 2}, headers=headers)
+        self.assertEqual(rv.json['total_pence'], 2 * 79999 + 2 * 19999)
+        self.assertEqual(available_to_sell(1), 1)
+        statements = []
+
+        def record(connection, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            rv = self.client.post('/api/v1/orders', headers=headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(rv.json['total_pence'], 2 * 79999 + 2 * 19999)
+        # The new orders aren't read back after the commit, and the customer is loaded once
+        self.assertEqual([statement for statement in statements if statement.startswith('SELECT "order"')], [])
+        self.assertEqual(len([statement for statement in statements if 'FROM customer' in statement]), 1)
+        self.assertEqual(self.client.post('/api/v1/orders', headers=headers).status_code, 400)
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            rv = self.client.get('/api/v1/orders?limit=1', headers=headers)
+            rv = self.client.get(f'/api/v1/orders?after={rv.json["next_after"]}', headers=headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        # One query for each page and one checking each token hasn't been revoked
+        self.assertEqual(len(statements), 4)
+        self.assertEqual(rv.json['orders'][0]['product_name'], 'Apple Watch SE')
+        order_id = rv.json['orders'][0]['id']
+        self.assertEqual(self.client.get(f'/api/v1/orders/{order_id}', headers=headers).json['quantity'], 2)
+        other = self.api_token("admin@admin.com", "123456")
+        self.assertEqual(self.client.get(f'/api/v1/orders/{order_id}', headers=other).status_code, 404)
+        self.client.put('/api/v1/cart/2', json={'quantity': 1}, headers=headers)
+        rv = self.client.delete('/api/v1/cart/2', headers=headers)
+        self.assertEqual(rv.json['items'], [])
+
+    def test_product_cache(self):
+        """
+        Testing products are read once, evicted when the cache is full and never served after they change
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 3, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Apple Watch SE", 10, 199.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        statements = []
+
+        def record(connection, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            products = product_cache.get_many([1, 2, 99])
+            self.assertEqual(product_cache.get(2).name, 'Apple Watch SE')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(sorted(products), [1, 2])
+        self.assertFalse(hasattr(products[1], 'quantity'))
+        with self.assertRaises(AttributeError):
+            products[1].quantity = 5
+        # Changing a product empties the cache
+        Product.query.filter_by(id=1).update({'price_pence': 69999})
+        self.assertEqual(product_cache.get(1).price_pence, 69999)
+        db.session.commit()
+        self.assertEqual(product_cache.get(1).price_pence, 69999)
+        self.assertEqual(list(product_cache.products), [1])
+        # Selling stock changes the stock version but leaves the catalogue version and the cached products
+        versions = catalogue_version(), stock_version()
+        Product.query.filter_by(id=1).update({'quantity': Product.quantity - 1})
+        db.session.get(Product, 1).quantity = 1
+        self.assertFalse(db.session.info.get('catalogue_changed'))
+        db.session.commit()
+        self.assertEqual(catalogue_version(), versions[0])
+        self.assertNotEqual(stock_version(), versions[1])
+        self.assertEqual(list(product_cache.products), [1])
+        # The least recently used product is evicted
+        max_size = product_cache.max_size
+        product_cache.max_size = 1
+        try:
+            product_cache.get(2)
+            self.assertEqual(list(product_cache.products), [2])
+        finally:
+            product_cache.max_size = max_size
+        self.client.get('/delete-item/2')
+        self.assertIsNone(product_cache.get(2))
+
+    def test_compile_templates(self):
+        """
+        Testing every template is compiled into the cache and loaded from it by a new process instead of compiled
+        :return:
+        """
+        self.assertFalse(app.jinja_env.auto_reload)
+        directory = app.config['TEMPLATE_CACHE_DIR']
+        with tempfile.TemporaryDirectory() as cache_dir:
+            app.config['TEMPLATE_CACHE_DIR'] = cache_dir
+            configure_template_cache()
+            try:
+                app.jinja_env.cache.clear()
+                names = compile_templates()
+                self.assertIn('home.html', names)
+                self.assertEqual(len(os.listdir(cache_dir)), len(names))
+                # A new process has nothing in memory, so the templates are loaded from the cache
+                app.jinja_env.cache.clear()
+                compiled = []
+                compile_source = app.jinja_env.compile
+                app.jinja_env.compile = lambda *args, **kwargs: compiled.append(args) or compile_source(*args, **kwargs)
+                try:
+                    self.assertEqual(self.client.get('/').status_code, 200)
+                finally:
+                    del app.jinja_env.compile
+                self.assertEqual(compiled, [])
+            finally:
+                app.config['TEMPLATE_CACHE_DIR'] = directory
+                configure_template_cache()
+                app.jinja_env.cache.clear()
+
+    def test_warm_up(self):
+        """
+        Testing warming up a worker times each step and compiles the SQL the home page runs
+        :return:
+        """
+        # The test database has one connection, which the test's transaction holds
+        connections = app.config['WARM_UP_CONNECTIONS']
+        app.config['WARM_UP_CONNECTIONS'] = 0
+        try:
+            timings = warm_up()
+        finally:
+            app.config['WARM_UP_CONNECTIONS'] = connections
+        self.assertEqual([name for name, seconds in timings], ['mappers', 'connections', 'queries', 'search',
+                                                              'templates', 'renders'])
+        self.assertTrue(all(seconds >= 0 for name, seconds in timings))
+        compiled_cache = self.transaction.engine._compiled_cache
+        compiled = len(compiled_cache)
+        self.assertEqual(self.client.get('/').status_code, 200)
+        self.assertEqual(len(compiled_cache), compiled)
+
+    def test_fuzzy_search(self):
+        """
+        Testing searches allow for typing mistakes, rank the closest names first and see renamed products
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 3, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Apple Watch", 10, 199.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        self.create_product("Xbox Series X", 5, 449.99, "Games console", 'AppleWatch.jpg')
+        self.assertEqual([product.name for product in search_products('aple watch')], ['Apple Watch',
+                                                                                      'Apple Watch Ultra'])
+        self.assertEqual([product.name for product in search_products('Xbox seires')], ['Xbox Series X'])
+        self.assertEqual(search_products('Playstation'), [])
+        # Short queries are still matched anywhere in the name
+        self.assertEqual([product.name for product in search_products('tc')], ['Apple Watch Ultra', 'Apple Watch'])
+        self.assertIn(b'Apple Watch Ultra', self.search('aple wtch ultra').data)
+        # Selling stock leaves the index as it is, renaming a product rebuilds it
+        version = product_names_version()
+        Product.query.filter_by(id=3).update({'quantity': 4})
+        db.session.commit()
+        self.assertEqual(product_names_version(), version)
+        Product.query.filter_by(id=3).update({'name': 'Nintendo Switch'})
+        db.session.commit()
+        self.assertNotEqual(product_names_version(), version)
+        self.assertEqual([product.name for product in search_products('nintedo')], ['Nintendo Switch'])
+        self.assertEqual(search_index.get().ids.typecode, 'q')
+
+    def test_trigram_index(self):
+        """
+        Testing the trigram index counts the trigrams each name shares with the query
+        :return:
+        """
+        index = TrigramIndex([(1, 'Apple Watch'), (2, 'Apple Pencil'), (3, 'Watch Strap')])
+        self.assertEqual(index.search('watch', 0.5), [1, 3])
+        self.assertEqual(index.search('aple', 0.5), [1, 2])
+        self.assertEqual(index.search('pencl', 0.5), [2])
+        self.assertEqual(index.search('!!', 0.5), [])
+        self.assertTrue(all(positions.typecode == 'I' for positions in index.postings.values()))
+
+    def test_json_provider(self):
+        """
+        Testing rows and the values the standard library can't encode are written the same with and without orjson
+        :return:
+        """
+        self.register("admin", "admin@admin.com", "123456", "123456")
+        self.login("admin@admin.com", "123456")
+        self.create_product("Apple Watch Ultra", 3, 799.99, "Apple Smart Watch", 'AppleWatch.jpg')
+        rows = db.session.execute(db.select(Product.id, Product.name, Product.date_added)).all()
+        value = {'products': rows, 'price': decimal.Decimal('7.99'), 'day': datetime.date(2024, 5, 1), 'name': 'é'}
+        encoded = app.json.dumps(value)
+        date_added = rows[0].date_added.isoformat()
+        self.assertEqual(json.loads(encoded), {
+            'products': [{'id': 1, 'name': 'Apple Watch Ultra', 'date_added': date_added}],
+            'price': '7.99', 'day': '2024-05-01', 'name': 'é'
+        })
+        with app.test_request_context():
+            body = app.json.response(value).get_data()
+        accelerated = json_provider.orjson
+        json_provider.orjson = None
+        try:
+            self.assertEqual(json.loads(app.json.dumps(value)), json.loads(encoded))
+            with app.test_request_context():
+                self.assertEqual(json.loads(app.json.response(value).get_data()), json.loads(body))
+        finally:
+            json_provider.orjson = accelerated
+        with self.assertRaises(TypeError):
+            app.json.dumps({'value': object()})